@@ -1,7 +1,15 @@
 import logging
 import os.path as op
-
+import re
+import subprocess
+import time
+import uuid
+from collections import namedtuple
+from shlex import quote
+
+from .AdbClient import AdbClient, AdbClientError
 from .pyand import ADB
+from .ShellSession import ShellSession
 
 logger = logging.getLogger(__name__)
 
@@ -16,21 +24,80 @@ class ConnectionError(Exception):
     pass
 
 
-adb = None
+# Set once by setup() and only read afterwards, every handle copies them when it is created
+adb_path = 'adb'
+# AdbClient used instead of the adb binary when the 'server' or 'simulated' backend is selected
+client = None
+# Client of the 'simulated' backend, a dry run injects it with its devices before the experiment is created
+injected_client = None
+
+BACKENDS = ['adb', 'server', 'simulated']
+# Directory on the device used to stage APKs when installing through the adb server
+REMOTE_TMP_DIR = '/data/local/tmp'
+# Size of the chunks read by the streaming transfers, equal to the largest data packet of the sync service
+CHUNK_SIZE = AdbClient.SYNC_DATA_MAX
+
+
+def inject_client(simulated_client):
+    """Sets the client of the 'simulated' backend, e.g. a Simulator.SimulatedAdbClient, None removes it"""
+    global injected_client
+    injected_client = simulated_client
 
 
 # noinspection PyProtectedMember
-def setup(path='adb'):
-    global adb
+def setup(path='adb', backend='adb'):
+    global adb_path, client
+    if backend not in BACKENDS:
+        raise AdbError('Unknown adb backend "%s", expected one of %s' % (backend, BACKENDS))
+    if backend == 'simulated':
+        # Neither the adb binary nor a device is needed
+        if injected_client is None:
+            raise AdbError('The simulated adb backend is only available in a dry run')
+        adb_path = path
+        client = injected_client
+        return
     adb = ADB(adb_path=path)
     # Accessing class private variables to avoid another print of the same error message
     # https://stackoverflow.com/a/1301369
     if adb._ADB__error:
         raise AdbError('adb path is incorrect')
+    adb_path = path
+    client = None
+    if backend == 'server':
+        server_client = AdbClient()
+        try:
+            server_client.version()
+        except AdbClientError:
+            # Like the adb binary, start the server when it is not running yet
+            adb.start_server()
+            server_client.version()
+        client = server_client
+
+
+def run_adb(path, args):
+    """Runs the adb binary at path with the list of arguments and returns stdout and stderr combined"""
+    try:
+        cmdp = subprocess.Popen([path] + args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = cmdp.communicate()
+    except OSError as e:
+        raise AdbError(str(e))
+    return output.decode('utf-8', errors='replace').rstrip('\n')
+
+
+def devices():
+    """Returns a dictionary of connected devices along with an incremented id"""
+    if client is not None:
+        return client.devices()
+    device_dict = {}
+    for line in run_adb(adb_path, ['devices']).splitlines():
+        device = re.findall(r'([^\s]+)\t+.+$', line)
+        if device:
+            device_dict[len(device_dict)] = device[0]
+    return device_dict
 
 
 def connect(device_id):
-    device_list = adb.get_devices()
+    device_list = devices()
     if not device_list:
         raise ConnectionError('No devices are connected')
     logger.debug('Device list:\n%s' % device_list)
@@ -38,65 +105,181 @@ def connect(device_id):
         raise ConnectionError('%s: Device can not connected' % device_id)
 
 
-def shell_su(device_id, cmd):
-    adb.set_target_by_name(device_id)
-    result = adb.shell_command("su -c \'%s\'" % cmd)
-    result = result.decode('utf-8') if (isinstance(result, bytes) == True) else result
-    logger.debug('%s: "su -c \'%s\'" returned: \n%s' % (device_id, cmd, result))
-    if 'error' in result:
-        raise AdbError(result)
-    return result.rstrip()
-
-
-def shell(device_id, cmd):
-    adb.set_target_by_name(device_id)
-    result = adb.shell_command(cmd)
-    result = result.decode('utf-8') if (isinstance(result, bytes) == True) else result
-    logger.debug('%s: "%s" returned: \n%s' % (device_id, cmd, result))
-    if 'error' in result:
-        raise AdbError(result)
-    return result.rstrip()
-
-
-def list_apps(device_id):
-    return shell(device_id, 'pm list packages').replace('package:', '').split()
-
-
-# noinspection PyProtectedMember
-def install(device_id, apk, replace=True, all_permissions=True):
-    filename = op.basename(apk)
-    logger.debug('%s: Installing "%s"' % (device_id, filename))
-    adb.set_target_by_name(device_id)
-    cmd = 'install'
-    if replace:
-        cmd += ' -r'
-    if all_permissions:
-        cmd += ' -g'
-    adb.run_cmd('%s %s' % (cmd, apk))
-    # WARNING: Accessing class private variables
-    output = adb._ADB__output
-    logger.debug('install returned: %s' % output)
-    return output
-
-
-def uninstall(device_id, name, keep_data=False):
-    logger.debug('%s: Uninstalling "%s"' % (device_id, name))
-    adb.set_target_by_name(device_id)
-    # Flips the keep_data flag as it is incorrectly implemented in the pyand library
-    keep_data = not keep_data
-    result = adb.uninstall(package=name, keepdata=keep_data)
-    success_or_exception(result,
-                         '%s: "%s" uninstalled' % (device_id, name),
-                         '%s: Failed to uninstall "%s"' % (device_id, name)
-                         )
-
-
-def clear_app_data(device_id, name):
-    adb.set_target_by_name(device_id)
-    success_or_exception(adb.shell_command('pm clear %s' % name),
-                         '%s: Data of "%s" cleared' % (device_id, name),
-                         '%s: Failed to clear data for "%s"' % (device_id, name)
-                         )
+def get_handle(device_id, persistent_shell=True):
+    """Returns an adb handle bound to the device, using the configuration of setup()"""
+    # A client declares whether it has a shell to keep open
+    persistent_shell = persistent_shell and (client is None or client.persistent_shell)
+    session = ShellSession(device_id, adb_path=adb_path, client=client) if persistent_shell else None
+    return AdbHandle(device_id, adb_path, client, session)
+
+
+class AdbHandle(namedtuple('AdbHandle', ['serial', 'adb_path', 'client', 'session'])):
+    """Immutable adb handle bound to the serial of one device.
+
+    The handle keeps no state between commands, so handles of different devices can be used concurrently from
+    different threads. Commands of one device are serialized by its shell session.
+    """
+    __slots__ = ()
+
+    def run(self, args):
+        """Runs the adb binary for this device with the list of arguments"""
+        output = run_adb(self.adb_path, ['-s', str(self.serial)] + args)
+        if 'device unauthorized' in output:
+            raise AdbError('%s: Device unauthorized' % self.serial)
+        return output
+
+    def raw_shell(self, cmd):
+        """Runs cmd on the device without any checks on the output"""
+        if self.session is not None and self.session.supported():
+            return self.session.run(cmd)[0]
+        if self.client is not None:
+            return self.client.shell(str(self.serial), cmd)
+        return self.run(['shell', cmd])
+
+    def shell(self, cmd):
+        result = self.raw_shell(cmd)
+        logger.debug('%s: "%s" returned: \n%s' % (self.serial, cmd, result))
+        if 'error' in result:
+            raise AdbError(result)
+        return result.rstrip()
+
+    def shell_su(self, cmd):
+        result = self.raw_shell("su -c \'%s\'" % cmd)
+        logger.debug('%s: "su -c \'%s\'" returned: \n%s' % (self.serial, cmd, result))
+        if 'error' in result:
+            raise AdbError(result)
+        return result.rstrip()
+
+    def shell_batch(self, cmds):
+        """Runs the independent commands in a single shell invocation and returns the output of every command"""
+        marker = '__ANDROID_RUNNER_BATCH_%s__' % uuid.uuid4().hex
+        # Like the shell session, every command runs in a subshell and the newline in front of the marker guarantees
+        # that it starts on a new line
+        script = ''.join('( %s\n) </dev/null 2>&1; printf "\\n%s\\n"\n' % (cmd, marker) for cmd in cmds)
+        result = self.raw_shell(script)
+        # Devices without the shell protocol use a pty, which translates newlines to \r\n
+        outputs = re.split(r'\r?\n%s(?:\r?\n|$)' % marker, result)
+        if len(outputs) != len(cmds) + 1:
+            raise AdbError('%s: Unexpected output of batch %s: \n%s' % (self.serial, cmds, result))
+        for cmd, output in zip(cmds, outputs):
+            logger.debug('%s: "%s" returned: \n%s' % (self.serial, cmd, output))
+            if 'error' in output:
+                raise AdbError(output)
+        return [output.rstrip() for output in outputs[:-1]]
+
+    def list_apps(self):
+        return self.shell('pm list packages').replace('package:', '').split()
+
+    def install(self, apk, replace=True, all_permissions=True):
+        filename = op.basename(apk)
+        logger.debug('%s: Installing "%s"' % (self.serial, filename))
+        cmd = 'install'
+        if replace:
+            cmd += ' -r'
+        if all_permissions:
+            cmd += ' -g'
+        if self.client is not None:
+            # 'adb install' stages the APK on the device and calls the package manager, do the same over the server
+            remote = op.join(REMOTE_TMP_DIR, filename)
+            self.client.push(str(self.serial), apk, remote)
+            output = self.client.shell(str(self.serial), 'pm %s %s; rm -f %s' % (cmd, remote, remote))
+        else:
+            output = self.run(cmd.split() + [apk])
+        logger.debug('install returned: %s' % output)
+        return output
+
+    def uninstall(self, name, keep_data=False):
+        logger.debug('%s: Uninstalling "%s"' % (self.serial, name))
+        if self.client is not None:
+            result = self.client.shell(str(self.serial), 'pm uninstall %s%s' % ('-k ' if keep_data else '', name))
+        else:
+            result = self.run(['uninstall'] + (['-k'] if keep_data else []) + [name])
+        success_or_exception(result,
+                             '%s: "%s" uninstalled' % (self.serial, name),
+                             '%s: Failed to uninstall "%s"' % (self.serial, name)
+                             )
+
+    def clear_app_data(self, name):
+        success_or_exception(self.raw_shell('pm clear %s' % name),
+                             '%s: Data of "%s" cleared' % (self.serial, name),
+                             '%s: Failed to clear data for "%s"' % (self.serial, name)
+                             )
+
+    def push(self, local, remote):
+        if self.client is not None:
+            return transfer_summary('pushed', self.client.push(str(self.serial), local, remote))
+        return self.run(['push', local, remote])
+
+    def pull(self, remote, local):
+        if self.client is not None:
+            return transfer_summary('pulled', self.client.pull(str(self.serial), remote, local))
+        return self.run(['pull', remote, local])
+
+    def pull_stream(self, remote):
+        """Reads the remote file and yields its content as chunks of bytes while they arrive"""
+        if self.client is not None:
+            try:
+                for chunk in self.client.pull_stream(str(self.serial), remote):
+                    yield chunk
+            except AdbClientError as e:
+                raise AdbError(str(e))
+            return
+        # exec-out passes the bytes unaltered, but mixes in error messages and drops the exit code
+        if self.raw_shell('[ -r %s ] && echo readable' % quote(remote)).strip() != 'readable':
+            raise AdbError('%s: No such file or directory' % remote)
+        try:
+            process = subprocess.Popen([self.adb_path, '-s', str(self.serial), 'exec-out', 'cat %s' % quote(remote)],
+                                       shell=False, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            raise AdbError(str(e))
+        try:
+            for chunk in iter(lambda: process.stdout.read1(CHUNK_SIZE), b''):
+                yield chunk
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    def push_stream(self, chunks, remote):
+        """Writes the chunks of bytes to the remote file"""
+        if self.client is not None:
+            try:
+                self.client.push_stream(str(self.serial), chunks, remote)
+            except AdbClientError as e:
+                raise AdbError(str(e))
+            return
+        try:
+            process = subprocess.Popen([self.adb_path, '-s', str(self.serial), 'exec-in', 'cat > %s' % quote(remote)],
+                                       shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise AdbError(str(e))
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except (IOError, OSError):
+            # adb stopped reading, its output tells why
+            pass
+        finally:
+            output = process.communicate()[0].decode('utf-8', errors='replace')
+        if process.returncode != 0 or output.strip():
+            raise AdbError('%s: Failed to write "%s": %s' % (self.serial, remote, output.strip()))
+
+    def logcat(self, regex=None):
+        # https://developer.android.com/studio/command-line/logcat.html#Syntax
+        # -d prints to screen and exits
+        params = '-d'
+        if regex is not None:
+            params += ' -e %s' % regex
+        if self.client is not None:
+            return self.client.shell(str(self.serial), 'logcat %s' % params)
+        return self.run(['logcat'] + params.split())
+
+    def close(self):
+        """Stops the persistent shell session, it is restarted by the next shell command"""
+        if self.session is not None:
+            self.session.close()
 
 
 def success_or_exception(result, success_msg, fail_msg):
@@ -108,34 +291,35 @@ def success_or_exception(result, success_msg, fail_msg):
         raise AdbError(result)
 
 
-# Same with push_local_file(), but with the quotes removed
-# adb doesn't want quotes for some reason
-# noinspection PyProtectedMember
-def push(device_id, local, remote):
-    adb.set_target_by_name(device_id)
-    adb.run_cmd('push %s %s' % (local, remote))
-    # WARNING: Accessing class private variables
-    return adb._ADB__output
+class Transfer(object):
+    """Keeps track of the size and throughput of a streaming transfer"""
 
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.size = 0
+        self.duration = 0.0
+        self.start_time = None
 
-# Same with get_remote_file(), but with the quotes removed
-# adb doesn't want quotes for some reason
-# noinspection PyProtectedMember
-def pull(device_id, remote, local):
-    adb.set_target_by_name(device_id)
-    adb.run_cmd('pull %s %s' % (remote, local))
-    # WARNING: Accessing class private variables
-    if adb._ADB__error and "bytes in" in adb._ADB__error:
-        adb._ADB__output = adb._ADB__error
-        adb._ADB__error = None
-    return adb._ADB__output
-
-
-def logcat(device_id, regex=None):
-    # https://developer.android.com/studio/command-line/logcat.html#Syntax
-    # -d prints to screen and exits
-    params = '-d'
-    if regex is not None:
-        params += ' -e %s' % regex
-    adb.set_target_by_name(device_id)
-    return adb.get_logcat(lcfilter=params)
+    def count(self, chunks):
+        """Passes the chunks through, reporting the transferred bytes and elapsed seconds to the progress callback"""
+        self.start_time = time.time()
+        for chunk in chunks:
+            self.size += len(chunk)
+            self.duration = time.time() - self.start_time
+            if self.progress is not None:
+                self.progress(self.size, self.duration)
+            yield chunk
+        self.duration = time.time() - self.start_time
+
+    @property
+    def throughput(self):
+        """Average throughput in bytes per second"""
+        return self.size / self.duration if self.duration > 0 else 0.0
+
+    def __str__(self):
+        return '%d bytes in %.3fs (%.1f KB/s)' % (self.size, self.duration, self.throughput / 1024)
+
+
+def transfer_summary(action, size):
+    """Mimics the summary printed by 'adb push' and 'adb pull'"""
+    return '%d bytes %s' % (size, action)
@@ -0,0 +1,246 @@
+import os
+import os.path as op
+import socket
+import stat
+import struct
+import time
+
+
+class AdbClientError(Exception):
+    """Raised when the adb server refuses a request or the connection fails"""
+    pass
+
+
+class AdbClient(object):
+    """Client for the adb host protocol, talks to the adb server over a socket instead of running the adb binary.
+
+    Every request opens a new connection to the server, so the client holds no mutable state and can be shared.
+    https://android.googlesource.com/platform/packages/modules/adb/+/refs/heads/master/protocol.txt
+    https://android.googlesource.com/platform/packages/modules/adb/+/refs/heads/master/SYNC.TXT
+    """
+    DEFAULT_HOST = 'localhost'
+    DEFAULT_PORT = 5037
+    # The maximum size of a single DATA packet of the sync service
+    SYNC_DATA_MAX = 64 * 1024
+    # open_shell() is supported, so commands can go through a ShellSession
+    persistent_shell = True
+
+    def __init__(self, host=None, port=None, timeout=None):
+        self.host = host if host is not None else self.DEFAULT_HOST
+        # Same environment variable as the adb binary
+        self.port = int(port if port is not None else os.environ.get('ANDROID_ADB_SERVER_PORT', self.DEFAULT_PORT))
+        self.timeout = timeout
+
+    def connect(self):
+        """Opens a new connection to the adb server"""
+        try:
+            return socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except (IOError, OSError) as e:
+            raise AdbClientError('Cannot connect to adb server at %s:%s: %s' % (self.host, self.port, e))
+
+    @staticmethod
+    def send_request(sock, request):
+        """Sends a length prefixed request to the server"""
+        payload = request.encode('utf-8')
+        sock.sendall(('%04x' % len(payload)).encode('ascii') + payload)
+
+    @staticmethod
+    def recv_exactly(sock, size):
+        chunks = []
+        while size > 0:
+            chunk = sock.recv(min(size, 65536))
+            if not chunk:
+                raise AdbClientError('Connection closed by adb server')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def read_string(self, sock):
+        """Reads a length prefixed string from the server"""
+        length = int(self.recv_exactly(sock, 4), 16)
+        return self.recv_exactly(sock, length).decode('utf-8', errors='replace')
+
+    def read_status(self, sock, request):
+        status = self.recv_exactly(sock, 4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbClientError('%s: %s' % (request, self.read_string(sock)))
+        raise AdbClientError('%s: unexpected response %r' % (request, status))
+
+    def request(self, sock, request):
+        self.send_request(sock, request)
+        self.read_status(sock, request)
+
+    def host_query(self, request):
+        """Runs a host request which answers with a single length prefixed string"""
+        sock = self.connect()
+        try:
+            self.request(sock, request)
+            return self.read_string(sock)
+        finally:
+            sock.close()
+
+    def version(self):
+        """Returns the version of the adb server"""
+        return int(self.host_query('host:version'), 16)
+
+    def devices(self):
+        """Returns a dictionary of connected devices with an incremented id, like pyand's ADB.get_devices()"""
+        devices = {}
+        for line in self.host_query('host:devices').splitlines():
+            fields = line.split('\t')
+            if len(fields) == 2 and fields[0]:
+                devices[len(devices)] = fields[0]
+        return devices
+
+    def features(self, serial):
+        """Returns the set of features that both the device and the adb server support, e.g. shell_v2"""
+        return set(filter(None, self.host_query('host-serial:%s:features' % serial).split(',')))
+
+    def transport(self, serial, service):
+        """Returns a socket connected to service on the device with the given serial"""
+        sock = self.connect()
+        try:
+            self.request(sock, 'host:transport:%s' % serial)
+            self.request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def shell_stream(self, serial, cmd, chunk_size=4096):
+        """Runs cmd on the device and yields the output as it arrives"""
+        sock = self.transport(serial, 'shell:%s' % cmd)
+        try:
+            while True:
+                chunk = sock.recv(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            sock.close()
+
+    def shell(self, serial, cmd):
+        """Runs cmd on the device and returns the output"""
+        return b''.join(self.shell_stream(serial, cmd)).decode('utf-8', errors='replace')
+
+    def open_shell(self, serial, cmd='sh'):
+        """Returns a socket connected to the stdin and stdout of cmd on the device
+
+        A command is always given, because adbd allocates a pty for an empty command.
+        """
+        return self.transport(serial, 'shell:%s' % cmd)
+
+    # Sync service
+    @staticmethod
+    def sync_send(sock, sync_id, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        sock.sendall(sync_id + struct.pack('<I', len(data)) + data)
+
+    def sync_read_header(self, sock):
+        header = self.recv_exactly(sock, 8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+    def sync_fail(self, sock, length, path):
+        raise AdbClientError('%s: %s' % (path, self.recv_exactly(sock, length).decode('utf-8', errors='replace')))
+
+    def sync(self, serial):
+        """Returns a socket connected to the sync service of the device"""
+        return self.transport(serial, 'sync:')
+
+    def sync_quit(self, sock):
+        try:
+            self.sync_send(sock, b'QUIT', b'')
+        except (IOError, OSError):
+            pass
+        sock.close()
+
+    def stat(self, serial, remote):
+        """Returns a tuple (mode, size, mtime) for remote, mode is 0 if the file does not exist"""
+        sock = self.sync(serial)
+        try:
+            self.sync_send(sock, b'STAT', remote)
+            response = self.recv_exactly(sock, 16)
+            if response[:4] != b'STAT':
+                raise AdbClientError('%s: unexpected response %r' % (remote, response[:4]))
+            return struct.unpack('<III', response[4:])
+        finally:
+            self.sync_quit(sock)
+
+    def pull_stream(self, serial, remote):
+        """Yields the content of the remote file in chunks while it is transferred"""
+        sock = self.sync(serial)
+        try:
+            self.sync_send(sock, b'RECV', remote)
+            while True:
+                sync_id, length = self.sync_read_header(sock)
+                if sync_id == b'DATA':
+                    yield self.recv_exactly(sock, length)
+                elif sync_id == b'DONE':
+                    break
+                elif sync_id == b'FAIL':
+                    self.sync_fail(sock, length, remote)
+                else:
+                    raise AdbClientError('%s: unexpected response %r' % (remote, sync_id))
+        finally:
+            self.sync_quit(sock)
+
+    def pull(self, serial, remote, local):
+        """Pulls the remote file to local, which may be a directory, and returns the number of bytes"""
+        if op.isdir(local):
+            local = op.join(local, op.basename(remote.rstrip('/')))
+        size = 0
+        with open(local, 'wb') as f:
+            for chunk in self.pull_stream(serial, remote):
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    def push_stream(self, serial, chunks, remote, mode=0o644, mtime=None):
+        """Writes the chunks to the remote file and returns the number of bytes"""
+        sock = self.sync(serial)
+        size = 0
+        try:
+            self.sync_send(sock, b'SEND', '%s,%d' % (remote, stat.S_IFREG | mode))
+            for chunk in chunks:
+                for i in range(0, len(chunk), self.SYNC_DATA_MAX):
+                    data = chunk[i:i + self.SYNC_DATA_MAX]
+                    self.sync_send(sock, b'DATA', data)
+                    size += len(data)
+            sock.sendall(b'DONE' + struct.pack('<I', int(mtime if mtime is not None else time.time())))
+            sync_id, length = self.sync_read_header(sock)
+            if sync_id == b'FAIL':
+                self.sync_fail(sock, length, remote)
+            if sync_id != b'OKAY':
+                raise AdbClientError('%s: unexpected response %r' % (remote, sync_id))
+        finally:
+            self.sync_quit(sock)
+        return size
+
+    def push_file(self, serial, local, remote):
+        def read_chunks():
+            with open(local, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.SYNC_DATA_MAX), b''):
+                    yield chunk
+
+        return self.push_stream(serial, read_chunks(), remote, mode=stat.S_IMODE(os.stat(local).st_mode),
+                                mtime=os.stat(local).st_mtime)
+
+    def push(self, serial, local, remote):
+        """Pushes a file or a directory to the device and returns the number of bytes, like 'adb push'
+
+        A directory is copied into remote/<directory name>, a file into remote/<file name> if remote ends with a '/'.
+        """
+        if op.isdir(local):
+            root = op.join(remote, op.basename(op.normpath(local)))
+            size = 0
+            for path, _, files in os.walk(local):
+                remote_dir = op.normpath(op.join(root, op.relpath(path, local)))
+                for name in sorted(files):
+                    size += self.push_file(serial, op.join(path, name), op.join(remote_dir, name))
+            return size
+        if remote.endswith('/'):
+            remote = op.join(remote, op.basename(local))
+        return self.push_file(serial, local, remote)
@@ -2,9 +2,11 @@ import logging
 import os.path as op
 import re
 import time
+from shlex import quote
 
-from . import Adb
+from . import Adb, Manifest
 from .Adb import AdbError
+from .DeviceInfo import DeviceInfo
 from .util import ConfigError, makedirs
 
 
@@ -18,43 +20,75 @@ class Device:
         self.root_unplug_file = settings.get('usb_charging_disabled_file', None)
         self.root_plug_value = None
         Adb.connect(device_id)
+        self.adb = Adb.get_handle(device_id, persistent_shell=settings.get('persistent_shell', True))
+        self.info = None
+        # Installed packages, listed on first use and kept up to date by install() and uninstall()
+        self.packages = None
+
+    def get_info(self):
+        """Returns the DeviceInfo, read with a single getprop on first use and cached for the session"""
+        if self.info is None:
+            # Not shell(): property values can contain 'error'
+            self.info = DeviceInfo.from_getprop(self.adb.raw_shell('getprop'))
+        return self.info
 
     def get_version(self):
         """Returns the Android version"""
-        return Adb.shell(self.id, 'getprop ro.build.version.release')
+        return self.get_info().version
 
     def get_api_level(self):
         """Returns the Android API level as a number"""
-        return Adb.shell(self.id, 'getprop ro.build.version.sdk')
+        api_level = self.get_info().api_level
+        if api_level is not None:
+            return api_level
+        # The dump can miss the property, e.g. when getprop was cut off while the device was booting
+        sdk = self.adb.raw_shell('getprop ro.build.version.sdk').strip()
+        if not sdk.isdigit():
+            raise AdbError('%s: Unknown API level "%s"' % (self.id, sdk))
+        return int(sdk)
 
     def is_installed(self, apps):
         """Returns a boolean if a package is installed"""
         return {app: app in self.get_app_list() for app in apps}
 
-    def get_app_list(self):
-        """Returns a list of installed packages on the system"""
-        return Adb.list_apps(self.id)
+    def get_app_list(self, refresh=False):
+        """Returns the set of installed packages on the system, only listed on the device when refreshed"""
+        if self.packages is None or refresh:
+            self.packages = frozenset(self.adb.list_apps())
+        return self.packages
 
     def install(self, apk):
         """Check if the file exists, and then install the package"""
         if not op.isfile(apk):
             raise AdbError("%s is not found" % apk)
-        Adb.install(self.id, apk)
+        self.adb.install(apk)
+        # The package name is only known to the device
+        if self.packages is not None:
+            self.get_app_list(refresh=True)
+
+    def get_apk_hash(self, name):
+        """Returns the MD5 hash of the installed (base) APK of a package, None if it can't be determined"""
+        # pm path lists the base APK first, toybox md5sum is available since Android 6.0
+        output = self.adb.shell('apk=$(pm path %s | head -n 1); md5sum "${apk#package:}"' % name)
+        md5 = output.split()[0] if output else ''
+        return md5 if re.match(r'^[0-9a-f]{32}$', md5) else None
 
     def uninstall(self, name):
         """Uninstalls the package on the device"""
-        Adb.uninstall(self.id, name)
+        self.adb.uninstall(name)
+        if self.packages is not None:
+            self.packages = self.packages - {name}
 
     def su_unplug(self, restart):
         """Root unplugs the device"""
-        self.root_plug_value = Adb.shell_su(self.id, 'cat %s' % self.root_unplug_file)
+        self.root_plug_value = self.adb.shell_su('cat %s' % self.root_unplug_file)
         if 'su: not found' in self.root_plug_value:
             raise AdbError("%s %s: is not rooted" % (self.id, self.name))
         if 'No such file or directory' in self.root_plug_value:
             raise ConfigError('%s %s: the root unplug file seems to be invalid' % (self.id, self.name))
         if restart:
             self.check_plug_value()
-        Adb.shell_su(self.id, 'echo %s > %s' % (self.root_unplug_value, self.root_unplug_file))
+        self.adb.shell_su('echo %s > %s' % (self.root_unplug_value, self.root_unplug_file))
 
     def check_plug_value(self):
         """Checks the root plug value for validity, if it's not valid it tries to make it valid"""
@@ -79,35 +113,35 @@ class Device:
             self.logger.info('Root unpluged')
         else:
             self.logger.info('Default unplug')
-            if int(self.get_api_level()) < 23:
+            if self.get_api_level() < 23:
                 # API level < 23, 4.4.3+ tested, WARNING: hardcoding
-                Adb.shell(self.id, 'dumpsys battery set usb 0')
-                # Adb.shell(self.id, 'dumpsys battery set ac 0')
-                # Adb.shell(self.id, 'dumpsys battery set wireless 0')
+                self.adb.shell('dumpsys battery set usb 0')
+                # self.adb.shell('dumpsys battery set ac 0')
+                # self.adb.shell('dumpsys battery set wireless 0')
             else:
                 # API level 23+ (Android 6.0+)
-                Adb.shell(self.id, 'dumpsys battery unplug')
+                self.adb.shell('dumpsys battery unplug')
 
     def su_plug(self):
         """Reset the power status of the device if root unpluged"""
         self.logger.info('Root pluged, please check if device is charging')
-        Adb.shell_su(self.id, 'echo %s > %s' % (self.root_plug_value, self.root_unplug_file))
+        self.adb.shell_su('echo %s > %s' % (self.root_plug_value, self.root_unplug_file))
 
     def plug(self):
         """Reset the power status of the device"""
         # if self.get_api_level() < 23:
         # API level < 23, 4.4.3+ tested, WARNING: hardcoding
         # reset only restarts auto-update
-        #    Adb.shell(self.id, 'dumpsys battery set usb 1')
+        #    self.adb.shell('dumpsys battery set usb 1')
         # API level 23+ (Android 6.0+)
         if self.root_unplug:
             self.su_plug()
-        Adb.shell(self.id, 'dumpsys battery reset')
+        self.adb.shell('dumpsys battery reset')
 
     def current_activity(self):
         """Returns the current focused activity on the system"""
         # https://github.com/aldonin/appium-adb/blob/7b4ed3e7e2b384333bb85f8a2952a3083873a90e/lib/adb.js#L1278
-        windows = Adb.shell(self.id, 'dumpsys window windows')
+        windows = self.adb.shell('dumpsys window windows')
         null_re = r'mFocusedApp=null'
         # https://regex101.com/r/xZ8vF7/1
         current_focus_re = r'mCurrentFocus.+\s([^\s\/\}]+)\/[^\s\/\}]+(\.[^\s\/\}]+)}'
@@ -137,7 +171,7 @@ class Device:
     def launch_package(self, package):
         """Launches a package by name without activity, returns instantly"""
         # https://stackoverflow.com/a/25398877
-        result = Adb.shell(self.id, 'monkey -p {} 1'.format(package))
+        result = self.adb.shell('monkey -p {} 1'.format(package))
         if 'monkey aborted' in result:
             raise AdbError('Could not launch "{}"'.format(package))
 
@@ -157,36 +191,110 @@ class Device:
         # https://android.stackexchange.com/a/113919
         if from_scratch:
             cmd += ' --activity-clear-task'
-        return Adb.shell(self.id, cmd)
+        return self.adb.shell(cmd)
+
+    def is_running(self, name):
+        """Returns if a process of the package is running"""
+        # pidof is missing before Android 7.0, ps lists the package name as the last column
+        output = self.adb.raw_shell('pidof %s || ps' % name)
+        lines = output.strip().splitlines()
+        if lines and lines[0].split() and all(pid.isdigit() for pid in lines[0].split()):
+            return True
+        return any(line.split()[-1] == name for line in lines if line.split())
+
+    def file_size(self, path):
+        """Returns the size in bytes of a file on the device, None if it does not exist"""
+        output = self.adb.raw_shell('[ -f %s ] && stat -c %%s %s' % (quote(path), quote(path))).strip()
+        return int(output) if output.isdigit() else None
+
+    def clock_offset(self, round_trips=5):
+        """Returns the seconds the device clock is ahead of the host clock and the uncertainty of that in seconds.
+
+        Like NTP, the device is assumed to read its clock halfway the round trip, the round trip that took the least
+        time is used. The clock of devices without %N in date is read in whole seconds.
+        """
+        return self.measure_offset('date +%s.%N', round_trips)
+
+    def uptime_offset(self, round_trips=5):
+        """Returns the seconds the uptime of the device is ahead of the host clock and the uncertainty of that"""
+        return self.measure_offset('cat /proc/uptime', round_trips)
+
+    def measure_offset(self, command, round_trips):
+        best = None
+        for _ in range(round_trips):
+            sent = time.time()
+            output = self.adb.raw_shell(command).strip()
+            received = time.time()
+            seconds, _, fraction = (output.split() or [''])[0].partition('.')
+            if not seconds.isdigit():
+                raise AdbError('%s: Unexpected output of %s: %s' % (self.id, command.split()[0], output))
+            # The clock is truncated to its resolution, it is read halfway the resolution on average
+            resolution = 10.0 ** -len(fraction) if fraction.isdigit() else 1.0
+            device_time = float('%s.%s' % (seconds, fraction) if fraction.isdigit() else seconds) + resolution / 2
+            offset = device_time - (sent + received) / 2
+            uncertainty = (received - sent + resolution) / 2
+            if best is None or uncertainty < best[1]:
+                best = (offset, uncertainty)
+        return best
 
     def force_stop(self, name):
         """Force stop an app by package name"""
-        Adb.shell(self.id, 'am force-stop %s' % name)
+        self.adb.shell('am force-stop %s' % name)
 
     def clear_app_data(self, name):
         """Clears the data of an app by package name"""
-        Adb.clear_app_data(self.id, name)
+        self.adb.clear_app_data(name)
 
     def logcat_to_file(self, path):
         """Dumps the last x lines of logcat into a file specified by path"""
         makedirs(path)
-        with open(op.join(path, '%s_%s.txt' % (self.id, time.strftime('%Y.%m.%d_%H%M%S'))), 'w+') as f:
-            f.write(Adb.logcat(self.id))
+        filename = op.join(path, '%s_%s.txt' % (self.id, time.strftime('%Y.%m.%d_%H%M%S')))
+        with open(filename, 'w+') as f:
+            Manifest.register(filename)
+            f.write(self.adb.logcat())
 
     def logcat_regex(self, regex):
-        return Adb.logcat(self.id, regex=regex)
+        return self.adb.logcat(regex=regex)
 
     def push(self, local, remote):
         """Pushes a file from the computer to the device"""
-        return Adb.push(self.id, local, remote)
+        return self.adb.push(local, remote)
 
     def pull(self, remote, local):
         """Pulls a file from the device to the computer"""
-        return Adb.pull(self.id, remote, local)
+        Manifest.register(op.join(local, op.basename(remote)) if op.isdir(local) else local)
+        return self.adb.pull(remote, local)
+
+    def pull_stream(self, remote, progress=None):
+        """Pulls a file from the device as an iterator of chunks of bytes, available while the transfer runs"""
+        return Adb.Transfer(progress).count(self.adb.pull_stream(remote))
+
+    def pull_to(self, remote, fileobj, progress=None):
+        """Pulls a file from the device into a binary file object or buffer, returns the finished Transfer"""
+        transfer = Adb.Transfer(progress)
+        for chunk in transfer.count(self.adb.pull_stream(remote)):
+            fileobj.write(chunk)
+        self.logger.debug('%s: Pulled "%s": %s' % (self.id, remote, transfer))
+        return transfer
+
+    def push_from(self, fileobj, remote, progress=None):
+        """Pushes the content of a binary file object or buffer to a file on the device, returns the finished Transfer"""
+        transfer = Adb.Transfer(progress)
+        self.adb.push_stream(transfer.count(iter(lambda: fileobj.read(Adb.CHUNK_SIZE), b'')), remote)
+        self.logger.debug('%s: Pushed "%s": %s' % (self.id, remote, transfer))
+        return transfer
 
     def shell(self, cmd):
-        """Runs the device shell with command specified by cmd"""
-        return Adb.shell(self.id, cmd)
+        """Runs the device shell with command specified by cmd, using the persistent shell session if enabled"""
+        return self.adb.shell(cmd)
+
+    def shell_batch(self, cmds):
+        """Runs the list of independent commands in a single adb round trip, returns the list of their outputs"""
+        return self.adb.shell_batch(cmds)
+
+    def close_shell_session(self):
+        """Stops the persistent shell session, it is restarted on the next call to shell()"""
+        self.adb.close()
 
     def __str__(self):
         return '%s (%s, Android %s, API level %s)' % (self.name, self.id, self.get_version(), self.get_api_level())
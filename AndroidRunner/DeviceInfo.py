@@ -0,0 +1,44 @@
+import re
+
+
+class DeviceInfo(object):
+    """Read-only properties of a device, parsed from a single 'getprop' dump"""
+    # Every property is printed as: [name]: [value]
+    PROPERTY_RE = re.compile(r'^\[([^\]]+)\]: \[(.*)\]\s*$')
+
+    def __init__(self, properties):
+        self.properties = dict(properties)
+        self.version = self.get('ro.build.version.release')
+        self.api_level = self.get_int('ro.build.version.sdk')
+        self.manufacturer = self.get('ro.product.manufacturer')
+        self.model = self.get('ro.product.model')
+        self.abi = self.get('ro.product.cpu.abi')
+        self.build_fingerprint = self.get('ro.build.fingerprint')
+
+    @classmethod
+    def from_getprop(cls, output):
+        """Builds the DeviceInfo from the output of getprop without arguments"""
+        properties = {}
+        for line in output.splitlines():
+            match = cls.PROPERTY_RE.match(line)
+            if match:
+                properties[match.group(1)] = match.group(2)
+        return cls(properties)
+
+    def get(self, name, default=None):
+        """Returns the value of any property by name"""
+        return self.properties.get(name, default)
+
+    def get_int(self, name, default=None):
+        try:
+            return int(self.properties[name])
+        except (KeyError, ValueError):
+            return default
+
+    def to_dict(self):
+        """Returns the typed properties, e.g. to be written next to the results"""
+        return {'version': self.version, 'api_level': self.api_level, 'manufacturer': self.manufacturer,
+                'model': self.model, 'abi': self.abi, 'build_fingerprint': self.build_fingerprint}
+
+    def __repr__(self):
+        return 'DeviceInfo(%s)' % ', '.join('%s=%r' % item for item in sorted(self.to_dict().items()))
@@ -9,11 +9,11 @@ from .util import ConfigError, load_json
 
 
 class Devices:
-    def __init__(self, devices, adb_path='adb', devices_spec=None):
+    def __init__(self, devices, adb_path='adb', devices_spec=None, adb_backend='adb'):
         if devices_spec is None:
             devices_spec = op.join(ROOT_DIR, 'devices.json')
             
-        Adb.setup(adb_path)
+        Adb.setup(adb_path, backend=adb_backend)
         mapping_file = load_json(devices_spec)
         self._device_map = {n: mapping_file.get(n, None) for n in devices}
         for name, device_id in list(self._device_map.items()):
@@ -0,0 +1,241 @@
+import glob
+import logging
+import os.path as op
+import re
+import shutil
+from collections import OrderedDict, defaultdict, namedtuple
+
+import paths
+from . import Adb, Scheduler, Simulator, Waits
+from .BrowserFactory import BrowserFactory
+from .ExperimentFactory import ExperimentFactory
+from .Profilers import Profilers
+from .Progress import Progress
+from .util import ConfigError, load_json
+
+# A run of the dry run with its start and duration in seconds on the virtual clock
+RunEstimate = namedtuple('RunEstimate', ['run', 'start', 'duration'])
+
+
+class HookHistory(object):
+    """Durations of the script and profiler hooks, read from the logs of earlier experiments"""
+    # Written by Scripts.run() and Profilers.run_hook(), behind the time, level and logger name of the log file
+    LINE_RE = re.compile(r':(Scripts|Profilers):Hook (\S+) took ([0-9.]+)s\s*$')
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.log_count = 0
+
+    @classmethod
+    def from_output_dir(cls, output_dir):
+        """Reads the experiment.log of every earlier experiment in the output directory"""
+        history = cls()
+        for log_file in sorted(glob.glob(op.join(output_dir, '*', 'experiment.log'))):
+            history.read_log(log_file)
+        return history
+
+    def read_log(self, path):
+        with open(path, errors='replace') as f:
+            for line in f:
+                match = self.LINE_RE.search(line)
+                if match:
+                    self.durations[(match.group(1), match.group(2))].append(float(match.group(3)))
+        self.log_count += 1
+
+    def mean(self, component, hook):
+        """Returns the mean duration of the hook in seconds, None if it never ran"""
+        durations = self.durations.get((component, hook))
+        return sum(durations) / len(durations) if durations else None
+
+
+class EstimatedScripts(object):
+    """Replaces the scripts in a dry run, a hook takes its mean duration in earlier experiments or its timeout"""
+
+    def __init__(self, scripts, history, clock):
+        self.scripts = scripts.scripts
+        self.history = history
+        self.clock = clock
+        # Hooks that never ran before, estimated by the timeout of their scripts
+        self.unknown = set()
+
+    def estimate(self, name):
+        if not self.scripts.get(name):
+            return 0.0
+        duration = self.history.mean('Scripts', name)
+        if duration is None:
+            self.unknown.add(name)
+            duration = sum(script.timeout for script in self.scripts[name])
+        return duration
+
+    def run(self, name, device, *args, **kwargs):
+        self.clock.sleep(self.estimate(name))
+
+
+class EstimatedProfilers(object):
+    """Replaces the profilers in a dry run, a hook takes its mean duration in earlier experiments"""
+
+    def __init__(self, profilers, history, clock):
+        self.configured = bool(profilers.profilers)
+        self.history = history
+        self.clock = clock
+        self.loaded_devices = []
+        # Hooks that never ran before, estimated to take no time
+        self.unknown = set()
+
+    def estimate(self, hook):
+        if not self.configured:
+            return 0.0
+        duration = self.history.mean('Profilers', hook)
+        if duration is None:
+            self.unknown.add(hook)
+            duration = 0.0
+        return duration
+
+    def dependencies(self):
+        return []
+
+    def load(self, device):
+        if device.name not in self.loaded_devices:
+            self.clock.sleep(self.estimate('load'))
+            self.loaded_devices.append(device.name)
+
+    def start_profiling(self, device, **kwargs):
+        self.clock.sleep(self.estimate('start_profiling'))
+
+    def stop_profiling(self, device, **kwargs):
+        self.clock.sleep(self.estimate('stop_profiling'))
+
+    def collect_results(self, device):
+        self.clock.sleep(self.estimate('collect_results'))
+
+    def unload(self, device):
+        self.clock.sleep(self.estimate('unload'))
+
+    def set_output(self):
+        pass
+
+    def aggregate_subject(self):
+        pass
+
+    def aggregate_end(self, output_dir):
+        pass
+
+
+class DryRun(object):
+    """Executes an experiment on simulated devices with a virtual clock and estimates its wall-clock time.
+
+    The experiment, its progress and the waits run like they do on real devices, only the adb backend is simulated.
+    Scripts and profilers are not executed, every hook takes its mean duration in the logs of earlier experiments.
+    """
+
+    def __init__(self, config_file, progress_file=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.config_file = config_file
+        self.config = load_json(config_file)
+        self.progress_file = progress_file
+        self.clock = Simulator.Clock()
+        self.history = HookHistory.from_output_dir(op.join(op.dirname(config_file), 'output'))
+        self.schedule = []
+        self.estimates = []
+        self.scripts = None
+        self.profilers = None
+
+    def setup_devices(self):
+        """Returns the simulated adb client with a device for every device of the configuration.
+
+        The devices have the packages installed that the experiment requires to be installed already.
+        """
+        client = Simulator.SimulatedAdbClient(self.clock)
+        packages = list(self.config.get('apps', [])) + Profilers(self.config.get('profilers', {})).dependencies()
+        if self.config.get('type') == 'web':
+            packages += [BrowserFactory.get_browser(name)(self.config).package_name
+                         for name in self.config.get('browsers', ['chrome'])]
+        devices_spec = load_json(self.config.get('devices_spec') or op.join(paths.ROOT_DIR, 'devices.json'))
+        for name in self.config.get('devices', {}):
+            if devices_spec.get(name):
+                client.add_device(devices_spec[name], packages)
+        return client
+
+    def load_progress(self):
+        """Returns a copy of the progress to continue in the output directory, the progress file is not changed"""
+        if self.progress_file is None:
+            return None
+        progress_file = op.join(paths.OUTPUT_DIR, 'progress.xml')
+        shutil.copy(self.progress_file, progress_file)
+        journal_file = op.splitext(self.progress_file)[0] + '.journal.jsonl'
+        if op.isfile(journal_file):
+            shutil.copy(journal_file, op.splitext(progress_file)[0] + '.journal.jsonl')
+        return Progress(progress_file=progress_file, config_file=self.config_file, load_progress=True)
+
+    def run(self):
+        """Executes the remaining runs one after another, paths.OUTPUT_DIR must be a scratch directory"""
+        if self.config.get('type') not in ('native', 'web'):
+            raise ConfigError('A dry run needs a native or web experiment')
+        Adb.inject_client(self.setup_devices())
+        clock, Waits.clock = Waits.clock, self.clock
+        try:
+            experiment = ExperimentFactory.from_json(self.config_file, self.load_progress(),
+                                                     overrides={'adb_backend': 'simulated', 'parallel_devices': False})
+            self.scripts = experiment.scripts = EstimatedScripts(experiment.scripts, self.history, self.clock)
+            self.profilers = experiment.profilers = EstimatedProfilers(experiment.profilers, self.history,
+                                                                       self.clock)
+            self.schedule = experiment.progress.get_schedule()
+            run_experiment = experiment.run_experiment
+
+            def timed_run_experiment(current_run):
+                start = self.clock.time()
+                run_experiment(current_run)
+                self.estimates.append(RunEstimate(current_run, start, self.clock.time() - start))
+
+            experiment.run_experiment = timed_run_experiment
+            experiment.start()
+        finally:
+            Waits.clock = clock
+            Adb.inject_client(None)
+        return self.estimates
+
+    def device_durations(self):
+        """Returns the estimated seconds of the runs of every device"""
+        durations = OrderedDict()
+        for estimate in self.estimates:
+            durations[estimate.run['device']] = durations.get(estimate.run['device'], 0.0) + estimate.duration
+        return durations
+
+    def total_duration(self):
+        """Returns the estimated seconds of the experiment, the devices run at the same time with parallel_devices"""
+        if not self.config.get('parallel_devices', False) or not self.estimates:
+            return self.clock.time()
+        runs = sum(estimate.duration for estimate in self.estimates)
+        # Setup before the first run and cleanup after the last run are not part of the runs of a device
+        return self.clock.time() - runs + max(self.device_durations().values())
+
+    def report(self):
+        """Returns the schedule with the estimate of every run, followed by the estimated duration of the experiment"""
+        lines = ['%6s %-16s %-10s %5s %10s %10s  %s' % ('run', 'device', 'browser', 'count', 'start', 'duration',
+                                                        'subject')]
+        for estimate in self.estimates:
+            run = estimate.run
+            lines.append('%6s %-16s %-10s %5s %10s %10s  %s' % (run['runId'], run['device'], run.get('browser', '-'),
+                                                                run['runCount'], format_duration(estimate.start),
+                                                                format_duration(estimate.duration), run['path']))
+        lines.append('')
+        lines.append('Schedule: %d runs, %d subject setups, %d device changes' % Scheduler.setup_overhead(self.schedule))
+        for device, duration in self.device_durations().items():
+            lines.append('%s: %s' % (device, format_duration(duration)))
+        lines.append('Estimated duration%s: %s' % (' (parallel devices)' if self.config.get('parallel_devices') else '',
+                                                   format_duration(self.total_duration())))
+        lines.append('Hook durations from %d earlier experiment logs' % self.history.log_count)
+        if self.scripts is not None and self.scripts.unknown:
+            lines.append('Scripts without earlier durations, estimated by their timeout if they have one: %s' %
+                         ', '.join(sorted(self.scripts.unknown)))
+        if self.profilers is not None and self.profilers.unknown:
+            lines.append('Profiler hooks without earlier durations, estimated to take no time: %s' %
+                         ', '.join(sorted(self.profilers.unknown)))
+        return '\n'.join(lines)
+
+
+def format_duration(seconds):
+    """Formats seconds as H:MM:SS.s"""
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return '%d:%02d:%04.1f' % (hours, minutes, seconds)
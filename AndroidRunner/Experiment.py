@@ -1,37 +1,50 @@
 import logging
+import multiprocessing as mp
 import os.path as op
-import time
-from os import remove, rmdir, walk
-from threading import Thread
+import signal
+import traceback
+from collections import OrderedDict
+from queue import Empty
 
-from . import Tests
+from . import Manifest, Scheduler, Tests, Timing, Waits
 import paths
 from .Devices import Devices
 from .Profilers import Profilers
 from .Scripts import Scripts
-from .util import ConfigError, makedirs, slugify_dir
+from .util import ConfigError, makedirs, slugify_dir, write_to_file
+
+
+class ExperimentError(Exception):
+    """Raised when the runs of a device failed in a parallel experiment"""
+    pass
 
 
 # noinspection PyUnusedLocal
 class Experiment(object):
+    # Seconds a worker gets to stop by itself, and to roll back after SIGTERM
+    WORKER_STOP_TIMEOUT = 10
+
     def __init__(self, config, progress, restart):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.progress = progress
         self.basedir = None
-        self.random = config.get('randomization', False)
+        self.random = Tests.is_boolean(config.get('randomization', False))
         if 'devices' not in config:
             raise ConfigError('"device" is required in the configuration')
         adb_path = config.get('adb_path', 'adb')
-        self.devices = Devices(config['devices'], adb_path=adb_path, devices_spec=config.get('devices_spec'))
+        self.devices = Devices(config['devices'], adb_path=adb_path, devices_spec=config.get('devices_spec'),
+                               adb_backend=config.get('adb_backend', 'adb'))
         self.replications = Tests.is_integer(config.get('replications', 1))
         self.paths = config.get('paths', [])
         self.profilers = Profilers(config.get('profilers', {}))
         monkeyrunner_path = config.get('monkeyrunner_path', 'monkeyrunner')
         self.scripts = Scripts(config.get('scripts', {}), monkeyrunner_path=monkeyrunner_path)
         self.time_between_run = Tests.is_integer(config.get('time_between_run', 0))
+        self.parallel_devices = config.get('parallel_devices', False)
         Tests.check_dependencies(self.devices, self.profilers.dependencies())
         self.output_root = paths.OUTPUT_DIR
-        self.result_file_structure = None
+        # Id of the run that is executed, until it is journaled
+        self.unsaved_run = None
         if restart:
             for device in self.devices:
                 self.prepare_device(device, restart=True)
@@ -39,9 +52,18 @@ class Experiment(object):
     def prepare_device(self, device, restart=False):
         """Prepare the device for experiment"""
         self.logger.info('Device: %s' % device)
+        self.write_device_info(device)
         self.profilers.load(device)
         device.unplug(restart)
 
+    def write_device_info(self, device):
+        """Logs the properties of the device and writes them next to the results"""
+        info = device.get_info()
+        self.logger.info('%s: %s' % (device.name, info))
+        row = OrderedDict([('device', device.name), ('id', device.id)])
+        row.update(info.to_dict())
+        write_to_file(op.join(self.output_root, 'device_info_%s.csv' % device.name), [row])
+
     def cleanup(self, device):
         """Cleans up the changes on the devices"""
         device.plug()
@@ -51,21 +73,18 @@ class Experiment(object):
     def get_progress_xml_file(self):
         return self.progress.progress_xml_file
 
-    def update_progress(self):
-        self.progress.write_progress_to_file()
-        result_data_path = op.join(paths.BASE_OUTPUT_DIR, 'data')
-        self.result_file_structure = self.walk_to_list(walk(result_data_path))
-
     def start(self):
         try:
-            result_data_path = op.join(paths.BASE_OUTPUT_DIR, 'data')
-            self.result_file_structure = self.walk_to_list(walk(result_data_path))
+            self.report_schedule()
+            if self.parallel_devices:
+                self.run_devices_parallel()
             while not self.progress.experiment_finished_check():
                 current_run = self.get_experiment()
+                self.unsaved_run = current_run['runId']
                 self.run_experiment(current_run)
-                self.save_progress()
+                self.save_progress(current_run['runId'], self.collect_result_files())
+                self.unsaved_run = None
         except Exception as e:
-            import traceback
             print((traceback.format_exc()))
             self.logger.error('%s: %s' % (e.__class__.__name__, str(e)))
             self.finish_experiment(True, False)
@@ -76,23 +95,156 @@ class Experiment(object):
         else:
             self.finish_experiment(False, False)
 
+    def report_schedule(self):
+        """Logs the setup steps caused by the order of the remaining runs"""
+        overhead = Scheduler.setup_overhead(self.progress.get_schedule())
+        if self.parallel_devices:
+            # Every device works through its own runs, the devices don't wait for each other
+            self.logger.info('Schedule: %d runs, %d subject setups' % overhead[:2])
+        else:
+            self.logger.info('Schedule: %d runs, %d subject setups, %d device changes' % overhead)
+
+    def run_devices_parallel(self):
+        """Runs the queue of every device in its own worker process, the progress is kept by this process"""
+        # Processes instead of threads: scripts rely on SIGALRM and the output directory is a global of paths.
+        # Fork is requested explicitly, the workers inherit the experiment instead of pickling it.
+        context = mp.get_context('fork')
+        queue = context.Queue()
+        stop = context.Event()
+        workers = {}
+        for device in self.progress.get_devices_to_run():
+            workers[device] = context.Process(target=self.device_worker, args=(queue, device, stop))
+            workers[device].start()
+        try:
+            while workers:
+                message = self.get_worker_message(queue, workers)
+                if message[0] == 'run':
+                    self.worker_run_finished(message)
+                elif message[0] == 'done':
+                    Timing.summary.merge(message[2])
+                    workers.pop(message[1]).join()
+                else:
+                    raise ExperimentError('%s: %s' % (message[1], message[2]))
+        finally:
+            if workers:
+                self.stop_workers(queue, workers, stop)
+
+    def worker_run_finished(self, message):
+        self.progress.run_finished(message[2])
+        self.save_progress(message[2], message[3])
+
+    def stop_workers(self, queue, workers, stop):
+        """Stops the remaining workers, the run a worker is still executing is rolled back by that worker"""
+        stop.set()
+        for worker in workers.values():
+            worker.join(self.WORKER_STOP_TIMEOUT)
+        for worker in workers.values():
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers.values():
+            worker.join(self.WORKER_STOP_TIMEOUT)
+            if worker.is_alive():
+                self.logger.error('Worker %s did not stop, killing it without a rollback' % worker.pid)
+                worker.kill()
+                worker.join()
+        # Runs the workers finished before stopping are kept
+        while True:
+            try:
+                message = queue.get_nowait()
+            except Empty:
+                break
+            if message[0] == 'run':
+                self.worker_run_finished(message)
+
+    @staticmethod
+    def get_worker_message(queue, workers):
+        """Waits for the next message of the workers, fails when a worker died without reporting"""
+        while True:
+            try:
+                return queue.get(timeout=1)
+            except Empty:
+                for device, worker in list(workers.items()):
+                    if not worker.is_alive() and queue.empty():
+                        raise ExperimentError('%s: Worker stopped unexpectedly (exit code %s)' %
+                                              (device, worker.exitcode))
+
+    def device_worker(self, queue, device, stop):
+        """Executes the remaining runs of one device and reports every finished run to the parent process.
+
+        The worker keeps its own copy of the progress, so the per-device hooks see the runs of their device only.
+        The worker stops after the current run when stop is set, and rolls back the current run on SIGTERM.
+        """
+        # The parent adds the timings of the runs of this worker to its summary
+        Timing.summary = Timing.Summary()
+        sigterm_handler = signal.signal(signal.SIGTERM, self.interrupt_worker)
+        try:
+            while not self.progress.device_finished(device) and not stop.is_set():
+                current_run = self.get_experiment(device)
+                self.run_experiment(current_run)
+                queue.put(('run', device, current_run['runId'], self.collect_result_files()))
+            queue.put(('done', device, Timing.summary))
+        except Exception as e:
+            Manifest.rollback_run()
+            queue.put(('error', device, '%s: %s\n%s' % (e.__class__.__name__, str(e), traceback.format_exc())))
+        except KeyboardInterrupt:
+            Manifest.rollback_run()
+        finally:
+            signal.signal(signal.SIGTERM, sigterm_handler)
+
+    @staticmethod
+    def interrupt_worker(signum, frame):
+        """Turns the SIGTERM of the parent into a KeyboardInterrupt, so the worker rolls back its current run"""
+        raise KeyboardInterrupt
+
     def finish_experiment(self, error, interrupted):
-        self.check_result_files(self.result_file_structure)
+        # The results of a run that did not complete are removed, so it has to be executed again
+        self.progress.write_progress_to_file(unfinished=[self.unsaved_run] if self.unsaved_run is not None else [])
+        Manifest.rollback_run()
+        self.write_timing_summary()
         for device in self.devices:
             try:
                 self.cleanup(device)
+                device.close_shell_session()
             except Exception:
                 continue
         if not error and not interrupted:
             self.aggregate_end()
 
     def run_experiment(self, current_run):
-        self.prepare_run(current_run)
-        self.run_run(current_run)
-        self.finish_run(current_run)
+        Timing.start_run()
+        with Timing.measure('prepare_run'):
+            self.prepare_run(current_run)
+        with Timing.measure('run'):
+            self.run_run(current_run)
+        with Timing.measure('finish_run'):
+            self.finish_run(current_run)
+        self.write_timings(current_run, Timing.end_run())
+
+    @staticmethod
+    def write_timings(current_run, timings):
+        """Writes the duration of every phase of the run next to its results"""
+        if not timings.phases:
+            return
+        timing_dir = op.join(paths.OUTPUT_DIR, 'timing')
+        makedirs(timing_dir)
+        write_to_file(op.join(timing_dir, 'run%s.csv' % current_run['runCount']),
+                      [phase.to_dict() for phase in timings.phases])
+
+    def write_timing_summary(self):
+        """Writes the durations of the phases over the runs of this session and logs those of a run"""
+        rows = Timing.summary.to_rows()
+        if not rows:
+            return
+        write_to_file(op.join(self.output_root, 'timing_summary.csv'), rows)
+        self.logger.info('Mean duration of %d runs: %s' % (
+            rows[0]['runs'], ', '.join('%s %.3fs' % (row['phase'], float(row['mean'])) for row in rows
+                                       if row['phase'] in ('prepare_run', 'run', 'finish_run'))))
 
     def prepare_run(self, current_run):
+        Manifest.start_run()
         self.prepare_output_dir(current_run)
+        # Scripts and third party profilers write their results without registering them
+        Manifest.watch(paths.OUTPUT_DIR)
         self.first_run_device(current_run)
         self.before_every_run_subject(current_run)
 
@@ -109,38 +261,20 @@ class Experiment(object):
         self.last_run_subject(current_run)
         self.last_run_device(current_run)
 
-    def save_progress(self):
-        a = Thread(target=self.update_progress)
-        a.start()
-        a.join()
-
-    def check_result_files(self, correct_file_list):
-        result_data_path = op.join(paths.BASE_OUTPUT_DIR, 'data')
-        current_file_structure = walk(result_data_path)
-        current_file_list = self.walk_to_list(current_file_structure)
-        for path in current_file_list:
-            if path not in correct_file_list:
-                if op.isfile(path):
-                    remove(path)
-                else:
-                    rmdir(path)
+    def save_progress(self, run_id, files):
+        """Journals the finished run and the files it produced, the progress file is rewritten periodically"""
+        self.progress.journal_run(run_id, files)
 
     @staticmethod
-    def walk_to_list(walk_result):
-        walk_list = list()
-        for (path, dirs, files) in walk_result:
-            for dr in dirs:
-                walk_list.append(op.join(path, dr))
-            for fl in files:
-                walk_list.append(op.join(path, fl))
-        walk_list.reverse()
-        return walk_list
-
-    def get_experiment(self):
+    def collect_result_files():
+        """Returns the files and directories registered in the manifest of the last run"""
+        return Manifest.end_run().paths
+
+    def get_experiment(self, device=None):
         if self.random:
-            return self.progress.get_random_run()
+            return self.progress.get_random_run(device)
         else:
-            return self.progress.get_next_run()
+            return self.progress.get_next_run(device)
 
     def first_run_device(self, current_run):
         device = self.devices.get_device(current_run['device'])
@@ -166,11 +300,16 @@ class Experiment(object):
         makedirs(paths.OUTPUT_DIR)
 
     def run(self, device, path, run, dummy):
-        self.before_run(device, path, run)
-        self.start_profiling(device, path, run)
-        self.interaction(device, path, run)
-        self.stop_profiling(device, path, run)
-        self.after_run(device, path, run)
+        self.run_hook('before_run', device, path, run)
+        self.run_hook('start_profiling', device, path, run)
+        self.run_hook('interaction', device, path, run)
+        self.run_hook('stop_profiling', device, path, run)
+        self.run_hook('after_run', device, path, run)
+
+    def run_hook(self, hook, *args):
+        """Executes the hook of the experiment, timing it as a phase of the run"""
+        with Timing.measure(hook):
+            getattr(self, hook)(*args)
 
     def before_experiment(self, device, *args, **kwargs):
         """Hook executed before the first run of a device in current experiment"""
@@ -208,8 +347,7 @@ class Experiment(object):
         """Hook executed after a run"""
         self.scripts.run('after_run', device, *args, **kwargs)
         self.profilers.collect_results(device)
-        self.logger.debug('Sleeping for %s milliseconds' % self.time_between_run)
-        time.sleep(self.time_between_run / 1000.0)
+        Waits.sleep(self.time_between_run / 1000.0, '%s: time between runs' % device.id)
 
     def after_last_run(self, device, path, *args, **kwargs):
         """Hook executed after the last run of a subject"""
@@ -18,11 +18,12 @@ class ExperimentFactory(object):
         pass
 
     @staticmethod
-    def from_json(path, progress):
-        """Returns an Experiment object from a JSON configuration"""
+    def from_json(path, progress, overrides=None):
+        """Returns an Experiment object from a JSON configuration, overrides replace settings of the configuration"""
         logger.info(path)
         shutil.copy(path, op.join(paths.OUTPUT_DIR, 'config.json'))
         config = util.load_json(path)
+        config.update(overrides or {})
         experiment_type = config['type']
         if experiment_type == 'plugintest':
             return PluginTests(config)
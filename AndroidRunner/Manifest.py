@@ -0,0 +1,127 @@
+import logging
+import os
+import os.path as op
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def walk(directory):
+    """Returns the files and directories in directory, a directory comes before its content"""
+    paths = []
+    for root, directories, files in os.walk(directory):
+        paths.extend(op.join(root, name) for name in directories + files)
+    return paths
+
+
+def remove(path):
+    try:
+        if op.isdir(path) and not op.islink(path):
+            os.rmdir(path)
+        elif op.lexists(path):
+            os.remove(path)
+    except OSError as e:
+        logger.warning('Could not remove "%s" of the unfinished run: %s' % (path, e))
+
+
+class Manifest(object):
+    """The files and directories created by one run, in order of creation"""
+
+    # Seconds a modification time can lag behind time.time(), the file system clock is coarser
+    MTIME_TOLERANCE = 0.1
+
+    def __init__(self):
+        self.paths = []
+        self.registered = set()
+        # The paths in the output directories of the run when it started
+        self.watched = {}
+        self.started = time.time()
+
+    def add(self, path):
+        path = op.normpath(path)
+        if path not in self.registered:
+            self.registered.add(path)
+            self.paths.append(path)
+
+    def watch(self, directory, existing=None):
+        """Also removes the paths that are not registered but created in directory by the run on rollback
+
+        existing are the paths in directory before the run, the directory is walked when they are not given.
+        """
+        directory = op.normpath(directory)
+        if directory not in self.watched:
+            self.watched[directory] = set(walk(directory)) if existing is None else existing
+
+    def unregistered(self):
+        """Returns the paths created in the watched directories that are not registered, e.g. by a user script"""
+        paths = []
+        for directory, existing in self.watched.items():
+            paths.extend(path for path in walk(directory)
+                          if path not in existing and path not in self.registered and self.created(path))
+        return paths
+
+    def created(self, path):
+        """Tells if path was created or modified by the run, paths of earlier runs can be missing in a snapshot"""
+        try:
+            return op.getmtime(path) >= self.started - self.MTIME_TOLERANCE
+        except OSError:
+            return False
+
+    def rollback(self):
+        """Removes the created paths, a directory is only removed when the run left nothing else in it"""
+        for path in reversed(self.unregistered()):
+            remove(path)
+        for path in reversed(self.paths):
+            remove(path)
+        self.paths = []
+        self.registered = set()
+        self.watched = {}
+
+
+# Manifest of the run that is executed by this process, None between runs
+current = None
+# The paths in every watched directory, walked once and extended with the registered paths of the finished runs
+snapshots = {}
+
+
+def start_run():
+    global current
+    current = Manifest()
+    return current
+
+
+def detach_run():
+    global current
+    manifest, current = current, None
+    return manifest if manifest is not None else Manifest()
+
+
+def end_run():
+    """Returns the manifest of the finished run, the paths created after it are not registered anymore"""
+    manifest = detach_run()
+    for directory, existing in manifest.watched.items():
+        existing.update(path for path in manifest.paths if path.startswith(directory + os.sep))
+    return manifest
+
+
+def rollback_run():
+    """Removes the paths created by the run that did not finish, if there is one"""
+    manifest = detach_run()
+    if manifest.paths or manifest.watched:
+        logger.info('Removing the results of the unfinished run')
+    manifest.rollback()
+
+
+def watch(directory):
+    """Removes everything the current run creates in directory if the run does not finish"""
+    if current is not None:
+        directory = op.normpath(directory)
+        if directory not in snapshots:
+            snapshots[directory] = set(walk(directory))
+        current.watch(directory, snapshots[directory])
+
+
+def register(path):
+    """Adds a file or directory created by a profiler or script to the manifest of the current run"""
+    if current is not None:
+        current.add(path)
@@ -1,21 +1,72 @@
 import os.path as op
-import time
+from concurrent.futures import ThreadPoolExecutor
 
-from . import Tests
+from . import Tests, Waits
 from .Experiment import Experiment
-from .util import ConfigError
+from .util import ConfigError, file_md5
 
 
 class NativeExperiment(Experiment):
     def __init__(self, config, progress, restart):
         self.package = None
         self.duration = Tests.is_integer(config.get('duration', 0)) / 1000
+        self.preinstall_apks = config.get('preinstall_apks', False)
+        # MD5 hashes of the APK files by path, hashed on first use
+        self.apk_hashes = {}
         super(NativeExperiment, self).__init__(config, progress, restart)
         self.pre_installed_apps = config.get('apps', [])
         for apk in config.get('paths', []):
             if not op.isfile(apk):
                 raise ConfigError('File %s not found' % apk)
 
+    def start(self):
+        if self.preinstall_apks:
+            self.install_apks()
+        super(NativeExperiment, self).start()
+
+    def install_apks(self):
+        """Installs the APKs of the remaining runs on all devices in parallel, one installation at a time per device"""
+        apks = {}
+        for device_name in self.progress.get_devices_to_run():
+            device_apks = []
+            for run in self.progress.get_runs_to_run(device_name):
+                path = run['path']
+                if path in self.paths and path not in device_apks:
+                    device_apks.append(path)
+            apks[device_name] = device_apks
+        hashes = {}
+        for device_apks in apks.values():
+            for apk in device_apks:
+                hashes[apk] = self.get_apk_hash(apk)
+        if not hashes:
+            return
+        # Every device has its own adb handle, installations on different devices don't block each other
+        with ThreadPoolExecutor(max_workers=len(apks)) as executor:
+            futures = [executor.submit(self.install_device_apks, self.devices.get_device(name), device_apks, hashes)
+                       for name, device_apks in apks.items()]
+            for future in futures:
+                future.result()
+
+    def install_device_apks(self, device, apks, hashes):
+        """Installs the APKs on the device, skipping packages that are installed from an identical APK"""
+        for apk in apks:
+            self.install_apk(device, apk, hashes[apk])
+
+    def install_apk(self, device, apk, md5):
+        """Installs the APK on the device, unless its package is installed from an identical APK"""
+        package = op.splitext(op.basename(apk))[0]
+        # Identical content implies the same version and signature
+        if package in device.get_app_list() and device.get_apk_hash(package) == md5:
+            self.logger.info('%s: %s is already installed' % (device.name, package))
+            return
+        self.logger.info('%s: Installing %s' % (device.name, op.basename(apk)))
+        device.install(apk)
+
+    def get_apk_hash(self, apk):
+        if apk not in self.apk_hashes:
+            self.apk_hashes[apk] = file_md5(apk)
+        return self.apk_hashes[apk]
+
     def cleanup(self, device):
         super(NativeExperiment, self).cleanup(device)
         if self.package in device.get_app_list() and self.package not in self.pre_installed_apps:
@@ -31,24 +82,23 @@ class NativeExperiment(Experiment):
         else:
             filename = op.basename(path)
             self.logger.info('APK: %s' % filename)
-            if filename not in device.get_app_list():
-                device.install(path)
-            self.package = op.splitext(op.basename(path))[0]
+            self.package = op.splitext(filename)[0]
+            self.install_apk(device, path, self.get_apk_hash(path))
 
     def before_run(self, device, path, run, *args, **kwargs):
         super(NativeExperiment, self).before_run(device, path, run)
         device.launch_package(self.package)
-        time.sleep(1)
+        Waits.activity_focused(device, self.package)
         self.after_launch(device, path, run)
 
     def start_profiling(self, device, path, run, *args, **kwargs):
         self.profilers.start_profiling(device, app=self.package)
-        time.sleep(self.duration)
+        Waits.sleep(self.duration, '%s: duration' % device.id)
 
     def after_run(self, device, path, run, *args, **kwargs):
         self.before_close(device, path, run)
         device.force_stop(self.package)
-        time.sleep(3)
+        Waits.process_gone(device, self.package)
         super(NativeExperiment, self).after_run(device, path, run)
 
     def after_last_run(self, device, path, *args, **kwargs):
@@ -1,23 +1,125 @@
 import csv
+import io
 import os
 import os.path as op
+import math
 import threading
 import time
-import timeit
+from array import array
 from collections import OrderedDict
-from functools import reduce
 
-from AndroidRunner import util
+from AndroidRunner import util, Manifest, Waits
 from AndroidRunner import Tests
+from AndroidRunner.util import ConfigError
+from .AndroidDataPoints import DATA_POINTS
 from .Profiler import Profiler
 
+# Samples /proc every $1 centiseconds into the file $2 until $2.stop exists, $3 is the package of the app or empty.
+# The deadlines are multiples of the interval on the uptime clock, only sleep is not a shell builtin.
+SAMPLER_SCRIPT = '''interval=$1
+out=$2
+pid=
+[ -n "$3" ] && pid=$(pidof $3)
+pid=${pid%% *}
+read start idle < /proc/uptime
+echo "start $(date +%s) $start $(getconf PAGESIZE 2>/dev/null || echo 4096) $pid" > $out
+deadline=${start%.*}${start#*.}
+while [ ! -e $out.stop ]; do
+  read up idle < /proc/uptime
+  read cpu < /proc/stat
+  total=
+  available=
+  while read key value unit; do
+    case $key in
+      MemTotal:) total=$value;;
+      MemAvailable:) available=$value; break;;
+    esac
+  done < /proc/meminfo
+  stat=
+  [ -n "$pid" ] && read stat < /proc/$pid/stat
+  echo "$deadline $up|$total $available|$cpu|$stat" >> $out
+  read now idle < /proc/uptime
+  now=${now%.*}${now#*.}
+  deadline=$((deadline + interval))
+  while [ $deadline -le $now ]; do deadline=$((deadline + interval)); done
+  wait=$((deadline - now))
+  cs=$((wait % 100))
+  [ $cs -lt 10 ] && cs=0$cs
+  sleep $((wait / 100)).$cs
+done
+read up idle < /proc/uptime
+echo "stop $up" >> $out
+rm -f $out.stop
+'''
+
+
+class SampleBuffer(object):
+    """The samples of a run in typed columns: milliseconds since the epoch and a float per data column.
+
+    Values are parsed when they are added, a value that is missing or not a number is NaN and written as empty.
+    """
+
+    def __init__(self, columns=()):
+        self.initial_columns = list(columns)
+        self.timestamps = array('q')
+        self.columns = OrderedDict((column, array('d')) for column in self.initial_columns)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def clear(self):
+        """Removes the samples and the columns that were found during the run"""
+        self.__init__(self.initial_columns)
+
+    def append(self, timestamp, values):
+        """Adds a sample of the OrderedDict of column to value, columns that were not seen before are added"""
+        for column in values:
+            if column not in self.columns:
+                self.columns[column] = array('d', [math.nan]) * len(self)
+        self.timestamps.append(int(timestamp))
+        for column, data in self.columns.items():
+            data.append(to_float(values.get(column)))
+
+    def header(self):
+        return ['datetime'] + list(self.columns)
+
+    def rows(self):
+        """Yields the samples as rows of strings"""
+        for i, timestamp in enumerate(self.timestamps):
+            yield [format_timestamp(timestamp)] + [format_value(data[i]) for data in self.columns.values()]
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def format_value(value):
+    if math.isnan(value):
+        return ''
+    return '%d' % value if value.is_integer() else repr(value)
+
+
+def format_timestamp(milliseconds):
+    """Returns the UTC time of milliseconds since the epoch, with milliseconds"""
+    seconds, milliseconds = divmod(int(milliseconds), 1000)
+    return '%s.%03dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)), milliseconds)
+
+
 class Android(Profiler):
+    # Seconds stop_profiling waits for a sample that is being taken
+    STOP_TIMEOUT = 30
+    SAMPLER_PATH = '/data/local/tmp/android_runner_sampler.sh'
+    SAMPLES_PATH = '/data/local/tmp/android_runner_samples.txt'
+
     def __init__(self, config, paths):
         super(Android, self).__init__(config, paths)
         self.output_dir = ''
         self.paths = paths
         self.profile = False
-        available_data_points = ['cpu', 'mem']
+        available_data_points = list(DATA_POINTS)
         self.interval = float(Tests.is_integer(
             config.get('sample_interval', 0))
         ) / 1000
@@ -29,80 +131,220 @@ class Android(Profiler):
                 'Invalid data points in config: {}'.format(invalid_data_points))
         self.data_points = [dp for dp in config['data_points']
                             if dp in set(available_data_points)]
-        self.data = [['datetime'] + self.data_points]
-
-    @staticmethod
-    def get_cpu_usage(device):
-        """Get CPU usage in percentage"""
-        # return device.shell('dumpsys cpuinfo | grep TOTAL | cut -d" " -f1').strip()[:-1]
-        shell_result = device.shell('dumpsys cpuinfo | grep TOTAL')
-        shell_splitted = shell_result.split('%')[0]
-        if '.-' in shell_splitted:
-            shell_splitted = shell_splitted.replace('.-', '.')
-        return shell_splitted
-        # return device.shell('dumpsys cpuinfo | grep TOTAL').split('%')[0]
-
-    @staticmethod
-    def get_mem_usage(device, app):
-        """Get memory usage in KB for app, if app is None system usage is used"""
-        if not app:
-            # return device.shell('dumpsys meminfo | grep Used | cut -d" " -f5').strip()[1:-1]
-            # return device.shell('dumpsys meminfo | grep Used').split()[2].strip()[1:-1].replace(",", ".")
-            # https://stackoverflow.com/questions/23175809/str-translate-gives-typeerror-translate-takes-one-argument-2-given-worked-i
-            return device.shell('dumpsys meminfo | grep Used').translate(str.maketrans('', '', '(kB,K')).split()[2]
-        else:
-            result = device.shell(
-                'dumpsys meminfo {} | grep TOTAL'.format(app))
-            if result == '':
-                result = device.shell('dumpsys meminfo {}'.format(app))
-                if 'No process found' in result:
-                    raise Exception('Android Profiler: {}'.format(result))
-            return ' '.join(result.strip().split()).split()[1]
+        self.points = [DATA_POINTS[dp](dp) for dp in self.data_points]
+        self.data = SampleBuffer(column for point in self.points for column in point.columns)
+        self.sampling = config.get('sampling', 'host')
+        if self.sampling not in ('host', 'device'):
+            raise ConfigError('Android profiler: sampling must be "host" or "device", not "%s"' % self.sampling)
+        if self.sampling == 'device' and set(self.data_points) - {'cpu', 'mem'}:
+            raise ConfigError('Android profiler: sampling on the device supports the data points cpu and mem')
+        cost = sum(point.cost for point in self.points)
+        if self.sampling == 'host' and self.interval and cost > self.interval * 1000:
+            self.logger.warning('The data points take about %dms per sample on the device, the sample_interval is '
+                                '%dms' % (cost, self.interval * 1000))
+        self.app = None
+        # Seconds the device clock is ahead of the host clock and its uncertainty, measured at the start of a run
+        self.clock_offset = None
+        self.clock_uncertainty = None
+        # Seconds the uptime of the device is ahead of the host clock, the clock of the device sampler
+        self.uptime_offset = None
+        # Host time and monotonic clock at the start of a run, samples are timestamped with the monotonic clock
+        self.wall_start = None
+        self.monotonic_start = None
+        self.sampler = None
+        self.stopped = threading.Event()
+        # Seconds every sample of the run started after its deadline and the number of deadlines that were skipped
+        self.lateness = []
+        self.missed = 0
+        self.sampling_duration = 0.0
 
     def start_profiling(self, device, **kwargs):
         self.profile = True
         app = kwargs.get('app', None)
-        self.get_data(device, app)
+        self.lateness = []
+        self.missed = 0
+        self.data.clear()
+        self.clock_offset = self.clock_uncertainty = self.uptime_offset = None
+        self.clock_offset, self.clock_uncertainty = device.clock_offset()
+        self.logger.debug('%s: clock is %.3fs (+/- %.3fs) ahead of the host' % (device.id, self.clock_offset,
+                                                                               self.clock_uncertainty))
+        if self.sampling == 'device':
+            self.app = app
+            # The sampler times the samples with the uptime, which is converted to the device clock via the host
+            self.uptime_offset, uptime_uncertainty = device.uptime_offset()
+            self.clock_uncertainty += uptime_uncertainty
+            device.shell_batch(['rm -f %s %s.stop' % (self.SAMPLES_PATH, self.SAMPLES_PATH),
+                                'nohup sh %s %d %s %s >/dev/null 2>&1 &' % (
+                                    self.SAMPLER_PATH, self.device_interval(), self.SAMPLES_PATH, app or '')])
+            return
+        for point in self.points:
+            point.reset()
+        self.wall_start, self.monotonic_start = time.time(), time.monotonic()
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self.get_data, args=(device, app), name='Android-%s' % device.id)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def sample(self, device, app):
+        """Adds a sample of the data points, read in a single shell invocation, at the device time halfway the call"""
+        points = [point for point in self.points if app or not point.per_app]
+        sent = time.monotonic()
+        outputs = device.shell_batch([point.command(app) for point in points]) if points else []
+        received = time.monotonic()
+        values = OrderedDict()
+        for point, output in zip(points, outputs):
+            values.update(point.parse(output, app))
+        self.data.append(self.device_time((sent + received) / 2), values)
+
+    def device_time(self, monotonic):
+        """Returns the milliseconds since the epoch on the device clock at the time of the host monotonic clock"""
+        return round((self.wall_start + monotonic - self.monotonic_start + self.clock_offset) * 1000)
 
     def get_data(self, device, app):
-        """Runs the profiling methods every self.interval seconds in a separate thread"""
-        start = timeit.default_timer()
-        device_time = device.shell('date -u')
-        row = [device_time]
-        if 'cpu' in self.data_points:
-            row.append(self.get_cpu_usage(device))
-        if 'mem' in self.data_points:
-            row.append(self.get_mem_usage(device, app))
-        self.data.append(row)
-        end = timeit.default_timer()
-        # timer results could be negative
-        interval = max(float(0), self.interval - max(0, int(end - start)))
-        if self.profile:
-            threading.Timer(interval, self.get_data,
-                            args=(device, app)).start()
+        """Samples every self.interval seconds until profiling stops.
+
+        The deadlines are fixed multiples of the interval after the start on the monotonic clock, so the time a
+        sample takes does not delay the next one. Deadlines that passed while a sample was taken are skipped and
+        counted as missed.
+        """
+        start = time.monotonic()
+        deadline = start
+        while self.profile:
+            self.lateness.append(time.monotonic() - deadline)
+            self.sample(device, app)
+            now = time.monotonic()
+            if self.interval > 0:
+                deadline += self.interval
+                if now > deadline:
+                    skipped = int((now - deadline) / self.interval) + 1
+                    self.missed += skipped
+                    deadline += skipped * self.interval
+            else:
+                deadline = now
+            if self.stopped.wait(max(0.0, deadline - now)):
+                break
+        self.sampling_duration = time.monotonic() - start
 
     def stop_profiling(self, device, **kwargs):
         self.profile = False
+        if self.sampling == 'device':
+            stop_file = '%s.stop' % self.SAMPLES_PATH
+            device.shell('touch %s' % stop_file)
+            # The sampler removes the stop file when it exits
+            if not Waits.until(lambda: device.file_size(stop_file) is None, '%s: sampler stopped' % device.id,
+                               timeout=self.interval + self.STOP_TIMEOUT, phase='wait.sampler_stopped'):
+                self.logger.warning('Sampling on %s did not stop within %ss' % (device.id, self.STOP_TIMEOUT))
+            return
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join(self.STOP_TIMEOUT)
+            if self.sampler.is_alive():
+                self.logger.warning('Sampling on %s did not stop within %ss' % (device.id, self.STOP_TIMEOUT))
+            self.sampler = None
+
+    def read_samples(self, lines):
+        """Adds the rows of the samples of the device sampler and records their deadlines.
+
+        The CPU usage of a sample is that since the previous sample, so the first sample only starts the count. Memory
+        is the resident size of the app, or the used memory of the system (MemTotal - MemAvailable), in KB.
+        """
+        lines = iter(lines)
+        _, epoch, start, page_size, pid = (next(lines, '').split(' ', 4) + [''] * 5)[:5]
+        if 'mem' in self.data_points and self.app and not pid.strip():
+            self.logger.warning('Android Profiler: No process found for: %s' % self.app)
+        epoch, start, page_size = float(epoch or 0), float(start or 0), int(page_size or 4096)
+        previous = None
+        end = start
+        for line in lines:
+            if line.startswith('stop '):
+                end = float(line.split()[1])
+                continue
+            timing, memory, cpu, stat = (line.rstrip('\n').split('|', 3) + [''] * 4)[:4]
+            timing, memory, cpu = timing.split(), memory.split(), [int(value) for value in cpu.split()[1:]]
+            if len(timing) != 2 or not cpu:
+                continue
+            deadline, uptime = int(timing[0]) / 100.0, float(timing[1])
+            end = max(end, uptime)
+            self.lateness.append(uptime - deadline)
+            if previous is not None:
+                self.missed += max(0, int(round((deadline - previous[0]) * 100 / self.device_interval())) - 1)
+                total = sum(cpu) - sum(previous[1])
+                # idle and iowait
+                idle = sum(cpu[3:5]) - sum(previous[1][3:5])
+                values = OrderedDict()
+                if 'cpu' in self.data_points:
+                    values['cpu'] = 100.0 * (total - idle) / total if total > 0 else 0.0
+                if 'mem' in self.data_points:
+                    if self.app:
+                        fields = stat[stat.rfind(')') + 2:].split()
+                        # Field 24 of /proc/<pid>/stat, the resident pages
+                        values['mem'] = int(fields[21]) * page_size // 1024 if len(fields) > 21 else None
+                    else:
+                        values['mem'] = int(memory[0]) - int(memory[1]) if len(memory) == 2 else None
+                self.data.append(self.uptime_to_device_time(uptime, epoch, start), values)
+            previous = (deadline, cpu)
+        self.sampling_duration = end - start
+
+    def uptime_to_device_time(self, uptime, epoch, start):
+        """Returns the milliseconds since the epoch on the device clock at an uptime of the device.
+
+        Without the offsets of the run, the whole second of date at the start of the sampler is used.
+        """
+        if self.uptime_offset is None or self.clock_offset is None:
+            return round((epoch + uptime - start) * 1000)
+        return round((uptime - self.uptime_offset + self.clock_offset) * 1000)
+
+    def device_interval(self):
+        """Returns the interval of the device sampler in centiseconds, the resolution of /proc/uptime"""
+        return max(1, int(round(self.interval * 100)))
+
+    def sampling_report(self):
+        """Returns the number of samples, the missed deadlines, the achieved rate and the jitter of the last run"""
+        samples = len(self.lateness)
+        duration = self.sampling_duration
+        return OrderedDict([('sample_interval', '%.3f' % self.interval), ('samples', samples),
+                            ('missed', self.missed), ('duration', '%.3f' % duration),
+                            ('target_rate', '%.3f' % (1 / self.interval) if self.interval > 0 else ''),
+                            ('achieved_rate', '%.3f' % (samples / duration) if duration > 0 else ''),
+                            ('mean_jitter', '%.6f' % (sum(self.lateness) / samples) if samples else ''),
+                            ('max_jitter', '%.6f' % max(self.lateness) if samples else ''),
+                            ('clock_offset', '%.6f' % self.clock_offset if self.clock_offset is not None else ''),
+                            ('clock_uncertainty', '%.6f' % self.clock_uncertainty
+                             if self.clock_uncertainty is not None else '')])
 
     def collect_results(self, device):
-        filename = '{}_{}.csv'.format(
-            device.id, time.strftime('%Y.%m.%d_%H%M%S'))
-        with open(op.join(self.output_dir, filename), 'w+') as f:
+        if self.sampling == 'device':
+            self.read_samples(util.iter_lines(device.pull_stream(self.SAMPLES_PATH)))
+            device.shell('rm -f %s' % self.SAMPLES_PATH)
+        filename = op.join(self.output_dir, '{}_{}.csv'.format(
+            device.id, time.strftime('%Y.%m.%d_%H%M%S')))
+        with open(filename, 'w+') as f:
+            Manifest.register(filename)
             writer = csv.writer(f)
-            for row in self.data:
-                writer.writerow(row)
+            writer.writerow(self.data.header())
+            writer.writerows(self.data.rows())
+        # In a subdirectory, the subject aggregation averages every file of the output directory
+        report = self.sampling_report()
+        if report['missed']:
+            self.logger.warning('%s missed %d sample deadlines' % (device.id, report['missed']))
+        sampling_dir = op.join(self.output_dir, 'sampling')
+        util.makedirs(sampling_dir)
+        util.write_to_file(op.join(sampling_dir, op.basename(filename)), [report])
 
     def set_output(self, output_dir):
         self.output_dir = output_dir
+        self.data.clear()
 
     def dependencies(self):
         return []
 
     def load(self, device):
-        return
+        if self.sampling == 'device':
+            device.push_from(io.BytesIO(SAMPLER_SCRIPT.encode()), self.SAMPLER_PATH)
 
     def unload(self, device):
-        return
+        if self.sampling == 'device':
+            device.shell('rm -f %s' % self.SAMPLER_PATH)
 
     def aggregate_subject(self):
         filename = os.path.join(self.output_dir, 'Aggregated.csv')
@@ -118,25 +360,22 @@ class Android(Profiler):
 
     @staticmethod
     def aggregate_android_subject(logs_dir):
-        def add_row(accum, new):
-            row = {k: v + float(new[k]) for k, v in list(accum.items())
-                   if k not in ['Component', 'count']}
-            count = accum['count'] + 1
-            return dict(row, **{'count': count})
-
+        """Returns the mean over the runs of the mean of every column of a run, empty values are left out"""
         runs = []
         for run_file in [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]:
             with open(os.path.join(logs_dir, run_file), 'r') as run:
                 reader = csv.DictReader(run)
-                init = dict(
-                    {fn: 0 for fn in reader.fieldnames if fn != 'datetime'}, **{'count': 0})
-                run_total = reduce(add_row, reader, init)
-                runs.append(
-                    {k: v / run_total['count'] for k, v in list(run_total.items()) if k != 'count'})
-        runs_total = reduce(
-            lambda x, y: {k: v + y[k] for k, v in list(x.items())}, runs)
-        return OrderedDict(
-            sorted(list({'android_' + k: v / len(runs) for k, v in list(runs_total.items())}.items()), key=lambda x: x[0]))
+                totals = OrderedDict((fn, [0.0, 0]) for fn in reader.fieldnames if fn not in ['datetime', 'Component'])
+                for row in reader:
+                    for k, total in list(totals.items()):
+                        if row.get(k):
+                            total[0] += float(row[k])
+                            total[1] += 1
+                runs.append({k: v / count for k, (v, count) in list(totals.items()) if count})
+        columns = {k for run in runs for k in run}
+        return OrderedDict(sorted(
+            [('android_' + k, sum(run[k] for run in runs if k in run) / len([run for run in runs if k in run]))
+             for k in columns], key=lambda x: x[0]))
 
     def aggregate_final(self, data_dir):
         rows = []
@@ -0,0 +1,220 @@
+import re
+from collections import OrderedDict
+
+# Clock ticks per second of the CPU times in /proc, USER_HZ is 100 on Android
+CLOCK_TICKS = 100
+
+
+def cpu_usage(output):
+    """Returns the total CPU usage in percent from the output of 'dumpsys cpuinfo | grep TOTAL'"""
+    usage = output.split('%')[0]
+    if '.-' in usage:
+        usage = usage.replace('.-', '.')
+    return usage
+
+
+def mem_usage(output, app):
+    """Returns the memory usage in KB from the output of 'dumpsys meminfo <app>' or 'dumpsys meminfo | grep Used'"""
+    if not app:
+        # https://stackoverflow.com/questions/23175809/str-translate-gives-typeerror-translate-takes-one-argument-2-given-worked-i
+        return output.translate(str.maketrans('', '', '(kB,K')).split()[2]
+    if 'No process found' in output:
+        raise Exception('Android Profiler: {}'.format(output.strip()))
+    total = [line for line in output.splitlines() if 'TOTAL' in line]
+    return ' '.join(total[0].strip().split()).split()[1]
+
+
+def split_stat(line):
+    """Returns the name and the fields after it of a line of /proc/<pid>/stat, the name can contain spaces"""
+    return line[line.find('(') + 1:line.rfind(')')], line[line.rfind(')') + 2:].split()
+
+
+class DataPoint(object):
+    """A value the android profiler reads from the device at every sample.
+
+    cost is the estimated milliseconds the command takes on the device. The commands of all data points of a sample
+    run in a single shell invocation, so a sample takes one adb round trip plus the cost of its data points. columns
+    are known up front for data points with a single column, the others add their columns as they find them.
+    """
+    cost = 1
+    columns = []
+    # Needs the package of the app, which web experiments do not have
+    per_app = False
+
+    def __init__(self, name):
+        self.name = name
+
+    def command(self, app):
+        raise NotImplementedError
+
+    def parse(self, output, app):
+        """Returns the OrderedDict of column to value of the output of command()"""
+        raise NotImplementedError
+
+    def reset(self):
+        """Forgets the previous sample, called at the start of a run"""
+        pass
+
+
+class CpuUsage(DataPoint):
+    """Total CPU usage in percent, according to dumpsys"""
+    cost = 100
+    columns = ['cpu']
+
+    def command(self, app):
+        return 'dumpsys cpuinfo | grep TOTAL'
+
+    def parse(self, output, app):
+        return OrderedDict([('cpu', cpu_usage(output))])
+
+
+class MemUsage(DataPoint):
+    """Total PSS of the app or used memory of the system in KB, according to dumpsys"""
+    cost = 150
+    columns = ['mem']
+
+    def command(self, app):
+        return 'dumpsys meminfo %s' % app if app else 'dumpsys meminfo | grep Used'
+
+    def parse(self, output, app):
+        return OrderedDict([('mem', mem_usage(output, app))])
+
+
+class CoreUtilization(DataPoint):
+    """Utilization in percent of every online core since the previous sample, from /proc/stat"""
+
+    def __init__(self, name):
+        super(CoreUtilization, self).__init__(name)
+        self.previous = {}
+
+    def command(self, app):
+        return 'grep "^cpu[0-9]" /proc/stat'
+
+    def parse(self, output, app):
+        values = OrderedDict()
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) < 6 or not all(field.isdigit() for field in fields[1:]):
+                continue
+            times = [int(field) for field in fields[1:]]
+            # idle and iowait
+            busy, total = sum(times) - sum(times[3:5]), sum(times)
+            if fields[0] in self.previous and total > self.previous[fields[0]][1]:
+                previous_busy, previous_total = self.previous[fields[0]]
+                values['core_util_%s' % fields[0]] = '%.1f' % (100.0 * (busy - previous_busy) /
+                                                                (total - previous_total))
+            self.previous[fields[0]] = (busy, total)
+        return values
+
+    def reset(self):
+        self.previous = {}
+
+
+class CoreFrequency(DataPoint):
+    """Current frequency of every online core in kHz"""
+    cost = 2
+
+    def command(self, app):
+        return 'grep -H . /sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq'
+
+    def parse(self, output, app):
+        values = OrderedDict()
+        for match in re.finditer(r'/(cpu\d+)/cpufreq/scaling_cur_freq:(\d+)', output):
+            values['core_freq_%s' % match.group(1)] = match.group(2)
+        return values
+
+
+class ThreadCpu(DataPoint):
+    """CPU usage of the threads of the app since the previous sample in percent of a core, summed by thread name"""
+    cost = 5
+    per_app = True
+
+    def __init__(self, name):
+        super(ThreadCpu, self).__init__(name)
+        self.previous = None
+
+    def command(self, app):
+        return 'cat /proc/uptime; p=$(pidof %s) && cat /proc/${p%%%% *}/task/*/stat' % app
+
+    def parse(self, output, app):
+        lines = output.splitlines()
+        if not lines or not re.match(r'^[0-9.]+ ', lines[0]):
+            return OrderedDict()
+        uptime = float(lines[0].split()[0])
+        ticks = OrderedDict()
+        for line in lines[1:]:
+            name, fields = split_stat(line)
+            if len(fields) > 12:
+                # utime and stime, fields 14 and 15 of the line
+                ticks[name] = ticks.get(name, 0) + int(fields[11]) + int(fields[12])
+        values = OrderedDict()
+        if self.previous is not None and uptime > self.previous[0]:
+            seconds = uptime - self.previous[0]
+            for name, total in ticks.items():
+                used = max(0, total - self.previous[1].get(name, 0))
+                values['thread_%s' % name] = '%.1f' % (100.0 * used / CLOCK_TICKS / seconds)
+        self.previous = (uptime, ticks)
+        return values
+
+    def reset(self):
+        self.previous = None
+
+
+class MemBreakdown(DataPoint):
+    """RSS, PSS and their shared, private and swapped parts of the app in KB, from /proc/<pid>/smaps_rollup"""
+    cost = 20
+    per_app = True
+
+    def command(self, app):
+        return 'p=$(pidof %s) && cat /proc/${p%%%% *}/smaps_rollup' % app
+
+    def parse(self, output, app):
+        values = OrderedDict()
+        for match in re.finditer(r'^(\w+):\s+(\d+) kB', output, re.MULTILINE):
+            values['mem_%s' % match.group(1).lower()] = match.group(2)
+        return values
+
+
+class Thermal(DataPoint):
+    """Temperature of every thermal zone in degrees Celsius, named by the type of the zone"""
+    cost = 5
+
+    def command(self, app):
+        return 'grep -H . /sys/class/thermal/thermal_zone*/type /sys/class/thermal/thermal_zone*/temp'
+
+    def parse(self, output, app):
+        types, temperatures = {}, OrderedDict()
+        for match in re.finditer(r'/(thermal_zone\d+)/(type|temp):(.+)', output):
+            (types if match.group(2) == 'type' else temperatures)[match.group(1)] = match.group(3).strip()
+        values = OrderedDict()
+        for zone, temperature in temperatures.items():
+            if not re.match(r'^-?\d+$', temperature):
+                continue
+            column = 'thermal_%s' % types.get(zone, zone)
+            if column in values:
+                column = '%s_%s' % (column, zone)
+            # Most zones report millidegrees
+            values[column] = '%.1f' % (int(temperature) / 1000.0 if abs(int(temperature)) >= 1000 else
+                                       float(temperature))
+        return values
+
+
+class Battery(DataPoint):
+    """Current in mA and voltage in mV of the battery, the sign of the current depends on the vendor"""
+    cost = 2
+
+    def command(self, app):
+        return 'grep -H . /sys/class/power_supply/battery/current_now /sys/class/power_supply/battery/voltage_now'
+
+    def parse(self, output, app):
+        values = OrderedDict()
+        for match in re.finditer(r'/(current|voltage)_now:(-?\d+)', output):
+            # The kernel reports microampere and microvolt
+            values['battery_%s' % match.group(1)] = '%.1f' % (int(match.group(2)) / 1000.0)
+        return values
+
+
+# The data points of the android profiler by their name in the configuration
+DATA_POINTS = OrderedDict([('cpu', CpuUsage), ('mem', MemUsage), ('core_util', CoreUtilization),
+                           ('core_freq', CoreFrequency), ('threads', ThreadCpu), ('mem_detail', MemBreakdown),
+                           ('thermal', Thermal), ('battery', Battery)])
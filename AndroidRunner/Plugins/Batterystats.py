@@ -11,7 +11,7 @@ from . import BatterystatsParser
 from AndroidRunner.BrowserFactory import BrowserFactory
 from .Profiler import Profiler
 from functools import reduce
-from AndroidRunner import Tests
+from AndroidRunner import Manifest, Tests
 from AndroidRunner import util
 
 class Batterystats(Profiler):
@@ -80,6 +80,7 @@ class Batterystats(Profiler):
         # TODO: Check if 'systrace freq idle' is supported by the device
         global sysproc
 
+        Manifest.register(systrace_file)
         sysproc = subprocess.Popen(
             '{} freq idle -e {} -a {} -t {} -o {}'.format(self.systrace, device.id, application, int(self.duration + 5),
                                                           systrace_file), shell=True)
@@ -99,6 +100,7 @@ class Batterystats(Profiler):
     # Get BatteryStats data
     def get_batterystats_results(self, device):
         with open(batterystats_file, 'w+') as f:
+            Manifest.register(batterystats_file)
             f.write(device.shell('dumpsys batterystats --history'))
         batterystats_results = BatterystatsParser.parse_batterystats(app, batterystats_file, self.powerprofile)
         return batterystats_results
@@ -106,8 +108,15 @@ class Batterystats(Profiler):
     # Estimate total consumption, charge is given in mAh, volt in mV
     @staticmethod
     def get_consumed_joules(device):
-        charge = device.shell('dumpsys batterystats | grep "Computed drain:"').split(',')[1].split(':')[1]
-        volt = device.shell('dumpsys batterystats | grep "volt="').split('volt=')[1].split()[0]
+        # The dump is large, only the lines with the drain and the voltages are transferred
+        lines = device.shell('dumpsys batterystats | grep -e "Computed drain:" -e "volt="').splitlines()
+        drain_line = next((line for line in lines if 'Computed drain:' in line), None)
+        volt_line = next((line for line in lines if 'volt=' in line), None)
+        if drain_line is None or volt_line is None:
+            raise Exception('Batterystats: the battery stats of %s have no %s' %
+                            (device.id, '"Computed drain:"' if drain_line is None else '"volt="'))
+        charge = drain_line.split(',')[1].split(':')[1]
+        volt = volt_line.split('volt=')[1].split()[0]
         energy_consumed_wh = float(charge) * float(volt) / 1000000.0
         energy_consumed_j = energy_consumed_wh * 3600.0
         return energy_consumed_j
@@ -126,13 +135,16 @@ class Batterystats(Profiler):
 
     def write_results(self, batterystats_results, systrace_results, energy_consumed_j):
         with open(results_file, 'w+') as results:
+            Manifest.register(results_file)
             writer = csv.writer(results, delimiter="\n")
             writer.writerow(
                 ['Start Time (Seconds),End Time (Seconds),Duration (Seconds),Component,Energy Consumption (Joule)'])
             writer.writerow(batterystats_results)
             writer.writerow(systrace_results)
         # FIX
-        with open(op.join(self.output_dir, 'Joule_{}'.format(results_file_name)), 'w+') as out:
+        joule_file = op.join(self.output_dir, 'Joule_{}'.format(results_file_name))
+        with open(joule_file, 'w+') as out:
+            Manifest.register(joule_file)
             out.write('Joule_calculated\n{}\n'.format(energy_consumed_j))
 
     def cleanup_logs(self):
@@ -3,14 +3,13 @@ import errno
 import json
 import os
 import os.path as op
-import time
 from collections import OrderedDict
 
 import lxml.etree as et
 
 from .Profiler import Profiler
 from functools import reduce
-from AndroidRunner import util
+from AndroidRunner import util, Manifest, Waits
 
 
 class Trepn(Profiler):
@@ -55,16 +54,16 @@ class Trepn(Profiler):
 
     def load(self, device):
         device.push(self.pref_dir, self.remote_pref_dir)
-        # There is no way to know if the following succeeded
         device.launch_package('com.quicinc.trepn')
-        time.sleep(5)  # launch_package returns instantly
-        # Trepn needs to be started for this to work
-        device.shell('am broadcast -a com.quicinc.trepn.load_preferences '
-                     '-e com.quicinc.trepn.load_preferences_file "%s"'
-                     % op.join(self.remote_pref_dir, 'trepn.pref'))
-        time.sleep(1)  # am broadcast returns instantly
+        # launch_package returns instantly, Trepn needs to be started for the broadcast to work
+        Waits.activity_focused(device, 'com.quicinc.trepn')
+        result = device.shell('am broadcast -a com.quicinc.trepn.load_preferences '
+                              '-e com.quicinc.trepn.load_preferences_file "%s"'
+                              % op.join(self.remote_pref_dir, 'trepn.pref'))
+        if not Waits.broadcast_acknowledged(result):
+            self.logger.warning('%s: Trepn did not acknowledge loading the preferences' % device.id)
         device.force_stop('com.quicinc.trepn')
-        time.sleep(2)  # am force-stop returns instantly
+        Waits.process_gone(device, 'com.quicinc.trepn')
         device.shell('am startservice com.quicinc.trepn/.TrepnService')
 
     def start_profiling(self, device, **kwargs):
@@ -82,13 +81,14 @@ class Trepn(Profiler):
             device.shell('am broadcast -a com.quicinc.trepn.export_to_csv '
                          '-e com.quicinc.trepn.export_db_input_file "%s" '
                          '-e com.quicinc.trepn.export_csv_output_file "%s"' % (newest_db, csv_filename))
-            time.sleep(1)  # adb returns instantly, while the command takes time
-            device.pull(op.join(Trepn.DEVICE_PATH, csv_filename), self.output_dir)
-            time.sleep(1)  # adb returns instantly, while the command takes time
+            # The broadcast returns instantly, while the export takes time
+            Waits.file_complete(device, op.join(Trepn.DEVICE_PATH, csv_filename))
+            # The rows are parsed while the export is streamed from the device, without a temporary local copy
+            rows = list(csv.reader(util.iter_lines(device.pull_stream(op.join(Trepn.DEVICE_PATH, csv_filename)))))
             # Delete the originals
-            device.shell('rm %s' % op.join(Trepn.DEVICE_PATH, newest_db))
-            device.shell('rm %s' % op.join(Trepn.DEVICE_PATH, csv_filename))
-        self.filter_results(op.join(self.output_dir, csv_filename))
+            device.shell_batch(['rm %s' % op.join(Trepn.DEVICE_PATH, newest_db),
+                                'rm %s' % op.join(Trepn.DEVICE_PATH, csv_filename)])
+            self.filter_results(op.join(self.output_dir, csv_filename), rows)
 
     @staticmethod
     def read_csv(filename):
@@ -99,8 +99,9 @@ class Trepn(Profiler):
                 result.append(row)
         return result
 
-    def filter_results(self, filename):
-        file_content = self.read_csv(filename)[3:]
+    def filter_results(self, filename, rows=None):
+        """Writes the wanted columns of the Trepn export to filename, the rows are read from filename if not given"""
+        file_content = (self.read_csv(filename) if rows is None else rows)[3:]
         split_line = file_content.index(['System Statistics:'])
         data = file_content[:split_line - 2]
         system_statistics = file_content[split_line + 2:]
@@ -113,6 +114,7 @@ class Trepn(Profiler):
     @staticmethod
     def write_list_to_file(filename, rows):
         with open(filename, 'w') as f:
+            Manifest.register(filename)
             writer = csv.writer(f)
             writer.writerows(rows)
 
@@ -148,8 +150,8 @@ class Trepn(Profiler):
         return wanted_columns
 
     def unload(self, device):
-        device.shell('am stopservice com.quicinc.trepn/.TrepnService')
-        device.shell('rm -r %s' % op.join(self.remote_pref_dir, 'trepn.pref'))
+        device.shell_batch(['am stopservice com.quicinc.trepn/.TrepnService',
+                            'rm -r %s' % op.join(self.remote_pref_dir, 'trepn.pref')])
 
     def set_output(self, output_dir):
         self.output_dir = output_dir
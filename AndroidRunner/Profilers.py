@@ -1,6 +1,7 @@
 import logging
 from itertools import chain
 
+from . import Timing
 from .PluginHandler import PluginHandler
 
 
@@ -24,41 +25,42 @@ class Profilers(object):
     def load(self, device):
         self.logger.info('Loading')
         if device.name not in self.loaded_devices:
-            for p in self.profilers:
-                p.load(device)
+            self.run_hook('load', device)
             self.loaded_devices.append(device.name)
 
     def start_profiling(self, device, **kwargs):
         self.logger.info('Start profiling')
-        for p in self.profilers:
-            p.start_profiling(device, **kwargs)
+        self.run_hook('start_profiling', device, **kwargs)
 
     def stop_profiling(self, device, **kwargs):
         self.logger.info('Stop profiling')
-        for p in self.profilers:
-            p.stop_profiling(device, **kwargs)
+        self.run_hook('stop_profiling', device, **kwargs)
 
     def collect_results(self, device):
         self.logger.info('Collecting results')
-        for p in self.profilers:
-            p.collect_results(device)
+        self.run_hook('collect_results', device)
 
     def unload(self, device):
         self.logger.info('Unloading')
-        for p in self.profilers:
-            p.unload(device)
+        self.run_hook('unload', device)
+
+    def run_hook(self, hook, *args, **kwargs):
+        """Calls the hook of every profiler, timing each profiler as a phase of the run"""
+        with Timing.measure('profilers.%s' % hook) as phase:
+            for p in self.profilers:
+                with Timing.measure('%s.%s' % (p.name, hook)):
+                    getattr(p, hook)(*args, **kwargs)
+        # A dry run estimates the hook from these lines of earlier experiments
+        self.logger.debug('Hook %s took %.3fs' % (hook, phase.duration))
 
     def set_output(self):
         self.logger.info('Setting output')
-        for p in self.profilers:
-            p.set_output()
+        self.run_hook('set_output')
 
     def aggregate_subject(self):
         self.logger.info('Start subject aggregation')
-        for p in self.profilers:
-            p.aggregate_subject()
+        self.run_hook('aggregate_subject')
 
     def aggregate_end(self, output_dir):
         self.logger.info('Start final aggregation')
-        for p in self.profilers:
-            p.aggregate_data_end(output_dir)
+        self.run_hook('aggregate_data_end', output_dir)
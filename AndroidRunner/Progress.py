@@ -1,197 +1,351 @@
 import hashlib
+import json
 import logging
 import os
 import sys
-from random import randint
+from collections import Counter, OrderedDict, namedtuple
+from xml.sax.saxutils import escape, quoteattr
 
 import lxml.etree as et
 
 import paths
+from . import Scheduler
+from .util import load_json
+
+Run = namedtuple('Run', ['run_id', 'device', 'path', 'browser', 'run_count'])
 
 
 class Progress(object):
+    # Number of journaled runs after which the journal is compacted into the progress file
+    COMPACT_INTERVAL = 100
+    # Bytes read at once when the referenced files are hashed
+    HASH_CHUNK_SIZE = 1024 * 1024
+
     def __init__(self, progress_file=None, config_file=None, config=None, load_progress=None):
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.config_hash = None
+        self.output_dir = None
+        # Seed of the precomputed random order of the runs, None when the runs are in configuration order
+        self.random_seed = None
+        # All runs by id, the XML file is only used to save and resume the progress
+        self.runs = {}
+        # Ids of the runs to run in order, in total and per device, and of the runs done in order of completion
+        self.runs_to_run = OrderedDict()
+        self.device_runs_to_run = {}
+        self.runs_done = []
+        # Number of runs to run and done per (device, path, browser), the browser None counts every browser
+        self.pending_counts = Counter()
+        self.done_counts = Counter()
+        self.device_done_counts = Counter()
+        self.escaped = {}
+        self.journal_size = 0
         if load_progress:
             self.progress_xml_file = progress_file
-            self.progress_xml_content = et.parse(self.progress_xml_file).getroot()
+            self.load_progress_file(self.progress_xml_file)
             self.check_config_hash(config_file)
+            self.replay_journal()
         else:
             self.progress_xml_file = os.path.join(paths.OUTPUT_DIR, 'progress.xml')
-            self.progress_xml_content = self.build_progress_xml(config, config_file)
+            self.config_hash = self.file_to_hash(config_file)
+            self.output_dir = paths.OUTPUT_DIR
+            self.build_runs(config)
             self.write_progress_to_file()
 
     def get_progress_xml_file(self):
         return self.progress_xml_file
 
+    def get_journal_file(self):
+        """The journal of the runs finished since progress.xml was written, named after progress.xml"""
+        return os.path.splitext(self.progress_xml_file)[0] + '.journal.jsonl'
+
+    def journal_run(self, run_id, files=()):
+        """Durably records a finished run and the files it produced, the journal is compacted periodically"""
+        with open(self.get_journal_file(), 'a') as f:
+            f.write(json.dumps({'runId': str(run_id), 'files': list(files)}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_size += 1
+        if self.journal_size >= self.COMPACT_INTERVAL:
+            self.write_progress_to_file()
+
+    def replay_journal(self):
+        """Marks the runs of the journal as finished and compacts the journal into the progress file"""
+        journal_file = self.get_journal_file()
+        if not os.path.isfile(journal_file):
+            return
+        with open(journal_file, 'r') as f:
+            for line in f:
+                try:
+                    run_id = json.loads(line)['runId']
+                except (ValueError, KeyError):
+                    # Only the last entry can be incomplete, when the experiment was killed while writing it
+                    self.logger.warning('Ignoring incomplete journal entry: %s' % line.strip())
+                    break
+                self.run_finished(run_id)
+        # New entries must not be appended to an incomplete one
+        self.write_progress_to_file()
+
+    @classmethod
+    def file_to_hash(cls, path):
+        """Fingerprint of the experiment: the configuration file and the content of the scripts and APKs it refers to.
+
+        The configuration is hashed in canonical form, so formatting, key order and 1.0 versus 1 don't matter.
+        """
+        config = load_json(path)
+        fingerprint = hashlib.blake2b(digest_size=16)
+        for chunk in json.JSONEncoder(sort_keys=True, separators=(',', ':')).iterencode(cls.canonical(config)):
+            fingerprint.update(chunk.encode('utf-8'))
+        # The paths are part of the configuration, the location of the experiment does not matter
+        for referenced_file in cls.referenced_files(config, os.path.dirname(path)):
+            if not os.path.isfile(referenced_file):
+                fingerprint.update(b'\0missing')
+                continue
+            # The size separates the contents of the files
+            fingerprint.update(b'\0%d\0' % os.path.getsize(referenced_file))
+            with open(referenced_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(cls.HASH_CHUNK_SIZE), b''):
+                    fingerprint.update(chunk)
+        return fingerprint.hexdigest()
+
+    @classmethod
+    def canonical(cls, value):
+        """Returns the JSON value with integral floats as integers"""
+        if isinstance(value, dict):
+            return {key: cls.canonical(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [cls.canonical(item) for item in value]
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    @staticmethod
+    def referenced_files(config, config_dir):
+        """Paths of the scripts, aggregation scripts and APKs of the configuration, in configuration order"""
+        files = []
+        for script in config.get('scripts', {}).values():
+            for item in [script] if isinstance(script, str) else script:
+                files.append(os.path.join(config_dir, item if isinstance(item, str) else item['path']))
+        for params in config.get('profilers', {}).values():
+            for key in ('subject_aggregation', 'experiment_aggregation'):
+                script = params.get(key, 'default')
+                if script.lower() not in ('default', 'none'):
+                    files.append(os.path.join(config_dir, script))
+        if config.get('type') == 'native':
+            files.extend(config.get('paths', []))
+        return files
+
     @staticmethod
-    def file_to_hash(path):
+    def legacy_file_hash(path):
+        """The hash of progress files of older versions, the MD5 of the configuration text without newlines"""
         with open(path, 'r') as myfile:
             content_string = myfile.read().replace('\n', '')
         hashed_string_obj = hashlib.md5(content_string.encode())
         return hashed_string_obj.hexdigest()
 
     def check_config_hash(self, config_file):
-        progress_config_hash = self.progress_xml_content.find('configHash').text
-        if progress_config_hash == self.file_to_hash(config_file):
+        if self.config_hash == self.file_to_hash(config_file):
+            return
+        elif self.config_hash == self.legacy_file_hash(config_file):
+            self.logger.info('Progress file of an older version, the scripts and APKs are not checked')
             return
         else:
-            print('Current config.json and config.json from progress.xml are not the same, cannot continue')
+            print('Current config.json, or the scripts and APKs it refers to, and the experiment of progress.xml are '
+                  'not the same, cannot continue')
             sys.exit()
 
-    def build_progress_xml(self, config, config_file):
-        config_hash_xml = '<configHash>{}</configHash>'.format(self.file_to_hash(config_file))
-        output_dir_xml = '<outputDir>{}</outputDir>'.format(paths.OUTPUT_DIR)
-        runs_to_run_xml = '<runsToRun>{}</runsToRun>'.format(self.build_runs_xml(config))
-        runs_done_xml = '<runsDone></runsDone>'
-        experiment_xml = '<experiment>{}{}{}{}</experiment>'.format(config_hash_xml, output_dir_xml,
-                                                                    runs_to_run_xml, runs_done_xml)
-        return et.fromstring(experiment_xml)
-
-    @staticmethod
-    def build_subject_xml(device, path, browser=None):
-        device_xml = '<device>{}</device>'.format(device)
-        path_xml = '<path>{}</path>'.format(path)
-        if browser is not None:
-            browser_xml = '<browser>{}</browser>'.format(browser)
-            return '{}{}{}'.format(device_xml, path_xml, browser_xml)
-        else:
-            return '{}{}'.format(device_xml, path_xml)
+    def build_runs(self, config):
+        """Creates the runs of the experiment, every subject is repeated replications times.
 
-    def build_runs_xml(self, config):
-        runs_xml = ''
-        run_id = 0
+        The runs are added in the order of the scheduler, which is stored in the progress file. Resuming the experiment
+        therefore continues the same order, also when it is random.
+        """
+        runs = []
         for device in config['devices']:
             current_paths = config.get('paths', []) + config.get('apps', [])
             for path in current_paths:
-                if config['type'] == 'web':
-                    for browser in config['browsers']:
-                        subject_xml = self.build_subject_xml(device, path, browser)
-                        for run in range(config['replications']):
-                            runs_xml = runs_xml + '<run runId="{}">{}<runCount>{}</runCount></run>'. \
-                                format(run_id, subject_xml, run + 1)
-                            run_id += 1
-                else:
-                    subject_xml = self.build_subject_xml(device, path)
+                browsers = config['browsers'] if config['type'] == 'web' else [None]
+                for browser in browsers:
                     for run in range(config['replications']):
-                        runs_xml = runs_xml + '<run runId="{}">{}<runCount>{}</runCount></run>'. \
-                            format(run_id, subject_xml, run + 1)
-                        run_id += 1
+                        runs.append(Run(str(len(runs)), device, path, browser, run + 1))
+        scheduler = Scheduler.get_scheduler(config)
+        self.random_seed = scheduler.seed
+        for run in scheduler.order(runs):
+            self.add_run(run)
+
+    def add_run(self, run, done=False):
+        """Adds a run to the runs to run, or to the runs done"""
+        self.runs[run.run_id] = run
+        if done:
+            self.runs_done.append(run.run_id)
+            for key in self.subject_keys(run):
+                self.done_counts[key] += 1
+            self.device_done_counts[run.device] += 1
+        else:
+            self.runs_to_run[run.run_id] = None
+            self.device_runs_to_run.setdefault(run.device, OrderedDict())[run.run_id] = None
+            for key in self.subject_keys(run):
+                self.pending_counts[key] += 1
 
-        return runs_xml
+    @staticmethod
+    def subject_keys(run):
+        """The counter keys of a run, the browser of web runs is also counted as None to match any browser"""
+        if run.browser is None:
+            return [(run.device, run.path, None)]
+        return [(run.device, run.path, run.browser), (run.device, run.path, None)]
+
+    def load_progress_file(self, progress_file):
+        """Reads the progress file run by run, without keeping the element tree of all runs in memory"""
+        for _, element in et.iterparse(progress_file, tag=('configHash', 'outputDir', 'randomSeed', 'run')):
+            if element.tag == 'configHash':
+                self.config_hash = element.text
+            elif element.tag == 'outputDir':
+                self.output_dir = element.text
+            elif element.tag == 'randomSeed':
+                self.random_seed = int(element.text)
+            else:
+                device, path, browser, run_count = self.read_run_xml(element)
+                self.add_run(Run(element.get('runId'), device, path, browser, run_count),
+                             done=element.getparent().tag == 'runsDone')
+                # Drop the run and the runs before it, the parent keeps a reference to every run that was read
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
 
-    def write_progress_to_file(self):
-        xml = self.progress_xml_content.getroottree()
-        xml.write(self.progress_xml_file, pretty_print=True)
+    @staticmethod
+    def read_run_xml(run_xml):
+        """Returns the device, path, browser (None for native runs) and run count of a run element"""
+        values = {'browser': None}
+        for child in run_xml:
+            # The names repeat for every run, share a single copy of every name
+            values[child.tag] = sys.intern(child.text) if child.tag != 'runCount' else int(child.text)
+        return values['device'], values['path'], values['browser'], values['runCount']
+
+    def build_run_xml(self, run):
+        """Serializes a run as an indented <run> element of progress.xml"""
+        browser_xml = '      <browser>%s</browser>\n' % self.escape(run.browser) if run.browser is not None else ''
+        return '    <run runId=%s>\n      <device>%s</device>\n      <path>%s</path>\n%s' \
+               '      <runCount>%d</runCount>\n    </run>\n' % (quoteattr(run.run_id), self.escape(run.device),
+                                                              self.escape(run.path), browser_xml, run.run_count)
+
+    def escape(self, text):
+        """Escapes text for XML, the result is cached as the names repeat for every run"""
+        if text not in self.escaped:
+            self.escaped[text] = escape(text, {'\r': '&#13;'})
+        return self.escaped[text]
+
+    def write_progress_to_file(self, unfinished=()):
+        """Writes a snapshot of the progress to the XML file run by run and clears the journal.
+
+        The runs in unfinished are written as the first runs to run, e.g. a run that failed after it was marked
+        finished.
+        """
+        unfinished = [str(run_id) for run_id in unfinished if str(run_id) in self.runs]
+        runs_to_run = unfinished + [run_id for run_id in self.runs_to_run if run_id not in unfinished]
+        runs_done = [run_id for run_id in self.runs_done if run_id not in unfinished] if unfinished else \
+            self.runs_done
+        # The previous snapshot stays intact until the new one is complete
+        temporary_file = self.progress_xml_file + '.tmp'
+        with open(temporary_file, 'wb') as f:
+            # Like lxml, write ASCII and replace other characters by character references
+            def write(text):
+                f.write(text.encode('ascii', 'xmlcharrefreplace'))
+
+            write('<experiment>\n  <configHash>%s</configHash>\n  <outputDir>%s</outputDir>\n' %
+                  (self.escape(self.config_hash), self.escape(self.output_dir)))
+            if self.random_seed is not None:
+                write('  <randomSeed>%d</randomSeed>\n' % self.random_seed)
+            for tag, run_ids in (('runsToRun', runs_to_run), ('runsDone', runs_done)):
+                if not run_ids:
+                    write('  <%s/>\n' % tag)
+                    continue
+                write('  <%s>\n' % tag)
+                for run_id in run_ids:
+                    write(self.build_run_xml(self.runs[run_id]))
+                write('  </%s>\n' % tag)
+            write('</experiment>\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_file, self.progress_xml_file)
+        # Runs of the journal that are also in the snapshot are ignored when replayed, so a crash here is harmless
+        if os.path.isfile(self.get_journal_file()):
+            os.remove(self.get_journal_file())
+        self.journal_size = 0
 
     def get_output_dir(self):
-        return self.progress_xml_content.find('outputDir').text
-
-    """Get a random run from the <runsToRuns> element"""
-
-    def get_random_run(self):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        count = len(runs_to_run.getchildren())
-        random_index = randint(0, count - 1)
-        next_run_xml = self.progress_xml_content.find('runsToRun')[random_index]
-        return self.run_to_dict(next_run_xml)
-
-    """Get the top run of the list"""
-
-    def get_next_run(self):
-        next_run_xml = self.progress_xml_content.find('runsToRun')[0]  # First run in list
-        return self.run_to_dict(next_run_xml)
-
-    """Turn a <run> element and its childeren into a dictionary"""
-
-    def run_to_dict(self, run_xml):
-        run = dict()
-        run['runId'] = run_xml.get('runId')
-        run['device'] = run_xml.find('device').text
-        run['path'] = run_xml.find('path').text
-        run['runCount'] = self.get_run_count(run_xml, run['device'], run['path'])
-        browser = run_xml.find('browser')
-        if browser is not None:
-            run['browser'] = run_xml.find('browser').text
-        return run
-
-    def get_run_count(self, run_xml, device, path):
-        runs_done = self.progress_xml_content.find('runsDone')
-        browser_val = run_xml.find('browser')
-        if browser_val is not None:
-            browser_name = browser_val.text
-            query = "run[device='{}' and path='{}' and browser='{}']".format(device, path, browser_name)
-        else:
-            query = "run[device='{}' and path='{}']".format(device, path)
-        elements = runs_done.xpath(query)
-        return len(elements) + 1
-
-    """Marks run as finished"""
+        return self.output_dir
+
+    def get_runs_to_run(self, device=None):
+        """Get the runs to run as dictionaries, optionally only those of one device"""
+        run_ids = self.runs_to_run if device is None else self.device_runs_to_run.get(device, {})
+        return [self.run_to_dict(run_id) for run_id in run_ids]
+
+    def get_schedule(self, device=None):
+        """Get the runs to run in order of execution, optionally only those of one device"""
+        run_ids = self.runs_to_run if device is None else self.device_runs_to_run.get(device, {})
+        return [self.runs[run_id] for run_id in run_ids]
+
+    def get_random_run(self, device=None):
+        """Get the next run of the random order, which is the order of the runs in the progress file"""
+        # Progress files of older versions have no random seed and continue in the order they were written
+        return self.get_next_run(device)
+
+    def get_next_run(self, device=None):
+        """Get the first run of the runs to run"""
+        run_ids = self.runs_to_run if device is None else self.device_runs_to_run[device]
+        return self.run_to_dict(next(iter(run_ids)))
+
+    def get_devices_to_run(self):
+        """Get the names of the devices that have runs left, in order of their first run"""
+        devices = []
+        for run_id in self.runs_to_run:
+            device = self.runs[run_id].device
+            if device not in devices:
+                devices.append(device)
+        return devices
+
+    def run_to_dict(self, run_id):
+        """Turn a run into a dictionary, runCount is the number of the run among the runs of its subject"""
+        run = self.runs[run_id]
+        run_dict = {'runId': run.run_id, 'device': run.device, 'path': run.path,
+                    'runCount': self.get_run_count(run.device, run.path, run.browser)}
+        if run.browser is not None:
+            run_dict['browser'] = run.browser
+        return run_dict
+
+    def get_run_count(self, device, path, browser=None):
+        return self.done_counts[(device, path, browser)] + 1
 
     def run_finished(self, run_id):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        runs_done = self.progress_xml_content.find('runsDone')
-        elements = runs_to_run.findall("run[@runId='{}']".format(run_id))
-        for el in elements:
-            runs_to_run.remove(el)
-            runs_done.append(el)
-
-    """Check if this subject already had it's first run"""
+        """Marks run as finished"""
+        run_id = str(run_id)
+        if run_id not in self.runs_to_run:
+            return
+        run = self.runs[run_id]
+        del self.runs_to_run[run_id]
+        del self.device_runs_to_run[run.device][run_id]
+        if not self.device_runs_to_run[run.device]:
+            del self.device_runs_to_run[run.device]
+        self.runs_done.append(run_id)
+        for key in self.subject_keys(run):
+            self.pending_counts[key] -= 1
+            self.done_counts[key] += 1
+        self.device_done_counts[run.device] += 1
 
     def subject_first(self, device, path, browser=None):
-        runs_done = self.progress_xml_content.find('runsDone')
-        if browser is not None:
-            elements = runs_done.xpath(
-                "run[device='{}' and path='{}' and browser='{}']".format(device, path, browser))
-        else:
-            elements = runs_done.xpath(
-                "run[device='{}' and path='{}']".format(device, path))
-        if not elements:
-            return True
-        else:
-            return False
-
-    """Checks if all subject runs are done"""
+        """Check if this subject already had it's first run"""
+        return self.done_counts[(device, path, browser)] == 0
 
     def subject_finished(self, device, path, browser=None):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        if browser is not None:
-            elements = runs_to_run.xpath(
-                "run[device='{}' and path='{}' and browser='{}']".format(device, path, browser))
-        else:
-            elements = runs_to_run.xpath(
-                "run[device='{}' and path='{}']".format(device, path))
-        if not elements:
-            return True
-        else:
-            return False
-
-    """Check if this device already had it's first run"""
+        """Checks if all subject runs are done"""
+        return self.pending_counts[(device, path, browser)] == 0
 
     def device_first(self, device):
-        runs_done = self.progress_xml_content.find('runsDone')
-        elements = runs_done.xpath("run[device='{}']".format(device))
-
-        if not elements:
-            return True
-        else:
-            return False
-
-    """Checks if all device runs are done"""
+        """Check if this device already had it's first run"""
+        return self.device_done_counts[device] == 0
 
     def device_finished(self, device):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        elements = runs_to_run.xpath("run[device='{}']".format(device))
-
-        if not elements:
-            return True
-        else:
-            return False
+        """Checks if all device runs are done"""
+        return device not in self.device_runs_to_run
 
     def experiment_finished_check(self):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        count = len(runs_to_run.getchildren())
-        if count == 0:
-            return True
-        else:
-            return False
+        return not self.runs_to_run
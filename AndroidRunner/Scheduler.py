@@ -0,0 +1,124 @@
+import logging
+import random
+from collections import OrderedDict, namedtuple
+
+from . import Tests
+from .util import ConfigError
+
+# Setup steps caused by an order of runs: a subject is set up (e.g. its APK installed and launched) when a device
+# switches to it, a device change only costs time when the devices run one after another
+SetupOverhead = namedtuple('SetupOverhead', ['runs', 'subject_setups', 'device_changes'])
+
+
+class Scheduler(object):
+    """Orders the runs of an experiment once, when it is created. The progress stores the order."""
+    # Whether the order depends on a random seed
+    randomized = True
+
+    def __init__(self, seed=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.seed = seed
+        self.random = random.Random(seed)
+
+    def order(self, runs):
+        """Returns the runs in the order of the strategy, the runs are given in configuration order"""
+        raise NotImplementedError
+
+    @staticmethod
+    def group(runs, key):
+        """Groups the runs by key, in order of the first run of every group"""
+        groups = OrderedDict()
+        for run in runs:
+            groups.setdefault(key(run), []).append(run)
+        return list(groups.values())
+
+    @staticmethod
+    def interleave(groups):
+        """Takes one run of every group in turn, until all groups are empty"""
+        longest = max(len(group) for group in groups) if groups else 0
+        return [group[i] for i in range(longest) for group in groups if i < len(group)]
+
+
+class Sequential(Scheduler):
+    """Every subject of every device in configuration order"""
+    randomized = False
+
+    def order(self, runs):
+        return list(runs)
+
+
+class Random(Scheduler):
+    """All runs in a random order"""
+
+    def order(self, runs):
+        runs = list(runs)
+        self.random.shuffle(runs)
+        return runs
+
+
+class DeviceBlocks(Scheduler):
+    """The runs of every device in a random order, the devices one after another"""
+
+    def order(self, runs):
+        blocks = self.group(runs, lambda run: run.device)
+        for block in blocks:
+            self.random.shuffle(block)
+        return [run for block in blocks for run in block]
+
+
+class RoundRobin(DeviceBlocks):
+    """Like device_blocks, but the devices take turns, so they progress equally"""
+
+    def order(self, runs):
+        return self.interleave(self.group(super(RoundRobin, self).order(runs), lambda run: run.device))
+
+
+class SubjectBlocks(Scheduler):
+    """The subjects of every device in a random order, the replications of a subject one after another"""
+
+    def order(self, runs):
+        ordered = []
+        for device_runs in self.group(runs, lambda run: run.device):
+            blocks = self.group(device_runs, lambda run: (run.path, run.browser))
+            self.random.shuffle(blocks)
+            ordered.extend(run for block in blocks for run in block)
+        return ordered
+
+
+SCHEDULERS = OrderedDict([('sequential', Sequential), ('random', Random), ('device_blocks', DeviceBlocks),
+                          ('round_robin', RoundRobin), ('subject_blocks', SubjectBlocks)])
+
+
+def get_scheduler(config):
+    """Returns the scheduler of the configuration, randomization selects the random scheduler by default"""
+    randomization = Tests.is_boolean(config.get('randomization', False))
+    name = config.get('scheduler', 'random' if randomization else 'sequential')
+    if name not in SCHEDULERS:
+        raise ConfigError('Unknown scheduler "%s", expected one of %s' % (name, list(SCHEDULERS)))
+    if randomization and not SCHEDULERS[name].randomized:
+        raise ConfigError('Scheduler "%s" does not randomize the order of the runs, disable randomization or choose '
+                          'another scheduler' % name)
+    seed = None
+    if SCHEDULERS[name].randomized:
+        seed = Tests.is_integer(config.get('random_seed', random.randrange(2 ** 32)))
+    return SCHEDULERS[name](seed)
+
+
+def setup_overhead(runs):
+    """Counts the setup steps of the runs in order of execution"""
+    run_count = 0
+    subject_setups = 0
+    device_changes = 0
+    previous_device = None
+    # Subject of the last run of every device
+    subjects = {}
+    for run in runs:
+        run_count += 1
+        subject = (run.path, run.browser)
+        if subjects.get(run.device) != subject:
+            subject_setups += 1
+            subjects[run.device] = subject
+        if previous_device is not None and run.device != previous_device:
+            device_changes += 1
+        previous_device = run.device
+    return SetupOverhead(run_count, subject_setups, device_changes)
@@ -2,6 +2,7 @@ import logging
 import os.path as op
 
 import paths
+from . import Timing
 from .MonkeyReplay import MonkeyReplay
 from .MonkeyRunner import MonkeyRunner
 from .Python3 import Python3
@@ -36,5 +37,10 @@ class Scripts(object):
 
     def run(self, name, device, *args, **kwargs):
         self.logger.debug('Running hook {} on device {}\nargs: {}\nkwargs: {}'.format(name, device, args, kwargs))
-        for script in self.scripts.get(name, []):
-            script.run(device, *args, **kwargs)
+        if name not in self.scripts:
+            return
+        with Timing.measure('scripts.%s' % name) as hook:
+            for script in self.scripts[name]:
+                script.run(device, *args, **kwargs)
+        # A dry run estimates the hook from these lines of earlier experiments
+        self.logger.debug('Hook %s took %.3fs' % (name, hook.duration))
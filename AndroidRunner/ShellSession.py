@@ -0,0 +1,200 @@
+import logging
+import os
+import select
+import socket
+import subprocess
+import threading
+import time
+import uuid
+import weakref
+
+# The sessions of this process, a forked child detaches from them
+sessions = weakref.WeakSet()
+
+
+class ShellSessionError(Exception):
+    """Raised when the persistent shell channel can not be used"""
+    pass
+
+
+class ShellSession(object):
+    """A long-lived shell channel to a single device.
+
+    Commands are written to the stdin of one shell on the device. Every response is framed by a sentinel line
+    carrying the exit code of the command, so consecutive commands reuse the same adb connection instead of
+    forking a new adb process per command. The channel is an 'adb shell' process, or a socket to the adb server
+    when an AdbClient is given. Every command runs in its own subshell, like it would with a separate 'adb shell'.
+
+    Without the shell_v2 feature of adbd (before Android 7.0) the shell gets a pty that echoes the input and prints
+    prompts, so the session is only used when the device supports shell_v2, see supported().
+    """
+    # Seconds to wait for the output of a command before the session is given up
+    TIMEOUT = 600
+
+    def __init__(self, device_id, adb_path='adb', client=None, timeout=TIMEOUT):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.device_id = device_id
+        self.adb_path = adb_path
+        self.client = client
+        self.timeout = timeout
+        self.sentinel = '__ANDROID_RUNNER_%s__' % uuid.uuid4().hex
+        self.process = None
+        self.socket = None
+        self.stdin = None
+        self.stdout = None
+        self.owner_pid = None
+        self.buffer = b''
+        # Whether the device has shell_v2, None until it was queried
+        self.shell_v2 = None
+        self.lock = threading.Lock()
+        sessions.add(self)
+
+    def supported(self):
+        """Returns if the device can run a shell without a pty, it is queried once"""
+        if self.shell_v2 is None:
+            try:
+                if self.client is not None:
+                    features = self.client.features(str(self.device_id))
+                else:
+                    features = subprocess.run([self.adb_path, '-s', str(self.device_id), 'features'],
+                                              stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT).stdout.decode('utf-8', errors='replace')
+                    features = set(features.replace(',', '\n').split())
+            except (IOError, OSError) as e:
+                self.logger.debug('%s: Features of the device unknown (%s)' % (self.device_id, e))
+                features = set()
+            self.shell_v2 = 'shell_v2' in features
+            if not self.shell_v2:
+                self.logger.info('%s: No shell_v2 support, every command starts its own adb shell' % self.device_id)
+        return self.shell_v2
+
+    def start(self):
+        """Starts the shell on the device"""
+        # With shell_v2 and a command given, neither adb nor adbd allocates a pty that would echo the input
+        if self.client is not None:
+            self.socket = self.client.open_shell(str(self.device_id), 'sh')
+            self.stdin = self.socket.makefile('wb')
+        else:
+            self.process = subprocess.Popen([self.adb_path, '-s', str(self.device_id), 'shell', 'sh'], shell=False,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.stdin = self.process.stdin
+            self.stdout = self.process.stdout
+        self.owner_pid = os.getpid()
+        self.buffer = b''
+        self.logger.debug('%s: Shell session started' % self.device_id)
+
+    def is_alive(self):
+        """Returns True if the channel is open and was started by the current process"""
+        # A forked process (e.g. a script executed with multiprocessing) must not share the channel of its parent
+        if self.owner_pid != os.getpid():
+            return False
+        if self.process is not None:
+            return self.process.poll() is None
+        if self.socket is None:
+            return False
+        # Nothing is sent between commands, so a readable socket was closed by the adb server
+        try:
+            return not select.select([self.socket], [], [], 0)[0] or self.socket.recv(1, socket.MSG_PEEK) != b''
+        except (IOError, OSError):
+            return False
+
+    def detach(self):
+        """Forgets the channel and the lock of the parent, called in a forked child"""
+        self.lock = threading.Lock()
+        self.process = None
+        self.socket = None
+        self.stdin = None
+        self.stdout = None
+        self.owner_pid = None
+        self.buffer = b''
+
+    def close(self):
+        """Stops the shell, if it was started by the current process"""
+        if self.owner_pid == os.getpid():
+            for f in (self.stdin, self.stdout, self.socket):
+                try:
+                    if f is not None:
+                        f.close()
+                except (IOError, OSError):
+                    pass
+            if self.process is not None:
+                if self.process.poll() is None:
+                    self.process.terminate()
+                self.process.wait()
+            self.logger.debug('%s: Shell session closed' % self.device_id)
+        self.process = None
+        self.socket = None
+        self.stdin = None
+        self.stdout = None
+        self.owner_pid = None
+        self.buffer = b''
+
+    def run(self, cmd):
+        """Runs cmd in the shell session and returns a tuple with its output and exit code.
+
+        The session is restarted, and the command retried once, when the command could not be sent. Once sent, the
+        command may have run, so a failure is raised and the session restarted by the next command.
+        """
+        # The lock of a forked child can be held by a thread of the parent that does not exist in the child
+        if self.owner_pid is not None and self.owner_pid != os.getpid():
+            self.detach()
+        with self.lock:
+            try:
+                self.send(cmd)
+            except (IOError, OSError, ShellSessionError) as e:
+                self.logger.debug('%s: Restarting shell session (%s)' % (self.device_id, e))
+                self.close()
+                self.send(cmd)
+            try:
+                return self.receive(cmd)
+            except BaseException:
+                # The rest of the output would be taken for the output of the next command
+                self.close()
+                raise
+
+    def send(self, cmd):
+        if not self.is_alive():
+            self.close()
+            self.start()
+        # The subshell keeps e.g. cd, export or exit from affecting the commands that follow, stdin is redirected so
+        # commands can't consume them, the newline in front of the sentinel guarantees that it starts on a new line
+        frame = '( %s\n) </dev/null 2>&1; printf "\\n%s %%d\\n" $?\n' % (cmd, self.sentinel)
+        self.stdin.write(frame.encode('utf-8'))
+        self.stdin.flush()
+
+    def receive(self, cmd):
+        deadline = time.time() + self.timeout
+        lines = []
+        while True:
+            line = self.read_line(cmd, deadline).decode('utf-8', errors='replace')
+            if line.startswith(self.sentinel):
+                exit_code = int(line[len(self.sentinel):].strip())
+                break
+            lines.append(line)
+        output = ''.join(lines)
+        # Remove the newline printed in front of the sentinel
+        return output[:-1] if output.endswith('\n') else output, exit_code
+
+    def read_line(self, cmd, deadline):
+        """Returns the next line of output, raises a ShellSessionError when it did not arrive before the deadline"""
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.time()
+            channel = self.socket if self.socket is not None else self.stdout
+            if remaining <= 0 or not select.select([channel], [], [], remaining)[0]:
+                raise ShellSessionError('%s: No response to "%s" within %s seconds' % (self.device_id, cmd,
+                                                                                      self.timeout))
+            data = self.socket.recv(65536) if self.socket is not None else os.read(self.stdout.fileno(), 65536)
+            if not data:
+                raise ShellSessionError('%s: Shell session closed unexpectedly' % self.device_id)
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line + b'\n'
+
+
+def detach_sessions():
+    for session in list(sessions):
+        session.detach()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=detach_sessions)
@@ -0,0 +1,291 @@
+import hashlib
+import logging
+import os.path as op
+import re
+import shlex
+
+
+class Clock(object):
+    """Virtual time of a simulation, a sleep advances it instantly"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class SimulatedDevice(object):
+    """State of a simulated device: its packages, the running processes and the files pushed to it"""
+    PROPERTIES = {'ro.build.version.release': '9', 'ro.build.version.sdk': '28',
+                  'ro.product.manufacturer': 'android-runner', 'ro.product.model': 'simulated',
+                  'ro.product.cpu.abi': 'arm64-v8a', 'sys.boot_completed': '1',
+                  'ro.build.fingerprint': 'android-runner/simulated/simulated:9/SIMULATED/1:user/release-keys'}
+
+    def __init__(self, serial, packages=()):
+        self.serial = serial
+        self.packages = set(packages)
+        self.running = set()
+        # Package and activity in the foreground, None when no app is focused
+        self.focused = None
+        self.files = {}
+        # MD5 hashes of the installed APKs by package, unknown for the packages the device started with
+        self.apk_hashes = {}
+
+
+class SimulatedAdbClient(object):
+    """Stands in for the AdbClient of the 'simulated' adb backend, no device or adb server is involved.
+
+    The shell understands the commands android-runner itself sends to a device, the commands that only read the
+    state of a device print canned outputs and other commands print nothing. Every round trip and transferred byte
+    advances the clock, so a dry run accounts for the adb traffic of a run.
+
+    latencies is a list of (regex, seconds) that adds the time a matching command takes on the device, outputs is a
+    list of (regex, output) that replaces the output of matching commands. The clock can be the time module, to
+    spend the latencies in real time.
+    """
+    # Seconds of one adb round trip and the USB throughput in bytes per second, typical for the adb server
+    COMMAND_SECONDS = 0.05
+    TRANSFER_BYTES_PER_SECOND = 20 * 1024 * 1024
+    # Batch format of AdbHandle.shell_batch()
+    BATCH_RE = re.compile(r'\( (.*?)\n\) </dev/null 2>&1; printf "\\n(\w+)\\n"\n', re.DOTALL)
+    # Seconds since the epoch of the device clock at time 0 of the clock, that of the canned date
+    EPOCH = 1704067200
+    # There is no shell to keep open, every command is answered directly
+    persistent_shell = False
+    # Outputs of commands that read the state of a device, in the format the profilers parse
+    CANNED_OUTPUTS = [
+        (r'date', 'Mon Jan  1 00:00:00 UTC 2024'),
+        (r'dumpsys cpuinfo$', 'Load: 2.15 / 2.08 / 2.06\n'
+                              'CPU usage from 10000ms to 0ms ago:\n'
+                              '  8.1% 1234/system_server: 5.2% user + 2.9% kernel\n'
+                              '12.5% TOTAL: 8.1% user + 4.4% kernel + 0% iowait'),
+        (r'dumpsys meminfo$', 'Total RAM: 3,844,424K (status normal)\n'
+                              ' Free RAM: 2,001,208K (  580,368K cached pss + 1,420,840K free)\n'
+                              ' Used RAM: 1,843,216K (1,320,488K used pss +   522,728K kernel)'),
+        (r'dumpsys meminfo \S+$', '** MEMINFO in pid 4242 **\n'
+                                  '                   Pss  Private  Private     Swap     Heap\n'
+                                  '        TOTAL    52345    40123     2048        0    24576'),
+        (r'dumpsys batterystats --reset$', 'Battery stats reset.'),
+        (r'dumpsys batterystats --history$', 'Battery History (1% used, 4096 used of 256KB, 12 strings using 924):\n'
+                                             '                    0 (9) RESET:TIME: 2024-01-01-00-00-00\n'
+                                             '                    0 (2) 100 status=discharging health=good '
+                                             'plug=none temp=250 volt=4200 charge=3000 +running +screen'),
+        (r'dumpsys batterystats$', 'Statistics since last charge:\n'
+                                   '  Estimated power use (mAh):\n'
+                                   '    Capacity: 3000, Computed drain: 12.3, actual drain: 10-20\n'
+                                   '  Battery: status=discharging health=good plug=none temp=250 volt=4200'),
+        (r'cat /proc/cpuinfo', '\n'.join('processor\t: %d' % i for i in range(8))),
+    ]
+
+    LOGCAT = ['01-01 00:00:00.000  1000  1000 I ActivityManager: Start proc 4242',
+              '01-01 00:00:01.000  4242  4242 I chromium: [INFO:CONSOLE(1)] "loaded"']
+
+    def __init__(self, clock=None, latencies=(), outputs=()):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.clock = clock if clock is not None else Clock()
+        self.latencies = [(re.compile(pattern), seconds) for pattern, seconds in latencies]
+        self.outputs = [(re.compile(pattern), output) for pattern, output in outputs]
+        self.device_states = {}
+        # Commands with their own ';' or '|', matched before the command line is split
+        self.scripts = [
+            (r'apk=\$\(pm path (\S+) \| head -n 1\); md5sum "\$\{apk#package:\}"$', self.apk_hash),
+        ]
+        self.commands = [
+            (r'getprop$', self.getprop),
+            (r'getprop (\S+)$', self.getprop),
+            (r'pm list packages', self.list_packages),
+            (r'pm install(?: -\w)* (\S+)$', self.install),
+            (r'pm uninstall(?: -k)? (\S+)$', self.uninstall),
+            (r'pm clear (\S+)$', lambda device, package: 'Success'),
+            (r'monkey -p (\S+) 1$', self.launch_package),
+            (r'am start .*-n (\S+)/(\S+)', self.launch_activity),
+            (r'am force-stop (\S+)$', self.force_stop),
+            (r'am broadcast ', lambda device: 'Broadcasting: Intent\nBroadcast completed: result=0'),
+            (r'pidof (\S+) \|\| ps$', self.pidof),
+            (r'dumpsys window windows$', self.windows),
+            (r'\[ -f (\S+) \] && stat -c %s ', self.file_size),
+            (r'\[ -r (\S+) \] && echo readable$', self.readable),
+            (r'rm -f (\S+)$', self.remove),
+            (r'logcat -d(?: -e (.+))?$', self.logcat),
+            (r'su -c (.*)$', self.su),
+            (r'date \+%s$', lambda device: str(int(self.EPOCH + self.clock.time()))),
+            (r'date \+%s\.%N$', lambda device: '%.9f' % (self.EPOCH + self.clock.time())),
+        ]
+
+    def add_device(self, serial, packages=()):
+        """Connects a simulated device with the packages installed"""
+        self.device_states[serial] = SimulatedDevice(serial, packages)
+        return self.device_states[serial]
+
+    def device(self, serial):
+        if serial not in self.device_states:
+            raise IOError("device '%s' not found" % serial)
+        return self.device_states[serial]
+
+    def elapse(self, size=0, seconds=0.0):
+        """Advances the clock by a round trip, the transfer of size bytes and seconds on the device"""
+        self.clock.sleep(self.COMMAND_SECONDS + float(size) / self.TRANSFER_BYTES_PER_SECOND + seconds)
+
+    def latency(self, cmd):
+        for pattern, seconds in self.latencies:
+            if pattern.search(cmd):
+                return seconds
+        return 0.0
+
+    def version(self):
+        return 41
+
+    def devices(self):
+        return {i: serial for i, serial in enumerate(self.device_states)}
+
+    def shell(self, serial, cmd):
+        device = self.device(serial)
+        batch = self.BATCH_RE.findall(cmd)
+        self.elapse(seconds=sum(self.latency(command) for command, _ in batch) if batch else self.latency(cmd))
+        if batch:
+            return ''.join('%s\n%s\n' % (self.run(device, command), marker) for command, marker in batch)
+        return self.run(device, cmd)
+
+    def run(self, device, cmd):
+        """Returns the output of the commands separated by ';', like the shell of the device"""
+        for pattern, handler in self.scripts:
+            match = re.match(pattern, cmd)
+            if match:
+                return handler(device, *match.groups())
+        return '\n'.join(filter(None, (self.run_command(device, command.strip()) for command in cmd.split('; '))))
+
+    def run_command(self, device, cmd):
+        """Returns the output of a command, a pipe to grep, head or wc filters it like on the device"""
+        stages = cmd.split(' | ')
+        output = self.run_program(device, stages[0])
+        for stage in stages[1:]:
+            output = self.filter(stage, output)
+        return output
+
+    @staticmethod
+    def filter(stage, output):
+        args = shlex.split(stage)
+        lines = output.splitlines()
+        if args[0] == 'grep':
+            patterns = [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == '-e'] or args[-1:]
+            return '\n'.join(line for line in lines if any(re.search(pattern, line) for pattern in patterns))
+        if args[:2] == ['head', '-n']:
+            return '\n'.join(lines[:int(args[2])])
+        if args == ['wc', '-l']:
+            return str(len(lines))
+        return ''
+
+    def run_program(self, device, cmd):
+        for pattern, output in self.outputs:
+            if pattern.match(cmd):
+                return output
+        for pattern, handler in self.commands:
+            match = re.match(pattern, cmd)
+            if match:
+                return handler(device, *match.groups())
+        for pattern, output in self.CANNED_OUTPUTS:
+            if re.match(pattern, cmd):
+                return output
+        self.logger.debug('%s: "%s" is not simulated' % (device.serial, cmd))
+        return ''
+
+    def getprop(self, device, name=None):
+        if name is not None:
+            return SimulatedDevice.PROPERTIES.get(name, '')
+        return '\n'.join('[%s]: [%s]' % item for item in sorted(SimulatedDevice.PROPERTIES.items()))
+
+    def list_packages(self, device):
+        return '\n'.join('package:%s' % package for package in sorted(device.packages))
+
+    def install(self, device, remote):
+        if remote not in device.files:
+            return 'Failure [INSTALL_FAILED_INVALID_URI]'
+        # Like the experiments, assume the APK is named after its package
+        package = op.splitext(op.basename(remote))[0]
+        device.packages.add(package)
+        device.apk_hashes[package] = hashlib.md5(device.files[remote]).hexdigest()
+        return 'Success'
+
+    def apk_hash(self, device, package):
+        if package not in device.apk_hashes:
+            return 'md5sum: : No such file or directory'
+        return '%s  /data/app/%s-1/base.apk' % (device.apk_hashes[package], package)
+
+    def uninstall(self, device, package):
+        if package not in device.packages:
+            return 'Failure [DELETE_FAILED_INTERNAL_ERROR]'
+        self.force_stop(device, package)
+        device.packages.discard(package)
+        device.apk_hashes.pop(package, None)
+        return 'Success'
+
+    def launch_package(self, device, package):
+        if package not in device.packages:
+            return '** No activities found to run, monkey aborted.'
+        return self.launch_activity(device, package, '%s.MainActivity' % package)
+
+    def launch_activity(self, device, package, activity):
+        if package not in device.packages:
+            return 'Error: Activity not started, unable to resolve Intent'
+        device.running.add(package)
+        device.focused = (package, activity)
+        return 'Starting: Intent { cmp=%s/%s }' % (package, activity)
+
+    def force_stop(self, device, package):
+        device.running.discard(package)
+        if device.focused is not None and device.focused[0] == package:
+            device.focused = None
+        return ''
+
+    def pidof(self, device, package):
+        return '4242' if package in device.running else ''
+
+    def windows(self, device):
+        if device.focused is None:
+            return '  mCurrentFocus=null\n  mFocusedApp=null'
+        return '  mCurrentFocus=Window{1 u0 %s/%s}' % device.focused
+
+    def file_size(self, device, path):
+        return str(len(device.files[path])) if path in device.files else ''
+
+    def readable(self, device, path):
+        return 'readable' if path in device.files else ''
+
+    def remove(self, device, path):
+        device.files.pop(path, None)
+        return ''
+
+    def logcat(self, device, regex=None):
+        return '\n'.join(line for line in self.LOGCAT if regex is None or re.search(regex, line))
+
+    def su(self, device, cmd):
+        return self.run(device, ' '.join(shlex.split(cmd)))
+
+    def push(self, serial, local, remote):
+        with open(local, 'rb') as f:
+            self.push_stream(serial, iter(lambda: f.read(1024 * 1024), b''), remote)
+        return len(self.device(serial).files[remote])
+
+    def push_stream(self, serial, chunks, remote):
+        content = b''.join(chunks)
+        self.device(serial).files[remote] = content
+        self.elapse(len(content))
+
+    def pull(self, serial, remote, local):
+        size = 0
+        with open(local, 'wb') as f:
+            for chunk in self.pull_stream(serial, remote):
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    def pull_stream(self, serial, remote):
+        device = self.device(serial)
+        if remote not in device.files:
+            raise IOError('%s: No such file or directory' % remote)
+        self.elapse(len(device.files[remote]))
+        yield device.files[remote]
@@ -10,6 +10,12 @@ def is_integer(number, minimum=0):
     return number
 
 
+def is_boolean(value):
+    if not isinstance(value, bool):
+        raise ConfigError('%s is not true or false' % value)
+    return value
+
+
 def is_string(string):
     if not isinstance(string, str):
         raise ConfigError('String expected, got %s' % type(string))
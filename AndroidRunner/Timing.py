@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Phase(object):
+    """A timed phase of a run, parent is the phase that was running when it started"""
+
+    def __init__(self, name, parent=None, start=0.0):
+        self.name = name
+        self.parent = parent
+        # Seconds since the start of the run
+        self.start = start
+        self.duration = None
+
+    def to_dict(self):
+        return OrderedDict([('phase', self.name), ('parent', self.parent or ''), ('start', '%.6f' % self.start),
+                            ('duration', '%.6f' % self.duration)])
+
+
+class RunTimings(object):
+    """The phases of one run in order of start"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self.running = []
+
+    def begin(self, name):
+        phase = Phase(name, self.running[-1].name if self.running else None, time.perf_counter() - self.start)
+        self.phases.append(phase)
+        self.running.append(phase)
+        return phase
+
+    def end(self, phase):
+        if phase in self.running:
+            self.running.remove(phase)
+
+
+class Summary(object):
+    """Number of runs and total, minimum and maximum seconds of every phase, in order of first occurrence"""
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    def add(self, durations):
+        """Adds the (phase, seconds) of a run, a phase that occurred more than once in the run counts once"""
+        run = OrderedDict()
+        for name, duration in durations:
+            run[name] = run.get(name, 0.0) + duration
+        for name, duration in run.items():
+            runs, total, minimum, maximum = self.phases.get(name, (0, 0.0, duration, duration))
+            self.phases[name] = (runs + 1, total + duration, min(minimum, duration), max(maximum, duration))
+
+    def merge(self, other):
+        """Adds the runs of another summary, e.g. of a parallel device worker"""
+        for name, (runs, total, minimum, maximum) in other.phases.items():
+            if name in self.phases:
+                own_runs, own_total, own_minimum, own_maximum = self.phases[name]
+                runs, total = runs + own_runs, total + own_total
+                minimum, maximum = min(minimum, own_minimum), max(maximum, own_maximum)
+            self.phases[name] = (runs, total, minimum, maximum)
+
+    def to_rows(self):
+        return [OrderedDict([('phase', name), ('runs', runs), ('total', '%.6f' % total),
+                             ('mean', '%.6f' % (total / runs)), ('min', '%.6f' % minimum), ('max', '%.6f' % maximum)])
+                for name, (runs, total, minimum, maximum) in self.phases.items()]
+
+
+# Timings of the run that is executed by this process, None between runs
+current = None
+# Phases of the runs finished in this process, the parent of parallel device workers adds the runs they report
+summary = Summary()
+
+
+def start_run():
+    global current
+    current = RunTimings()
+    return current
+
+
+def end_run():
+    """Returns the timings of the finished run and adds them to the summary"""
+    global current
+    timings, current = current, None
+    if timings is None:
+        return RunTimings()
+    summary.add(durations(timings))
+    return timings
+
+
+def durations(timings):
+    """Returns the (phase, seconds) of the finished phases, to report them to another process"""
+    return [(phase.name, phase.duration) for phase in timings.phases if phase.duration is not None]
+
+
+@contextmanager
+def measure(name):
+    """Times the phase as part of the current run, yields the Phase that has its duration once the block finished"""
+    timings = current
+    phase = timings.begin(name) if timings is not None else Phase(name)
+    start = time.perf_counter()
+    try:
+        yield phase
+    finally:
+        phase.duration = time.perf_counter() - start
+        if timings is not None:
+            timings.end(phase)
@@ -0,0 +1,90 @@
+import logging
+import time
+
+from . import Timing
+from .Adb import AdbError
+
+logger = logging.getLogger(__name__)
+
+# Seconds before a wait gives up, a wait that timed out logs a warning and the run continues like it did after a sleep
+DEFAULT_TIMEOUT = 10
+# Seconds between two checks of a condition
+DEFAULT_INTERVAL = 0.2
+
+# Source of time() and sleep(), a dry run replaces it by the virtual clock of the simulator
+clock = time
+
+
+def until(condition, description, timeout=DEFAULT_TIMEOUT, interval=DEFAULT_INTERVAL, phase='wait.until'):
+    """Checks condition until it returns True or timeout seconds passed, returns if the condition was met.
+
+    The wait is timed as a phase of the current run, so the run timings show how long the run actually waited.
+    """
+    start = clock.time()
+    with Timing.measure(phase):
+        while True:
+            try:
+                satisfied = bool(condition())
+            except AdbError as e:
+                # E.g. the focused window can't be parsed while an activity is starting
+                logger.debug('%s: %s' % (description, e))
+                satisfied = False
+            duration = clock.time() - start
+            if satisfied or duration >= timeout:
+                break
+            clock.sleep(interval)
+    if satisfied:
+        logger.debug('%s after %.2fs' % (description, duration))
+    else:
+        logger.warning('%s: not met within %ss, continuing' % (description, timeout))
+    return satisfied
+
+
+def sleep(seconds, description):
+    """Waits a fixed number of seconds, for the cases without a condition to check"""
+    logger.debug('%s: sleeping %.2fs' % (description, seconds))
+    with Timing.measure('wait.sleep'):
+        clock.sleep(seconds)
+
+
+def activity_focused(device, package, **kwargs):
+    """Waits until an activity of the package is in the foreground"""
+    return until(lambda: device.current_activity() == package, '%s: %s focused' % (device.id, package),
+                 phase='wait.activity_focused', **kwargs)
+
+
+def process_started(device, package, **kwargs):
+    """Waits until a process of the package is running"""
+    return until(lambda: device.is_running(package), '%s: %s started' % (device.id, package),
+                 phase='wait.process_started', **kwargs)
+
+
+def process_gone(device, package, **kwargs):
+    """Waits until no process of the package is running anymore"""
+    return until(lambda: not device.is_running(package), '%s: %s stopped' % (device.id, package),
+                 phase='wait.process_gone', **kwargs)
+
+
+def file_exists(device, path, **kwargs):
+    """Waits until the file exists on the device"""
+    return until(lambda: device.file_size(path) is not None, '%s: %s exists' % (device.id, path),
+                 phase='wait.file_exists', **kwargs)
+
+
+def file_complete(device, path, interval=0.5, **kwargs):
+    """Waits until the file exists on the device and its size did not change between two checks"""
+    sizes = [None]
+
+    def size_unchanged():
+        size = device.file_size(path)
+        unchanged = size is not None and size == sizes[-1]
+        sizes.append(size)
+        return unchanged
+
+    return until(size_unchanged, '%s: %s written' % (device.id, path), interval=interval, phase='wait.file_complete',
+                 **kwargs)
+
+
+def broadcast_acknowledged(output):
+    """Checks the output of 'am broadcast', which returns after the receivers handled the broadcast"""
+    return 'Broadcast completed' in output
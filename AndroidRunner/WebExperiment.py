@@ -1,7 +1,6 @@
 import os.path as op
-import time
 
-from . import Tests
+from . import Tests, Waits
 import paths
 from .BrowserFactory import BrowserFactory
 from .Experiment import Experiment
@@ -20,13 +19,13 @@ class WebExperiment(Experiment):
         for browserItem in self.browsers:
             if browser_name in browserItem.to_string():
                 browser = browserItem
-        self.before_run(device, path, run, browser)
-        self.after_launch(device, path, run, browser)
-        self.start_profiling(device, path, run, browser)
-        self.interaction(device, path, run, browser)
-        self.stop_profiling(device, path, run, browser)
-        self.before_close(device, path, run, browser)
-        self.after_run(device, path, run, browser)
+        self.run_hook('before_run', device, path, run, browser)
+        self.run_hook('after_launch', device, path, run, browser)
+        self.run_hook('start_profiling', device, path, run, browser)
+        self.run_hook('interaction', device, path, run, browser)
+        self.run_hook('stop_profiling', device, path, run, browser)
+        self.run_hook('before_close', device, path, run, browser)
+        self.run_hook('after_run', device, path, run, browser)
 
     def last_run_subject(self, current_run):
         if self.progress.subject_finished(current_run['device'], current_run['path'], current_run['browser']):
@@ -48,21 +47,22 @@ class WebExperiment(Experiment):
         device.shell('logcat -c')
         browser = args[0]
         browser.start(device)
-        time.sleep(5)
+        Waits.activity_focused(device, browser.package_name)
 
     def interaction(self, device, path, run, *args, **kwargs):
         browser = args[0]
         browser.load_url(device, path)
-        time.sleep(5)
+        # adb has no signal for a finished page load
+        Waits.sleep(5, '%s: %s loading' % (device.id, path))
         super(WebExperiment, self).interaction(device, path, run, *args, **kwargs)
 
         # TODO: Fix web experiments running longer than self.duration
-        time.sleep(self.duration)
+        Waits.sleep(self.duration, '%s: duration' % device.id)
 
     def after_run(self, device, path, run, *args, **kwargs):
         browser = args[0]
         browser.stop(device, clear_data=True)
-        time.sleep(3)
+        Waits.process_gone(device, browser.package_name)
         super(WebExperiment, self).after_run(device, path, run)
 
     def after_last_run(self, device, path, *args, **kwargs):
@@ -1,4 +1,6 @@
+import codecs
 import errno
+import hashlib
 import json
 import os
 import re
@@ -6,6 +8,8 @@ from collections import OrderedDict
 from slugify import slugify
 import csv
 
+from . import Manifest
+
 
 class ConfigError(Exception):
     pass
@@ -21,10 +25,32 @@ class FileFormatError(Exception):
 
 def write_to_file(filename, rows):
     with open(filename, 'w', encoding='utf-8') as f:
+        Manifest.register(filename)
         writer = csv.DictWriter(f, list(rows[0].keys()))
         writer.writeheader()
         writer.writerows(rows)
 
+def iter_lines(chunks, encoding='utf-8'):
+    """Decodes an iterator of chunks of bytes and yields its lines as soon as they are complete"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def file_md5(path, chunk_size=1024 * 1024):
+    """Returns the MD5 hex digest of the binary content of a file"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
 def load_json(path):
     """Load a JSON file from path, and returns an ordered dictionary or throws exceptions on formatting errors"""
     try:
@@ -46,13 +72,20 @@ def list_subdir(a_dir):
             if os.path.isdir(os.path.join(a_dir, name))]
 
 def makedirs(path):
-    """Create a directory on path if it does not exist"""
+    """Create a directory on path if it does not exist, the created directories are registered in the run manifest"""
+    created = []
+    parent = os.path.abspath(path)
+    while not os.path.exists(parent) and parent not in created:
+        created.append(parent)
+        parent = os.path.dirname(parent)
     # https://stackoverflow.com/a/5032238
     try:
         os.makedirs(path)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
+    for directory in reversed(created):
+        Manifest.register(directory)
 
 
 # noinspection PyTypeChecker
@@ -1,10 +1,13 @@
 import argparse
 import logging
 import os.path as op
+import shutil
 import sys
+import tempfile
 import time
 
 import paths
+from AndroidRunner.DryRun import DryRun
 from AndroidRunner.ExperimentFactory import ExperimentFactory
 from AndroidRunner.Progress import Progress
 from AndroidRunner.util import makedirs
@@ -12,6 +15,9 @@ from AndroidRunner.util import makedirs
 
 def main():
     args = parse_arguments(sys.argv[1:])
+    if args.get('dry_run'):
+        dry_run(args)
+        return
     progress, log_dir = set_progress(args)
     config_file = op.abspath(args['file'])
     setup_paths(config_file, log_dir)
@@ -38,6 +44,20 @@ def main():
                      '--progress {}'.format(progress_file))
 
 
+def dry_run(args):
+    """Prints the schedule and the estimated duration of the experiment, executed on simulated devices"""
+    config_file = op.abspath(args['file'])
+    # The results of the simulated runs are thrown away, they don't belong with the output of real experiments
+    log_dir = tempfile.mkdtemp()
+    setup_paths(config_file, log_dir)
+    try:
+        estimate = DryRun(config_file, progress_file=args.get('progress'))
+        estimate.run()
+        print(estimate.report())
+    finally:
+        shutil.rmtree(log_dir)
+
+
 def set_progress(args):
     config_file = op.abspath(args['file'])
     if not args.get('progress') is None:
@@ -53,6 +73,8 @@ def parse_arguments(args):
     parser = argparse.ArgumentParser()
     parser.add_argument('file')
     parser.add_argument('--progress', default=argparse.SUPPRESS)
+    parser.add_argument('--dry-run', action='store_true', default=argparse.SUPPRESS,
+                        help='print the schedule and the estimated duration without using the devices')
     return vars(parser.parse_args(args))
 
 
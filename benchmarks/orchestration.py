@@ -0,0 +1,127 @@
+"""Time spent by android-runner itself in every phase of a run, measured on simulated devices.
+
+Usage: python benchmarks/orchestration.py [replications]
+
+A native and a web experiment with the android profiler and a Python interaction script run on two devices of the
+'simulated' adb backend. The devices answer immediately and every sleep or wait of the experiment advances a virtual
+clock, so the wall-clock time of a phase is the overhead of Experiment, Progress, Profilers, PluginHandler and the
+scripts. The simulated column is the time the phase would take on the devices with the latencies below, it shows
+where a real run spends its time and that a change did not add adb commands.
+"""
+import json
+import os.path as op
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+import paths  # noqa: E402
+from AndroidRunner import Adb, Simulator, Waits  # noqa: E402
+from AndroidRunner.ExperimentFactory import ExperimentFactory  # noqa: E402
+from AndroidRunner.util import makedirs  # noqa: E402
+
+DEVICES = {'device1': 'simulated1', 'device2': 'simulated2'}
+# Seconds a command takes on a mid-range phone, on top of the adb round trip
+LATENCIES = [(r'^pm (install|uninstall)', 2.0), (r'^monkey', 0.5), (r'^am start', 0.4), (r'^pm clear', 0.3),
+             (r'^am force-stop', 0.1), (r'^dumpsys batterystats', 0.8), (r'^dumpsys (cpuinfo|meminfo)', 0.3),
+             (r'^dumpsys window', 0.1), (r'^logcat', 0.1)]
+# Methods of the experiment that are timed, none of them calls another
+PHASES = ['prepare_run', 'before_run', 'start_profiling', 'interaction', 'stop_profiling', 'after_run', 'finish_run',
+          'save_progress', 'finish_experiment']
+
+
+class PhaseTimer(object):
+    """Replaces the phases of an experiment by wrappers that add up their wall-clock and simulated time"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.wall = Counter()
+        self.simulated = Counter()
+
+    def wrap(self, experiment, phase):
+        method = getattr(experiment, phase)
+
+        def timed(*args, **kwargs):
+            start, simulated_start = time.perf_counter(), self.clock.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.wall[phase] += time.perf_counter() - start
+                self.simulated[phase] += self.clock.time() - simulated_start
+
+        setattr(experiment, phase, timed)
+
+
+def write_config(config_dir, experiment_type, replications):
+    with open(op.join(config_dir, 'devices.json'), 'w') as f:
+        json.dump(DEVICES, f)
+    with open(op.join(config_dir, 'interaction.py'), 'w') as f:
+        f.write('def main(device, *args, **kwargs):\n    pass\n')
+    config = {'type': experiment_type, 'adb_backend': 'simulated', 'devices': {name: {} for name in DEVICES},
+              'devices_spec': op.join(config_dir, 'devices.json'), 'replications': replications,
+              'duration': 10000, 'time_between_run': 1000,
+              'profilers': {'android': {'sample_interval': 100, 'data_points': ['cpu', 'mem']}},
+              'scripts': {'interaction': 'interaction.py'}}
+    if experiment_type == 'native':
+        config['paths'] = []
+        for package in ['com.example.app1', 'com.example.app2']:
+            config['paths'].append(op.join(config_dir, '%s.apk' % package))
+            with open(config['paths'][-1], 'wb') as f:
+                f.write(b'\0' * 1024 * 1024)
+    else:
+        config['paths'] = ['https://example.com/', 'https://example.org/']
+        config['browsers'] = ['chrome']
+    config_file = op.join(config_dir, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    return config_file
+
+
+def measure(experiment_type, replications):
+    config_dir = tempfile.mkdtemp()
+    try:
+        config_file = write_config(config_dir, experiment_type, replications)
+        paths.CONFIG_DIR = config_dir
+        paths.OUTPUT_DIR = paths.BASE_OUTPUT_DIR = op.join(config_dir, 'output')
+        clock = Simulator.Clock()
+        Waits.clock = clock
+        client = Simulator.SimulatedAdbClient(clock, latencies=LATENCIES)
+        for serial in DEVICES.values():
+            client.add_device(serial, ['com.android.chrome'])
+        Adb.inject_client(client)
+        makedirs(paths.OUTPUT_DIR)
+        timer = PhaseTimer(clock)
+        start = time.perf_counter()
+        experiment = ExperimentFactory.from_json(config_file, None)
+        timer.wall['setup'] = time.perf_counter() - start
+        timer.simulated['setup'] = clock.time()
+        for phase in PHASES:
+            timer.wrap(experiment, phase)
+        start, simulated_start = time.perf_counter(), clock.time()
+        experiment.start()
+        total, simulated_total = time.perf_counter() - start, clock.time() - simulated_start
+        timer.wall['other'] = total - sum(timer.wall[phase] for phase in PHASES)
+        timer.simulated['other'] = simulated_total - sum(timer.simulated[phase] for phase in PHASES)
+        return timer
+    finally:
+        shutil.rmtree(config_dir)
+
+
+def main(replications):
+    runs = len(DEVICES) * 2 * replications
+    for experiment_type in ['native', 'web']:
+        timer = measure(experiment_type, replications)
+        print('%s experiment, %d runs' % (experiment_type, runs))
+        print('%-18s %16s %18s' % ('phase', 'wall (ms/run)', 'simulated (s/run)'))
+        for phase in ['setup'] + PHASES + ['other']:
+            print('%-18s %16.2f %18.2f' % (phase, timer.wall[phase] * 1000 / runs, timer.simulated[phase] / runs))
+        print('%-18s %16.2f %18.2f' % ('total', sum(timer.wall.values()) * 1000 / runs,
+                                       sum(timer.simulated.values()) / runs))
+        print('')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,117 @@
+"""Startup time and peak memory of the experiment progress as the number of runs grows.
+
+Usage: python benchmarks/progress.py [devices ...]
+
+Every size is a web experiment of 200 URLs, 3 browsers and 30 replications on the given number of devices, up to the
+20 devices (360000 runs) of the largest experiments. The progress is created from the configuration, written to
+progress.xml and resumed from that file. For comparison, 'legacy' builds the <runsToRun> element like the original
+implementation: concatenated strings parsed by lxml, which were also queried with XPath for every run.
+
+Every step runs in a forked process, the memory column is the growth of its peak resident set size (Linux only).
+"""
+import json
+import multiprocessing as mp
+import os
+import os.path as op
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import lxml.etree as et
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+import paths  # noqa: E402
+from AndroidRunner.Progress import Progress  # noqa: E402
+
+
+def web_config(devices):
+    return {'type': 'web', 'devices': ['device%d' % i for i in range(devices)],
+            'paths': ['https://example.com/page%d' % i for i in range(200)],
+            'browsers': ['chrome', 'firefox', 'opera'], 'replications': 30}
+
+
+class UnsavedProgress(Progress):
+    """Progress that is not written when it is created, so create measures building the runs only"""
+
+    def write_progress_to_file(self, unfinished=()):
+        pass
+
+
+def config_file():
+    return op.join(paths.OUTPUT_DIR, 'config.json')
+
+
+def create(config):
+    return UnsavedProgress(config_file=config_file(), config=config)
+
+
+def resume(config):
+    return Progress(progress_file=op.join(paths.OUTPUT_DIR, 'progress.xml'), config_file=config_file(),
+                    load_progress=True)
+
+
+def legacy(config):
+    runs_xml = ''
+    run_id = 0
+    for device in config['devices']:
+        for path in config['paths']:
+            for browser in config['browsers']:
+                subject_xml = '<device>{}</device><path>{}</path><browser>{}</browser>'.format(device, path, browser)
+                for run in range(config['replications']):
+                    runs_xml = runs_xml + '<run runId="{}">{}<runCount>{}</runCount></run>'. \
+                        format(run_id, subject_xml, run + 1)
+                    run_id += 1
+    return et.fromstring('<runsToRun>{}</runsToRun>'.format(runs_xml))
+
+
+def resident_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+
+
+def measure_step(connection, step, config):
+    """Runs the step in this (forked) process and sends its seconds and memory growth in MB"""
+    if step == 'write':
+        progress = create(config)
+    baseline = resident_mb()
+    start = time.perf_counter()
+    if step == 'write':
+        Progress.write_progress_to_file(progress)
+    else:
+        result = globals()[step](config)  # noqa: F841, the result must be alive when the peak is read
+    duration = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    connection.send((duration, max(peak - baseline, 0.0)))
+
+
+def measure(step, config):
+    context = mp.get_context('fork')
+    parent, child = context.Pipe()
+    process = context.Process(target=measure_step, args=(child, step, config))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return '%8.2f / %7.1f' % result
+
+
+def main(device_counts):
+    paths.OUTPUT_DIR = tempfile.mkdtemp()
+    print('%8s %18s %18s %18s %18s' % ('runs', 'create (s / MB)', 'write (s / MB)', 'resume (s / MB)',
+                                        'legacy (s / MB)'))
+    try:
+        for devices in device_counts:
+            config = web_config(devices)
+            with open(config_file(), 'w') as f:
+                json.dump(config, f)
+            runs = devices * len(config['paths']) * len(config['browsers']) * config['replications']
+            print('%8d %s %s %s %s' % (runs, measure('create', config), measure('write', config),
+                                       measure('resume', config), measure('legacy', config)))
+    finally:
+        shutil.rmtree(paths.OUTPUT_DIR)
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1, 2, 5, 10, 20])
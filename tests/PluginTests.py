@@ -18,7 +18,7 @@ class PluginTests(object):
         self.errors = []
         self.config = config
         adb_path = config.get('adb_path', 'adb')
-        self.devices = Devices(config['devices'], adb_path=adb_path)
+        self.devices = Devices(config['devices'], adb_path=adb_path, adb_backend=config.get('adb_backend', 'adb'))
         self.profilers = None
         self.output_root = paths.OUTPUT_DIR
         self.result_file = os.path.join(self.output_root, 'Test_results.txt')
@@ -0,0 +1,166 @@
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import threading
+
+
+# noinspection PyMethodMayBeStatic
+class FakeAdbServer(object):
+    """Local stand-in for the adb server, speaks the host protocol without a device.
+
+    Shell commands are executed with the local /bin/sh, files of the sync service are kept in memory.
+    """
+
+    def __init__(self, serials=('fake_serial',), version=41, features=('shell_v2', 'cmd')):
+        self.serials = list(serials)
+        self.version = version
+        self.features = list(features)
+        self.files = {}
+        self.requests = []
+        self.server = None
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        fake = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                fake.handle(self.request)
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def recv_exactly(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def read_request(self, sock):
+        length = int(self.recv_exactly(sock, 4), 16)
+        request = self.recv_exactly(sock, length).decode('utf-8')
+        self.requests.append(request)
+        return request
+
+    @staticmethod
+    def okay(sock, payload=None):
+        sock.sendall(b'OKAY')
+        if payload is not None:
+            payload = payload.encode('utf-8')
+            sock.sendall(('%04x' % len(payload)).encode('ascii') + payload)
+
+    @staticmethod
+    def fail(sock, message):
+        message = message.encode('utf-8')
+        sock.sendall(b'FAIL' + ('%04x' % len(message)).encode('ascii') + message)
+
+    def handle(self, sock):
+        try:
+            request = self.read_request(sock)
+            if request == 'host:version':
+                self.okay(sock, '%04x' % self.version)
+            elif request == 'host:devices':
+                self.okay(sock, ''.join('%s\tdevice\n' % serial for serial in self.serials))
+            elif request.startswith('host-serial:') and request.endswith(':features'):
+                if request[len('host-serial:'):-len(':features')] not in self.serials:
+                    self.fail(sock, 'device not found')
+                    return
+                self.okay(sock, ','.join(self.features))
+            elif request.startswith('host:transport:'):
+                if request[len('host:transport:'):] not in self.serials:
+                    self.fail(sock, 'device not found')
+                    return
+                self.okay(sock)
+                self.handle_service(sock, self.read_request(sock))
+            else:
+                self.fail(sock, 'unknown host service')
+        except EOFError:
+            pass
+
+    def handle_service(self, sock, service):
+        if service.startswith('shell:'):
+            self.okay(sock)
+            self.shell(sock, service[len('shell:'):])
+        elif service == 'sync:':
+            self.okay(sock)
+            self.sync(sock)
+        else:
+            self.fail(sock, 'unknown service')
+
+    def shell(self, sock, cmd):
+        process = subprocess.Popen(['/bin/sh', '-c', cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+
+        def forward_stdin():
+            try:
+                while True:
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    process.stdin.write(data)
+                    process.stdin.flush()
+            except (IOError, OSError, ValueError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except (IOError, OSError):
+                    pass
+
+        threading.Thread(target=forward_stdin, daemon=True).start()
+        for chunk in iter(lambda: process.stdout.read1(4096), b''):
+            sock.sendall(chunk)
+        process.wait()
+        sock.shutdown(socket.SHUT_RDWR)
+
+    def sync(self, sock):
+        while True:
+            sync_id = self.recv_exactly(sock, 4)
+            length = struct.unpack('<I', self.recv_exactly(sock, 4))[0]
+            path = self.recv_exactly(sock, length).decode('utf-8')
+            if sync_id == b'QUIT':
+                return
+            elif sync_id == b'STAT':
+                if path in self.files:
+                    sock.sendall(b'STAT' + struct.pack('<III', stat.S_IFREG | 0o644, len(self.files[path]), 0))
+                else:
+                    sock.sendall(b'STAT' + struct.pack('<III', 0, 0, 0))
+            elif sync_id == b'RECV':
+                if path not in self.files:
+                    message = b'No such file or directory'
+                    sock.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+                    continue
+                content = self.files[path]
+                for i in range(0, len(content), 1000):
+                    chunk = content[i:i + 1000]
+                    sock.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+                sock.sendall(b'DONE' + struct.pack('<I', 0))
+            elif sync_id == b'SEND':
+                remote = path.rsplit(',', 1)[0]
+                content = b''
+                while True:
+                    data_id = self.recv_exactly(sock, 4)
+                    data_length = struct.unpack('<I', self.recv_exactly(sock, 4))[0]
+                    if data_id == b'DONE':
+                        break
+                    content += self.recv_exactly(sock, data_length)
+                self.files[remote] = content
+                sock.sendall(b'OKAY' + struct.pack('<I', 0))
@@ -0,0 +1,231 @@
+import os
+import os.path as op
+
+import pytest
+from mock import patch
+
+import AndroidRunner.Adb as Adb
+from AndroidRunner.AdbClient import AdbClient, AdbClientError
+from AndroidRunner.ShellSession import ShellSession
+from tests.unit.fixtures.FakeAdbServer import FakeAdbServer
+
+
+class TestAdbClient(object):
+    @pytest.fixture()
+    def server(self):
+        fake_server = FakeAdbServer(serials=['serial1', 'serial2']).start()
+        yield fake_server
+        fake_server.stop()
+
+    @pytest.fixture()
+    def client(self, server):
+        return AdbClient(port=server.port)
+
+    def test_init_default(self):
+        with patch.dict(os.environ, {}, clear=True):
+            client = AdbClient()
+        assert client.host == 'localhost'
+        assert client.port == 5037
+
+    def test_init_port_from_environment(self):
+        with patch.dict(os.environ, {'ANDROID_ADB_SERVER_PORT': '5038'}):
+            client = AdbClient()
+        assert client.port == 5038
+
+    def test_connect_refused(self, server):
+        port = server.port
+        server.stop()
+        with pytest.raises(AdbClientError):
+            AdbClient(port=port).version()
+
+    def test_version(self, client):
+        assert client.version() == 41
+
+    def test_devices(self, client):
+        assert client.devices() == {0: 'serial1', 1: 'serial2'}
+
+    def test_features(self, client, server):
+        assert client.features('serial1') == {'shell_v2', 'cmd'}
+        assert server.requests[-1] == 'host-serial:serial1:features'
+        server.features = []
+        assert client.features('serial1') == set()
+        with pytest.raises(AdbClientError):
+            client.features('unknown')
+
+    def test_transport_unknown_device(self, client):
+        with pytest.raises(AdbClientError) as except_result:
+            client.shell('unknown', 'echo test')
+        assert 'device not found' in str(except_result.value)
+
+    def test_shell(self, client, server):
+        assert client.shell('serial1', 'echo hello; echo world') == 'hello\nworld\n'
+        assert server.requests[-2:] == ['host:transport:serial1', 'shell:echo hello; echo world']
+
+    def test_shell_stream(self, client):
+        chunks = list(client.shell_stream('serial1', 'seq 1 20000', chunk_size=1024))
+        assert len(chunks) > 1
+        assert b''.join(chunks).decode().split() == [str(i) for i in range(1, 20001)]
+
+    def test_stat(self, client, server):
+        server.files['/sdcard/file.txt'] = b'12345'
+        mode, size, _ = client.stat('serial1', '/sdcard/file.txt')
+        assert mode != 0
+        assert size == 5
+        assert client.stat('serial1', '/sdcard/missing.txt') == (0, 0, 0)
+
+    def test_pull_stream(self, client, server):
+        server.files['/sdcard/big.csv'] = b'x' * 5000
+        chunks = list(client.pull_stream('serial1', '/sdcard/big.csv'))
+        assert len(chunks) == 5
+        assert b''.join(chunks) == b'x' * 5000
+
+    def test_pull_missing_file(self, client):
+        with pytest.raises(AdbClientError) as except_result:
+            list(client.pull_stream('serial1', '/sdcard/missing.txt'))
+        assert 'No such file or directory' in str(except_result.value)
+
+    def test_pull_to_directory(self, client, server, tmpdir):
+        server.files['/sdcard/trepn/result.csv'] = b'a,b\n1,2\n'
+        size = client.pull('serial1', '/sdcard/trepn/result.csv', str(tmpdir))
+        assert size == 8
+        with open(op.join(str(tmpdir), 'result.csv'), 'rb') as f:
+            assert f.read() == b'a,b\n1,2\n'
+
+    def test_pull_to_file(self, client, server, tmpdir):
+        server.files['/mnt/sdcard/logcat.txt'] = b'log'
+        local = op.join(str(tmpdir), 'logcat_local.txt')
+        client.pull('serial1', '/mnt/sdcard/logcat.txt', local)
+        with open(local, 'rb') as f:
+            assert f.read() == b'log'
+
+    def test_push_file(self, client, server, tmpdir):
+        local = op.join(str(tmpdir), 'app.apk')
+        with open(local, 'wb') as f:
+            f.write(b'\x00' * (AdbClient.SYNC_DATA_MAX + 10))
+        size = client.push('serial1', local, '/data/local/tmp/')
+        assert size == AdbClient.SYNC_DATA_MAX + 10
+        assert server.files['/data/local/tmp/app.apk'] == b'\x00' * (AdbClient.SYNC_DATA_MAX + 10)
+
+    def test_push_directory(self, client, server, tmpdir):
+        local_dir = op.join(str(tmpdir), 'trepn.pref')
+        os.makedirs(op.join(local_dir, 'sub'))
+        with open(op.join(local_dir, 'a.xml'), 'w') as f:
+            f.write('a')
+        with open(op.join(local_dir, 'sub', 'b.xml'), 'w') as f:
+            f.write('b')
+        client.push('serial1', local_dir + '/', '/sdcard/trepn/saved_preferences/')
+        assert server.files == {'/sdcard/trepn/saved_preferences/trepn.pref/a.xml': b'a',
+                                '/sdcard/trepn/saved_preferences/trepn.pref/sub/b.xml': b'b'}
+
+    def test_shell_session_over_server(self, client):
+        session = ShellSession('serial1', client=client)
+        try:
+            assert session.run('echo one') == ('one\n', 0)
+            assert session.run('false') == ('', 1)
+            socket = session.socket
+            assert session.run('printf two') == ('two', 0)
+            assert session.socket is socket
+        finally:
+            session.close()
+        assert session.socket is None
+
+
+class TestAdbServerBackend(object):
+    @pytest.fixture()
+    def server(self):
+        fake_server = FakeAdbServer(serials=['serial1']).start()
+        with patch.dict(os.environ, {'ANDROID_ADB_SERVER_PORT': str(fake_server.port)}):
+            with patch('AndroidRunner.Adb.ADB') as adb:
+                adb.return_value._ADB__error = None
+                Adb.setup('adb', backend='server')
+            yield fake_server
+        Adb.client = None
+        fake_server.stop()
+
+    def test_setup_unknown_backend(self):
+        with pytest.raises(Adb.AdbError):
+            Adb.setup('adb', backend='unknown')
+
+    @patch('AndroidRunner.Adb.ADB')
+    def test_setup_starts_server(self, adb):
+        adb.return_value._ADB__error = None
+        with patch('AndroidRunner.Adb.AdbClient') as client:
+            client.return_value.version.side_effect = [AdbClientError('refused'), 41]
+            Adb.setup('adb', backend='server')
+        adb.return_value.start_server.assert_called_once()
+        assert client.return_value.version.call_count == 2
+        Adb.client = None
+
+    def test_setup(self, server):
+        assert isinstance(Adb.client, AdbClient)
+        assert server.requests == ['host:version']
+
+    def test_connect(self, server):
+        Adb.connect('serial1')
+        with pytest.raises(Adb.ConnectionError):
+            Adb.connect('serial2')
+
+    @pytest.fixture()
+    def handle(self, server):
+        return Adb.get_handle('serial1', persistent_shell=False)
+
+    def test_get_handle(self, server):
+        handle = Adb.get_handle('serial1')
+        assert handle.client is Adb.client
+        assert handle.session.client is Adb.client
+
+    def test_shell(self, handle):
+        assert handle.shell('echo result') == 'result'
+        with pytest.raises(Adb.AdbError):
+            handle.shell('echo error')
+
+    def test_shell_su(self, server, handle):
+        handle.shell_su('true')
+        assert server.requests[-1] == "shell:su -c 'true'"
+
+    def test_shell_session(self, server):
+        handle = Adb.get_handle('serial1')
+        try:
+            assert handle.shell('echo session') == 'session'
+            assert handle.session.socket is not None
+        finally:
+            handle.close()
+
+    def test_list_apps(self, server, handle):
+        handle.list_apps()
+        assert server.requests[-1] == 'shell:pm list packages'
+
+    def test_install(self, server, handle, tmpdir):
+        apk = op.join(str(tmpdir), 'com.app.apk')
+        with open(apk, 'wb') as f:
+            f.write(b'apk')
+        handle.install(apk)
+        assert server.files['/data/local/tmp/com.app.apk'] == b'apk'
+        assert server.requests[-1] == 'shell:pm install -r -g /data/local/tmp/com.app.apk; ' \
+                                      'rm -f /data/local/tmp/com.app.apk'
+
+    def test_uninstall(self, server, handle):
+        with pytest.raises(Adb.AdbError):
+            handle.uninstall('com.app', keep_data=True)
+        assert server.requests[-1] == 'shell:pm uninstall -k com.app'
+
+    def test_push_pull(self, handle, tmpdir):
+        local = op.join(str(tmpdir), 'file.txt')
+        with open(local, 'w') as f:
+            f.write('content')
+        assert handle.push(local, '/sdcard/file.txt') == '7 bytes pushed'
+        os.remove(local)
+        assert handle.pull('/sdcard/file.txt', local) == '7 bytes pulled'
+        with open(local, 'r') as f:
+            assert f.read() == 'content'
+
+    def test_push_pull_stream(self, server, handle):
+        handle.push_stream(iter([b'x' * 70000, b'y']), '/sdcard/big.bin')
+        assert server.files['/sdcard/big.bin'] == b'x' * 70000 + b'y'
+        assert b''.join(handle.pull_stream('/sdcard/big.bin')) == b'x' * 70000 + b'y'
+        with pytest.raises(Adb.AdbError):
+            list(handle.pull_stream('/sdcard/missing.bin'))
+
+    def test_logcat(self, server, handle):
+        handle.logcat(regex='test')
+        assert server.requests[-1] == 'shell:logcat -d -e test'
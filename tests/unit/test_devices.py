@@ -1,11 +1,16 @@
+import io
+import multiprocessing as mp
 import os
+import subprocess
 
 import pytest
 from mock import MagicMock, Mock, call, patch
 
 import AndroidRunner.Adb as Adb
 from AndroidRunner.Device import Device
+from AndroidRunner.DeviceInfo import DeviceInfo
 from AndroidRunner.Devices import Devices
+from AndroidRunner.ShellSession import ShellSession, ShellSessionError
 from AndroidRunner.util import ConfigError
 
 
@@ -49,21 +54,48 @@ class TestDevice(object):
         assert device.root_unplug is True
         adb_connect.assert_called_once_with(device_id)
 
-    @patch('AndroidRunner.Adb.shell')
-    def test_get_version(self, adb_shell, device):
-        adb_shell.return_value = 9
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_get_version(self, adb_raw_shell, device):
+        adb_raw_shell.return_value = '[ro.build.version.release]: [9]\n[ro.build.version.sdk]: [28]\n'
         version = device.get_version()
 
-        assert version == 9
-        adb_shell.assert_called_once_with(123456789, 'getprop ro.build.version.release')
+        assert version == '9'
+        adb_raw_shell.assert_called_once_with('getprop')
 
-    @patch('AndroidRunner.Adb.shell')
-    def test_get_api_level(self, adb_shell, device):
-        adb_shell.return_value = 28
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_get_api_level(self, adb_raw_shell, device):
+        adb_raw_shell.return_value = '[ro.build.version.release]: [9]\n[ro.build.version.sdk]: [28]\n'
         level = device.get_api_level()
 
         assert level == 28
-        adb_shell.assert_called_once_with(123456789, 'getprop ro.build.version.sdk')
+        adb_raw_shell.assert_called_once_with('getprop')
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_get_api_level_missing_in_dump(self, adb_raw_shell, device):
+        adb_raw_shell.side_effect = ['[ro.build.version.release]: [9]\n', '28\n']
+        level = device.get_api_level()
+
+        assert level == 28
+        assert adb_raw_shell.mock_calls == [call('getprop'), call('getprop ro.build.version.sdk')]
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_get_api_level_unknown(self, adb_raw_shell, device):
+        adb_raw_shell.side_effect = ['[ro.build.version.release]: [9]\n', '\n']
+
+        with pytest.raises(Adb.AdbError):
+            device.get_api_level()
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_get_info_cached(self, adb_raw_shell, device):
+        adb_raw_shell.return_value = '[ro.build.version.release]: [9]\n[ro.build.version.sdk]: [28]\n'
+
+        info = device.get_info()
+        device.get_version()
+        device.get_api_level()
+        str(device)
+
+        assert device.get_info() is info
+        adb_raw_shell.assert_called_once_with('getprop')
 
     @patch('AndroidRunner.Device.Device.get_app_list')
     def test_is_installed(self, get_app_list, device):
@@ -74,14 +106,43 @@ class TestDevice(object):
         assert 'app4' in result_installed and not result_installed['app4']
         assert 'installed_app' in result_installed and result_installed['installed_app']
 
-    @patch('AndroidRunner.Adb.list_apps')
+    @patch('AndroidRunner.Adb.AdbHandle.list_apps')
     def test_get_app_list(self, adb_list_apps, device):
         adb_list_apps.return_value = ['app1', 'app2', 'app3']
         app_list = device.get_app_list()
 
-        assert app_list == ['app1', 'app2', 'app3']
+        assert app_list == {'app1', 'app2', 'app3'}
 
-    @patch('AndroidRunner.Adb.install')
+    @patch('AndroidRunner.Adb.AdbHandle.list_apps')
+    def test_get_app_list_cached(self, adb_list_apps, device):
+        adb_list_apps.return_value = ['app1']
+
+        device.get_app_list()
+        device.is_installed(['app1', 'app2', 'app3'])
+        assert adb_list_apps.call_count == 1
+
+        adb_list_apps.return_value = ['app1', 'app2']
+        assert device.get_app_list(refresh=True) == {'app1', 'app2'}
+        assert adb_list_apps.call_count == 2
+
+    @patch('os.path.isfile')
+    @patch('AndroidRunner.Adb.AdbHandle.uninstall')
+    @patch('AndroidRunner.Adb.AdbHandle.install')
+    @patch('AndroidRunner.Adb.AdbHandle.list_apps')
+    def test_get_app_list_updated(self, adb_list_apps, adb_install, adb_uninstall, os_isfile, device):
+        adb_list_apps.side_effect = [['com.app.1'], ['com.app.1', 'com.app.real.package']]
+        adb_install.return_value = 'Performing Streamed Install\nSuccess'
+        os_isfile.return_value = True
+        device.get_app_list()
+
+        # The list is refreshed, the package of an APK need not match its filename
+        device.install('path/to/com.app.2.apk')
+        assert device.get_app_list() == {'com.app.1', 'com.app.real.package'}
+        device.uninstall('com.app.1')
+        assert device.get_app_list() == {'com.app.real.package'}
+        assert adb_list_apps.call_count == 2
+
+    @patch('AndroidRunner.Adb.AdbHandle.install')
     def test_install_file_not_exist(self, adb_install, device):
         with pytest.raises(Adb.AdbError):
             device.install('fake.apk')
@@ -89,45 +150,59 @@ class TestDevice(object):
         assert adb_install.call_count == 0
 
     @patch('os.path.isfile')
-    @patch('AndroidRunner.Adb.install')
+    @patch('AndroidRunner.Adb.AdbHandle.install')
     def test_install_file_exist(self, adb_install, os_isfile, device):
         os_isfile.return_value = True
 
         device.install('fake.apk')
 
-        adb_install.assert_called_once_with(123456789, 'fake.apk')
+        adb_install.assert_called_once_with('fake.apk')
+
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
+    def test_get_apk_hash(self, adb_shell, device):
+        adb_shell.return_value = 'd41d8cd98f00b204e9800998ecf8427e  /data/app/com.app-1/base.apk'
+
+        assert device.get_apk_hash('com.app') == 'd41d8cd98f00b204e9800998ecf8427e'
+        adb_shell.assert_called_once_with('apk=$(pm path com.app | head -n 1); md5sum "${apk#package:}"')
+
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
+    def test_get_apk_hash_unknown(self, adb_shell, device):
+        adb_shell.return_value = '/system/bin/sh: md5sum: not found'
+        assert device.get_apk_hash('com.app') is None
+        adb_shell.return_value = ''
+        assert device.get_apk_hash('com.app') is None
 
-    @patch('AndroidRunner.Adb.uninstall')
+    @patch('AndroidRunner.Adb.AdbHandle.uninstall')
     def test_uninstall(self, adb_uninstall, device):
         app_name = 'fake_app'
 
         device.uninstall(app_name)
 
-        adb_uninstall.assert_called_once_with(123456789, app_name)
+        adb_uninstall.assert_called_once_with(app_name)
 
     @patch('AndroidRunner.Device.Device.su_unplug')
     @patch('AndroidRunner.Device.Device.get_api_level')
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_unplug_api_lower_23_no_root(self, adb_shell, get_api_level, su_unplug, device):
         get_api_level.return_value = 22
         device.unplug(False)
 
         assert su_unplug.call_count == 0
-        adb_shell.assert_called_once_with(123456789, 'dumpsys battery set usb 0')
+        adb_shell.assert_called_once_with('dumpsys battery set usb 0')
 
     @patch('AndroidRunner.Device.Device.su_unplug')
     @patch('AndroidRunner.Device.Device.get_api_level')
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_unplug_api_higher_equal_23_no_root(self, adb_shell, get_api_level, su_unplug, device):
         get_api_level.return_value = 23
         device.unplug(False)
 
         assert su_unplug.call_count == 0
-        adb_shell.assert_called_once_with(123456789, 'dumpsys battery unplug')
+        adb_shell.assert_called_once_with('dumpsys battery unplug')
 
     @patch('AndroidRunner.Device.Device.su_unplug')
     @patch('AndroidRunner.Device.Device.get_api_level')
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_unplug_api_lower_23_root(self, adb_shell, get_api_level, su_unplug, device_root):
         get_api_level.return_value = 22
         device_root.unplug(False)
@@ -137,7 +212,7 @@ class TestDevice(object):
 
     @patch('AndroidRunner.Device.Device.su_unplug')
     @patch('AndroidRunner.Device.Device.get_api_level')
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_unplug_api_lower_23_root_restart(self, adb_shell, get_api_level, su_unplug, device_root):
         get_api_level.return_value = 22
         device_root.unplug(True)
@@ -147,7 +222,7 @@ class TestDevice(object):
 
     @patch('AndroidRunner.Device.Device.su_unplug')
     @patch('AndroidRunner.Device.Device.get_api_level')
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_unplug_api_higher_equal_23_root(self, adb_shell, get_api_level, su_unplug, device_root):
         get_api_level.return_value = 23
         device_root.unplug(False)
@@ -157,7 +232,7 @@ class TestDevice(object):
 
     @patch('AndroidRunner.Device.Device.su_unplug')
     @patch('AndroidRunner.Device.Device.get_api_level')
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_unplug_api_higher_equal_23_root_restart(self, adb_shell, get_api_level, su_unplug, device_root):
         get_api_level.return_value = 23
         device_root.unplug(True)
@@ -166,52 +241,52 @@ class TestDevice(object):
         assert adb_shell.call_count == 0
 
     @patch('AndroidRunner.Device.Device.check_plug_value')
-    @patch('AndroidRunner.Adb.shell_su')
+    @patch('AndroidRunner.Adb.AdbHandle.shell_su')
     def test_su_unplug_no_error(self, shell_su, check_plug_value, device_root):
         shell_su.side_effect = ['default_return', '']
 
         device_root.su_unplug(False)
 
-        expected_calls = [call(device_root.id, 'cat %s' % device_root.root_unplug_file),
-                          call(device_root.id, 'echo %s > %s' %
+        expected_calls = [call('cat %s' % device_root.root_unplug_file),
+                          call('echo %s > %s' %
                                (device_root.root_unplug_value, device_root.root_unplug_file))]
         assert shell_su.mock_calls == expected_calls
         assert device_root.root_plug_value == 'default_return'
         assert check_plug_value.call_count == 0
 
     @patch('AndroidRunner.Device.Device.check_plug_value')
-    @patch('AndroidRunner.Adb.shell_su')
+    @patch('AndroidRunner.Adb.AdbHandle.shell_su')
     def test_su_unplug_not_rooted(self, shell_su, check_plug_value, device_root):
         shell_su.side_effect = ['su: not found', 'default_return', 'No such file or directory']
         with pytest.raises(Adb.AdbError):
             device_root.su_unplug(False)
 
-        expected_calls = [call(device_root.id, 'cat test/file')]
+        expected_calls = [call('cat test/file')]
         assert shell_su.mock_calls == expected_calls
         assert device_root.root_plug_value == 'su: not found'
         assert check_plug_value.call_count == 0
 
     @patch('AndroidRunner.Device.Device.check_plug_value')
-    @patch('AndroidRunner.Adb.shell_su')
+    @patch('AndroidRunner.Adb.AdbHandle.shell_su')
     def test_su_unplug_invalid_root_unplug_file(self, adb_shell, check_plug_value, device_root):
         adb_shell.side_effect = ['No such file or directory', '']
         with pytest.raises(ConfigError):
             device_root.su_unplug(False)
 
-        expected_calls = [call(device_root.id, 'cat %s' % device_root.root_unplug_file)]
+        expected_calls = [call('cat %s' % device_root.root_unplug_file)]
         assert adb_shell.mock_calls == expected_calls
         assert device_root.root_plug_value == 'No such file or directory'
         assert check_plug_value.call_count == 0
 
     @patch('AndroidRunner.Device.Device.check_plug_value')
-    @patch('AndroidRunner.Adb.shell_su')
+    @patch('AndroidRunner.Adb.AdbHandle.shell_su')
     def test_su_unplug_restart(self, shell_su, check_plug_value, device_root):
         shell_su.side_effect = ['default_return', '']
 
         device_root.su_unplug(True)
 
-        expected_calls = [call(device_root.id, 'cat %s' % device_root.root_unplug_file),
-                          call(device_root.id, 'echo %s > %s' %
+        expected_calls = [call('cat %s' % device_root.root_unplug_file),
+                          call('echo %s > %s' %
                                (device_root.root_unplug_value, device_root.root_unplug_file))]
         assert shell_su.mock_calls == expected_calls
         assert device_root.root_plug_value == 'default_return'
@@ -275,30 +350,30 @@ class TestDevice(object):
         assert device_root.root_unplug_value == 'enabled'
 
     @patch('AndroidRunner.Device.Device.su_plug')
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_plug_no_root(self, adb_shell, su_plug, device):
         device.plug()
 
         assert su_plug.call_count == 0
-        adb_shell.assert_called_once_with(123456789, 'dumpsys battery reset')
+        adb_shell.assert_called_once_with('dumpsys battery reset')
 
     @patch('AndroidRunner.Device.Device.su_plug')
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_plug_root(self, adb_shell, su_plug, device_root):
         device_root.plug()
 
         su_plug.assert_called_once()
-        adb_shell.assert_called_once_with(123456789, 'dumpsys battery reset')
+        adb_shell.assert_called_once_with('dumpsys battery reset')
 
-    @patch('AndroidRunner.Adb.shell_su')
+    @patch('AndroidRunner.Adb.AdbHandle.shell_su')
     def test_su_plug(self, adb_shell_su, device_root):
         device_root.root_plug_value = '123456'
 
         device_root.su_plug()
 
-        adb_shell_su.assert_called_once_with(123456789, 'echo 123456 > test/file')
+        adb_shell_su.assert_called_once_with('echo 123456 > test/file')
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_current_activity_current_focus(self, adb_shell, device):
         adb_shell.return_value = 'mCurrentFocus=Window{28d47066 u0 com.android.chrome/org.chromium.chrome.browser.' \
                                  'ChromeTabbedActivity}\nmFocusedApp=Window{3078b3ad u0 com.sonyericsson.usbux/com.' \
@@ -306,35 +381,35 @@ class TestDevice(object):
         current_activity = device.current_activity()
         assert current_activity == 'com.android.chrome'
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_current_activity_focused_app(self, adb_shell, device):
         adb_shell.return_value = 'mFocusedApp=AppWindowToken{ce6dd8c token=Token{31892bf ActivityRecord{21e5e0de u0 ' \
                                  'com.android.chrome/org.chromium.chrome.browser.ChromeTabbedActivity t25385}}}'
         current_activity = device.current_activity()
         assert current_activity == 'com.android.chrome'
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_current_activity_none(self, adb_shell, device):
         adb_shell.return_value = 'mFocusedApp=null'
         current_activity = device.current_activity()
         assert current_activity is None
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_current_activity_error(self, adb_shell, device):
         adb_shell.return_value = 'mFocusedApp=ajislvfhbljhglalkjasfdhdhg'
         with pytest.raises(Adb.AdbError):
             device.current_activity()
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_launch_package_succes(self, adb_shell, device):
         package = 'fake.test.package'
         adb_shell.return_value = 'successsss'
 
         device.launch_package(package)
 
-        adb_shell.assert_called_once_with(123456789, 'monkey -p {} 1'.format(package))
+        adb_shell.assert_called_once_with('monkey -p {} 1'.format(package))
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_launch_package_failure(self, adb_shell, device):
         package = 'fake.test.package'
         adb_shell.return_value = 'error error error monkey aborted error'
@@ -342,71 +417,131 @@ class TestDevice(object):
         with pytest.raises(Adb.AdbError):
             device.launch_package(package)
 
-        adb_shell.assert_called_once_with(123456789, 'monkey -p {} 1'.format(package))
+        adb_shell.assert_called_once_with('monkey -p {} 1'.format(package))
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_launch_activity(self, adb_shell, device):
         package = 'fake.test.package'
         activity = 'main'
 
         device.launch_activity(package, activity)
 
-        adb_shell.assert_called_once_with(123456789, 'am start -n {}/{}'.format(package, activity))
+        adb_shell.assert_called_once_with('am start -n {}/{}'.format(package, activity))
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_launch_activity_force_stop(self, adb_shell, device):
         package = 'fake.test.package'
         activity = 'main'
 
         device.launch_activity(package, activity, force_stop=True)
 
-        adb_shell.assert_called_once_with(123456789, 'am start -S -n {}/{}'.format(package, activity))
+        adb_shell.assert_called_once_with('am start -S -n {}/{}'.format(package, activity))
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_launch_activity_action(self, adb_shell, device):
         package = 'fake.test.package'
         activity = 'main'
 
         device.launch_activity(package, activity, action='action')
 
-        adb_shell.assert_called_once_with(123456789, 'am start -a {} -n {}/{}'.format('action', package, activity))
+        adb_shell.assert_called_once_with('am start -a {} -n {}/{}'.format('action', package, activity))
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_launch_activity_data_uri(self, adb_shell, device):
         package = 'fake.test.package'
         activity = 'main'
 
         device.launch_activity(package, activity, data_uri='data.uri')
 
-        adb_shell.assert_called_once_with(123456789, 'am start -n {}/{} -d {}'.format(package, activity, 'data.uri'))
+        adb_shell.assert_called_once_with('am start -n {}/{} -d {}'.format(package, activity, 'data.uri'))
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_launch_activity_from_scratch(self, adb_shell, device):
         package = 'fake.test.package'
         activity = 'main'
 
         device.launch_activity(package, activity, from_scratch=True)
 
-        adb_shell.assert_called_once_with(123456789,
-                                          'am start -n {}/{} --activity-clear-task'.format(package, activity))
+        adb_shell.assert_called_once_with('am start -n {}/{} --activity-clear-task'.format(package, activity))
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_force_stop(self, adb_shell, device):
         name = 'fake_app'
 
         device.force_stop(name)
 
-        adb_shell.assert_called_once_with(123456789, 'am force-stop {}'.format(name))
+        adb_shell.assert_called_once_with('am force-stop {}'.format(name))
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_is_running(self, raw_shell, device):
+        raw_shell.return_value = '1234 5678'
+        assert device.is_running('com.app')
+        raw_shell.assert_called_once_with('pidof com.app || ps')
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_is_running_ps(self, raw_shell, device):
+        raw_shell.return_value = '/system/bin/sh: pidof: not found\n' \
+                                 'USER     PID   PPID  VSIZE  RSS     WCHAN    PC         NAME\n' \
+                                 'u0_a61    1234  180   1006800 41240 ffffffff 00000000 S com.app\n' \
+                                 'u0_a62    1240  180   1006800 41240 ffffffff 00000000 S com.app:remote'
+        assert device.is_running('com.app')
+        assert not device.is_running('com.other')
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_is_running_not_running(self, raw_shell, device):
+        raw_shell.return_value = 'USER           PID  PPID     VSZ    RSS WCHAN            ADDR S NAME\n' \
+                                 'shell        10233 10230   10856   3084 __arm64_s+          0 S sh'
+        assert not device.is_running('com.app')
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_file_size(self, raw_shell, device):
+        raw_shell.return_value = '1024\n'
+        assert device.file_size('/sdcard/my file.csv') == 1024
+        raw_shell.assert_called_once_with("[ -f '/sdcard/my file.csv' ] && stat -c %s '/sdcard/my file.csv'")
+        raw_shell.return_value = ''
+        assert device.file_size('/sdcard/my file.csv') is None
+
+    @patch('time.time')
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_clock_offset(self, raw_shell, time_mock, device):
+        raw_shell.side_effect = ['1000.250000000\n', '1001.200000000\n', '1002.700000000\n']
+        time_mock.side_effect = [10.0, 10.2, 11.0, 11.1, 12.0, 12.4]
+
+        offset, uncertainty = device.clock_offset(round_trips=3)
+
+        assert offset == pytest.approx(1001.2 - 11.05)
+        assert uncertainty == pytest.approx(0.05)
+        raw_shell.assert_called_with('date +%s.%N')
+
+    @patch('time.time')
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_clock_offset_seconds(self, raw_shell, time_mock, device):
+        raw_shell.return_value = '1000.N'
+        time_mock.side_effect = [10.0, 10.2, 11.0, 11.2]
+
+        assert device.clock_offset(round_trips=1) == pytest.approx((1000.5 - 10.1, 0.6))
+        raw_shell.return_value = 'date: unknown option'
+        with pytest.raises(Adb.AdbError):
+            device.clock_offset(round_trips=1)
+
+    @patch('time.time')
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_uptime_offset(self, raw_shell, time_mock, device):
+        raw_shell.return_value = '100.25 180.50\n'
+        time_mock.side_effect = [10.0, 10.2]
+
+        assert device.uptime_offset(round_trips=1) == pytest.approx((100.255 - 10.1, 0.105))
+        raw_shell.assert_called_once_with('cat /proc/uptime')
 
-    @patch('AndroidRunner.Adb.clear_app_data')
+    @patch('AndroidRunner.Adb.AdbHandle.clear_app_data')
     def test_clear_app_data(self, adb_clear_app_data, device):
         name = 'fake_app'
 
         device.clear_app_data(name)
 
-        adb_clear_app_data.assert_called_once_with(123456789, name)
+        adb_clear_app_data.assert_called_once_with(name)
 
-    @patch('AndroidRunner.Adb.logcat')
+    @patch('AndroidRunner.Adb.AdbHandle.logcat')
     def test_logcat_to_file(self, adb_logcat, device, tmpdir):
         path = os.path.join(str(tmpdir), 'logcat')
         logcat_result = "test file content: 123dsfg564sdfhg"
@@ -420,9 +555,9 @@ class TestDevice(object):
         with open(os.path.join(path, files_in_path[0]), 'r') as fl:
             file_content = fl.read()
             assert file_content == logcat_result
-        adb_logcat.assert_called_once_with(123456789)
+        adb_logcat.assert_called_once_with()
 
-    @patch('AndroidRunner.Adb.logcat')
+    @patch('AndroidRunner.Adb.AdbHandle.logcat')
     def test_logcat_regex(self, adb_logcat, device):
         logcat_result = "test result 123dsfg564sdfhg"
         adb_logcat.return_value = logcat_result
@@ -430,10 +565,10 @@ class TestDevice(object):
 
         result = device.logcat_regex(fake_regex)
 
-        adb_logcat.assert_called_once_with(123456789, regex=fake_regex)
+        adb_logcat.assert_called_once_with(regex=fake_regex)
         assert result == logcat_result
 
-    @patch('AndroidRunner.Adb.push')
+    @patch('AndroidRunner.Adb.AdbHandle.push')
     def test_push(self, adb_push, device):
         adb_push.return_value = 'pushpush'
         local_path = 'test/local/path'
@@ -441,10 +576,10 @@ class TestDevice(object):
 
         result = device.push(local_path, remote_path)
 
-        adb_push.assert_called_once_with(123456789, local_path, remote_path)
+        adb_push.assert_called_once_with(local_path, remote_path)
         assert result == 'pushpush'
 
-    @patch('AndroidRunner.Adb.pull')
+    @patch('AndroidRunner.Adb.AdbHandle.pull')
     def test_pull(self, adb_pull, device):
         adb_pull.return_value = 'pullpull'
         local_path = 'test/local/path'
@@ -452,19 +587,80 @@ class TestDevice(object):
 
         result = device.pull(local_path, remote_path)
 
-        adb_pull.assert_called_once_with(123456789, local_path, remote_path)
+        adb_pull.assert_called_once_with(local_path, remote_path)
         assert result == 'pullpull'
 
-    @patch('AndroidRunner.Adb.shell')
+    @patch('AndroidRunner.Manifest.register')
+    @patch('AndroidRunner.Adb.AdbHandle.pull')
+    def test_pull_registers_local_file(self, adb_pull, register, device, tmpdir):
+        device.pull('/sdcard/results.csv', os.path.join(str(tmpdir), 'renamed.csv'))
+        device.pull('/sdcard/results.csv', str(tmpdir))
+
+        assert register.mock_calls == [call(os.path.join(str(tmpdir), 'renamed.csv')),
+                                       call(os.path.join(str(tmpdir), 'results.csv'))]
+
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
     def test_shell(self, adb_shell, device):
         adb_shell.return_value = 'shell return value'
         shell_command = 'dumpsys battery set usb 1'
 
         result = device.shell(shell_command)
 
-        adb_shell.assert_called_once_with(123456789, shell_command)
+        adb_shell.assert_called_once_with(shell_command)
         assert result == 'shell return value'
 
+    @patch('AndroidRunner.Adb.AdbHandle.pull_stream')
+    def test_pull_stream(self, adb_pull_stream, device):
+        adb_pull_stream.return_value = iter([b'12', b'345'])
+        progress = Mock()
+
+        assert list(device.pull_stream('remote/path', progress)) == [b'12', b'345']
+
+        adb_pull_stream.assert_called_once_with('remote/path')
+        assert [c[1][0] for c in progress.mock_calls] == [2, 5]
+
+    @patch('AndroidRunner.Adb.AdbHandle.pull_stream')
+    def test_pull_to(self, adb_pull_stream, device):
+        adb_pull_stream.return_value = iter([b'12', b'345'])
+        buffer = io.BytesIO()
+
+        transfer = device.pull_to('remote/path', buffer)
+
+        assert buffer.getvalue() == b'12345'
+        assert transfer.size == 5
+        assert transfer.throughput >= 0
+
+    @patch('AndroidRunner.Adb.AdbHandle.push_stream')
+    def test_push_from(self, adb_push_stream, device):
+        pushed = []
+        adb_push_stream.side_effect = lambda chunks, remote: pushed.extend(chunks)
+
+        transfer = device.push_from(io.BytesIO(b'content'), 'remote/path')
+
+        assert b''.join(pushed) == b'content'
+        assert adb_push_stream.call_args[0][1] == 'remote/path'
+        assert transfer.size == 7
+
+    @patch('AndroidRunner.Adb.connect')
+    def test_init_persistent_shell_disabled(self, adb_connect):
+        device = Device('fake_device', 123456789, {'persistent_shell': False})
+
+        assert device.adb.session is None
+
+    def test_init_persistent_shell_default(self, device):
+        assert isinstance(device.adb, Adb.AdbHandle)
+        assert device.adb.serial == 123456789
+        assert isinstance(device.adb.session, ShellSession)
+        assert device.adb.session.device_id == 123456789
+        assert device.adb.session.process is None
+
+    def test_close_shell_session(self, device):
+        device.adb = Mock()
+
+        device.close_shell_session()
+
+        device.adb.close.assert_called_once()
+
     @patch('AndroidRunner.Device.Device.get_api_level')
     @patch('AndroidRunner.Device.Device.get_version')
     def test_str(self, get_version, get_api_level, device):
@@ -475,6 +671,13 @@ class TestDevice(object):
 
         assert device_string == 'fake_device (123456789, Android 9, API level 28)'
 
+    @patch('AndroidRunner.Adb.AdbHandle.shell_batch')
+    def test_shell_batch(self, adb_shell_batch, device):
+        adb_shell_batch.return_value = ['a', 'b']
+
+        assert device.shell_batch(['cmd_a', 'cmd_b']) == ['a', 'b']
+        adb_shell_batch.assert_called_once_with(['cmd_a', 'cmd_b'])
+
 
 class TestDevices(object):
     @pytest.fixture()
@@ -492,7 +695,7 @@ class TestDevices(object):
         with pytest.raises(ConfigError):
             Devices(['fake_device'])
 
-        adb_setup.assert_called_once_with('adb')
+        adb_setup.assert_called_once_with('adb', backend='adb')
 
     @patch('AndroidRunner.Device.Device.__init__')
     @patch('AndroidRunner.Devices.load_json')
@@ -503,7 +706,7 @@ class TestDevices(object):
         mock_device_settings = Mock()
         devices = Devices({'fake_device': mock_device_settings}, 'adb/path')
 
-        adb_setup.assert_called_once_with('adb/path')
+        adb_setup.assert_called_once_with('adb/path', backend='adb')
         device.assert_called_once_with('fake_device', 123456789, mock_device_settings)
         assert len(devices.devices) == 1
         assert isinstance(devices.devices[0], Device)
@@ -573,6 +776,10 @@ class TestDevices(object):
 
 class TestAdb(object):
 
+    @pytest.fixture()
+    def handle(self):
+        return Adb.AdbHandle(123, 'adb/path', None, None)
+
     @patch('AndroidRunner.Adb.ADB')
     def test_setup_succes_custom_path(self, adb):
         adb_instance = MagicMock()
@@ -581,7 +788,8 @@ class TestAdb(object):
 
         Adb.setup('adb/path')
 
-        assert isinstance(Adb.adb, MagicMock)
+        assert Adb.adb_path == 'adb/path'
+        assert Adb.client is None
         adb.assert_called_once_with(adb_path='adb/path')
 
     @patch('AndroidRunner.Adb.ADB')
@@ -592,7 +800,7 @@ class TestAdb(object):
 
         Adb.setup()
 
-        assert isinstance(Adb.adb, MagicMock)
+        assert Adb.adb_path == 'adb'
         adb.assert_called_once_with(adb_path='adb')
 
     @patch('AndroidRunner.Adb.ADB')
@@ -603,187 +811,271 @@ class TestAdb(object):
         with pytest.raises(Adb.AdbError):
             Adb.setup()
 
-    def test_connect_no_devices(self):
-        mock_adb = Mock()
-        mock_adb.get_devices.return_value = {}
-        Adb.adb = mock_adb
+    @patch('subprocess.Popen')
+    def test_run_adb(self, popen):
+        popen.return_value.communicate.return_value = (b'output\n\n', None)
+
+        result = Adb.run_adb('adb/path', ['devices'])
+
+        assert result == 'output'
+        popen.assert_called_once_with(['adb/path', 'devices'], shell=False, stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT)
+
+    @patch('subprocess.Popen')
+    def test_run_adb_missing_binary(self, popen):
+        popen.side_effect = OSError('No such file or directory')
+
+        with pytest.raises(Adb.AdbError):
+            Adb.run_adb('adb/path', ['devices'])
+
+    @patch('AndroidRunner.Adb.run_adb')
+    def test_devices(self, run_adb):
+        run_adb.return_value = 'List of devices attached\n12\tdevice\n13\tunauthorized\n'
+
+        assert Adb.devices() == {0: '12', 1: '13'}
+        run_adb.assert_called_once_with(Adb.adb_path, ['devices'])
+
+    @patch('AndroidRunner.Adb.devices')
+    def test_connect_no_devices(self, devices):
+        devices.return_value = {}
 
         with pytest.raises(Adb.ConnectionError):
             Adb.connect('123')
 
-        mock_adb.get_devices.assert_called_once()
+        devices.assert_called_once()
 
-    def test_connect_device_missing(self):
-        mock_adb = Mock()
-        mock_adb.get_devices.return_value = {'a': 12, 'b': 13}
-        Adb.adb = mock_adb
+    @patch('AndroidRunner.Adb.devices')
+    def test_connect_device_missing(self, devices):
+        devices.return_value = {'a': 12, 'b': 13}
 
         with pytest.raises(Adb.ConnectionError):
             Adb.connect(123)
 
-        mock_adb.get_devices.assert_called_once()
+        devices.assert_called_once()
 
-    def test_connect_succes(self):
-        mock_adb = Mock()
-        mock_adb.get_devices.return_value = {'a': 12, 'b': 13, 'c': 123}
-        Adb.adb = mock_adb
+    @patch('AndroidRunner.Adb.devices')
+    def test_connect_succes(self, devices):
+        devices.return_value = {'a': 12, 'b': 13, 'c': 123}
 
         Adb.connect(123)
 
-        mock_adb.get_devices.assert_called_once()
+        devices.assert_called_once()
+
+    @patch('AndroidRunner.Adb.ADB')
+    def test_get_handle(self, adb):
+        adb_instance = MagicMock()
+        adb_instance._ADB__error = None
+        adb.return_value = adb_instance
+        Adb.setup('adb/path')
 
-    def test_shell_succes(self):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = "succes         "
-        Adb.adb = mock_adb
-        result = Adb.shell(123, "test_command")
+        handle = Adb.get_handle(123)
 
-        expected_calls = [call.set_target_by_name(123), call.shell_command('test_command')]
-        assert mock_adb.mock_calls == expected_calls
+        assert handle.serial == 123
+        assert handle.adb_path == 'adb/path'
+        assert handle.client is None
+        assert handle.session.device_id == 123
+        assert handle.session.adb_path == 'adb/path'
+        assert handle.session.process is None
+
+    def test_get_handle_no_persistent_shell(self):
+        handle = Adb.get_handle(123, persistent_shell=False)
+
+        assert handle.session is None
+
+    def test_handles_are_independent(self):
+        handle_a = Adb.get_handle('a', persistent_shell=False)
+        handle_b = Adb.get_handle('b', persistent_shell=False)
+
+        with pytest.raises(AttributeError):
+            handle_a.serial = 'b'
+        assert handle_a.serial == 'a'
+        assert handle_b.serial == 'b'
+
+    @patch('AndroidRunner.Adb.run_adb')
+    def test_run(self, run_adb, handle):
+        run_adb.return_value = 'output'
+
+        assert handle.run(['shell', 'test_command']) == 'output'
+        run_adb.assert_called_once_with('adb/path', ['-s', '123', 'shell', 'test_command'])
+
+    @patch('AndroidRunner.Adb.run_adb')
+    def test_run_unauthorized(self, run_adb, handle):
+        run_adb.return_value = 'error: device unauthorized.'
+
+        with pytest.raises(Adb.AdbError):
+            handle.run(['shell', 'test_command'])
+
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_shell_succes(self, run, handle):
+        run.return_value = "succes         "
+
+        result = handle.shell("test_command")
+
+        run.assert_called_once_with(['shell', 'test_command'])
         assert result == 'succes'
 
-    def test_shell_error(self):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = "error"
-        Adb.adb = mock_adb
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_shell_error(self, run, handle):
+        run.return_value = "error"
+
+        with pytest.raises(Adb.AdbError):
+            handle.shell("test_command")
+
+        run.assert_called_once_with(['shell', 'test_command'])
+
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_shell_session(self, run):
+        mock_session = Mock()
+        mock_session.run.return_value = ('session output\n', 0)
+        handle = Adb.AdbHandle(123, 'adb/path', None, mock_session)
+
+        result = handle.shell('test_command')
+
+        mock_session.run.assert_called_once_with('test_command')
+        run.assert_not_called()
+        assert result == 'session output'
+
+    def test_shell_session_error(self):
+        mock_session = Mock()
+        mock_session.run.return_value = ('error: device offline', 1)
+        handle = Adb.AdbHandle(123, 'adb/path', None, mock_session)
 
         with pytest.raises(Adb.AdbError):
-            Adb.shell(123, "test_command")
+            handle.shell('test_command')
 
-        expected_calls = [call.set_target_by_name(123), call.shell_command('test_command')]
-        assert mock_adb.mock_calls == expected_calls
+    def test_shell_client(self):
+        mock_client = Mock()
+        mock_client.shell.return_value = 'client output\n'
+        handle = Adb.AdbHandle(123, 'adb/path', mock_client, None)
 
-    def test_shell_su_succes(self):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = "su_succes         "
-        Adb.adb = mock_adb
-        result = Adb.shell_su(123, "test_command_su")
+        assert handle.shell('test_command') == 'client output'
+        mock_client.shell.assert_called_once_with('123', 'test_command')
 
-        expected_calls = [call.set_target_by_name(123), call.shell_command('su -c \'test_command_su\'')]
-        assert mock_adb.mock_calls == expected_calls
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_shell_su_succes(self, run, handle):
+        run.return_value = "su_succes         "
+
+        result = handle.shell_su("test_command_su")
+
+        run.assert_called_once_with(['shell', 'su -c \'test_command_su\''])
         assert result == 'su_succes'
 
-    def test_shell_su_error(self):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = "su_error"
-        Adb.adb = mock_adb
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_shell_su_error(self, run, handle):
+        run.return_value = "su_error"
+
+        with pytest.raises(Adb.AdbError):
+            handle.shell_su("test_command_su")
+
+        run.assert_called_once_with(['shell', 'su -c \'test_command_su\''])
+
+    @patch('AndroidRunner.Adb.run_adb')
+    def test_shell_batch(self, run_adb, handle):
+        run_adb.side_effect = lambda path, args: subprocess.check_output(['/bin/sh', '-c', args[-1]]).decode()
+
+        outputs = handle.shell_batch(['echo one; echo two', 'true', 'printf three', 'cat'])
+
+        assert outputs == ['one\ntwo', '', 'three', '']
+        assert run_adb.call_count == 1
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_shell_batch_pty(self, raw_shell, handle):
+        raw_shell.side_effect = lambda script: subprocess.check_output(['/bin/sh', '-c', script]).decode() \
+            .replace('\n', '\r\n')
+
+        assert handle.shell_batch(['echo one', 'echo two']) == ['one', 'two']
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_shell_batch_error(self, raw_shell, handle):
+        raw_shell.side_effect = lambda script: subprocess.check_output(['/bin/sh', '-c', script]).decode()
 
         with pytest.raises(Adb.AdbError):
-            Adb.shell_su(123, "test_command_su")
+            handle.shell_batch(['echo fine', 'echo error: device offline'])
+
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_shell_batch_truncated(self, raw_shell, handle):
+        raw_shell.return_value = 'one'
 
-        expected_calls = [call.set_target_by_name(123), call.shell_command('su -c \'test_command_su\'')]
-        assert mock_adb.mock_calls == expected_calls
+        with pytest.raises(Adb.AdbError):
+            handle.shell_batch(['echo one', 'echo two'])
 
-    @patch('AndroidRunner.Adb.shell')
-    def test_list_apps(self, adb_shell):
+    @patch('AndroidRunner.Adb.AdbHandle.shell')
+    def test_list_apps(self, adb_shell, handle):
         adb_shell.return_value = 'package:com.app.1\npackage:com.app.2\npackage:com.app.3'
 
-        result = Adb.list_apps(123)
+        result = handle.list_apps()
 
-        adb_shell.assert_called_once_with(123, 'pm list packages')
+        adb_shell.assert_called_once_with('pm list packages')
         assert len(result) == 3
         assert 'com.app.1' in result
         assert 'com.app.2' in result
         assert 'com.app.3' in result
 
-    def test_install_default(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_install_default(self, run, handle):
+        run.return_value = 'succes'
         apk = 'test_apk.apk'
 
-        result = Adb.install(device_id, apk)
+        result = handle.install(apk)
 
         assert result == 'succes'
-        expected_calls = [call.set_target_by_name(device_id), call.run_cmd('install -r -g {}'.format(apk))]
-        assert mock_adb.mock_calls == expected_calls
-
-    def test_install_no_replace(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+        run.assert_called_once_with(['install', '-r', '-g', apk])
+
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_install_no_replace(self, run, handle):
+        run.return_value = 'succes'
         apk = 'test_apk.apk'
 
-        result = Adb.install(device_id, apk, replace=False)
+        result = handle.install(apk, replace=False)
 
         assert result == 'succes'
-        expected_calls = [call.set_target_by_name(device_id), call.run_cmd('install -g {}'.format(apk))]
-        assert mock_adb.mock_calls == expected_calls
-
-    def test_install_not_all_permissions(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+        run.assert_called_once_with(['install', '-g', apk])
+
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_install_not_all_permissions(self, run, handle):
+        run.return_value = 'succes'
         apk = 'test_apk.apk'
 
-        result = Adb.install(device_id, apk, all_permissions=False)
+        result = handle.install(apk, all_permissions=False)
 
         assert result == 'succes'
-        expected_calls = [call.set_target_by_name(device_id), call.run_cmd('install -r {}'.format(apk))]
-        assert mock_adb.mock_calls == expected_calls
+        run.assert_called_once_with(['install', '-r', apk])
 
     @patch('AndroidRunner.Adb.success_or_exception')
-    def test_uninstall_delete_data(self, s_or_e):
-        mock_adb = Mock()
-        mock_adb.uninstall.return_value = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_uninstall_delete_data(self, run, s_or_e, handle):
+        run.return_value = 'succes'
         name = 'app_name'
 
-        manager = Mock()
-        manager.attach_mock(s_or_e, "s_or_e_mock")
-        manager.mock_adb = mock_adb
+        handle.uninstall(name)
 
-        Adb.uninstall(device_id, name)
-
-        expected_calls = [call.mock_adb.set_target_by_name(123),
-                          call.mock_adb.uninstall(package=name, keepdata=True),
-                          call.s_or_e_mock('succes', '{}: "{}" uninstalled'.format(device_id, name),
-                                           '{}: Failed to uninstall "{}"'.format(device_id, name))]
-        assert manager.mock_calls == expected_calls
+        run.assert_called_once_with(['uninstall', name])
+        s_or_e.assert_called_once_with('succes', '123: "{}" uninstalled'.format(name),
+                                       '123: Failed to uninstall "{}"'.format(name))
 
     @patch('AndroidRunner.Adb.success_or_exception')
-    def test_uninstall_keep_data(self, s_or_e):
-        mock_adb = Mock()
-        mock_adb.uninstall.return_value = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_uninstall_keep_data(self, run, s_or_e, handle):
+        run.return_value = 'succes'
         name = 'app_name'
 
-        manager = Mock()
-        manager.attach_mock(s_or_e, "s_or_e_mock")
-        manager.mock_adb = mock_adb
-
-        Adb.uninstall(device_id, name, True)
+        handle.uninstall(name, True)
 
-        expected_calls = [call.mock_adb.set_target_by_name(123),
-                          call.mock_adb.uninstall(package=name, keepdata=False),
-                          call.s_or_e_mock('succes', '{}: "{}" uninstalled'.format(device_id, name),
-                                           '{}: Failed to uninstall "{}"'.format(device_id, name))]
-        assert manager.mock_calls == expected_calls
+        run.assert_called_once_with(['uninstall', '-k', name])
+        s_or_e.assert_called_once_with('succes', '123: "{}" uninstalled'.format(name),
+                                       '123: Failed to uninstall "{}"'.format(name))
 
     @patch('AndroidRunner.Adb.success_or_exception')
-    def test_clear_app_data(self, s_or_e):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_clear_app_data(self, run, s_or_e, handle):
+        run.return_value = 'succes'
         name = 'app_name'
 
-        manager = Mock()
-        manager.attach_mock(s_or_e, "s_or_e_mock")
-        manager.mock_adb = mock_adb
-
-        Adb.clear_app_data(device_id, name)
+        handle.clear_app_data(name)
 
-        expected_calls = [call.mock_adb.set_target_by_name(123),
-                          call.mock_adb.shell_command('pm clear app_name'),
-                          call.s_or_e_mock('succes', '{}: Data of "{}" cleared'.format(device_id, name),
-                                           '{}: Failed to clear data for "{}"'.format(device_id, name))]
-        assert manager.mock_calls == expected_calls
+        run.assert_called_once_with(['shell', 'pm clear app_name'])
+        s_or_e.assert_called_once_with('succes', '123: Data of "{}" cleared'.format(name),
+                                       '123: Failed to clear data for "{}"'.format(name))
 
     @patch('logging.Logger.info')
     def test_success_or_exception_succes(self, logger):
@@ -806,98 +1098,265 @@ class TestAdb(object):
 
         logger.assert_called_once_with(fail_msg + '\nMessage returned:\n{}'.format(input_string))
 
-    def test_push(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'push output'
-        Adb.adb = mock_adb
-
-        device_id = 123
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_push(self, run, handle):
+        run.return_value = 'push output'
         local_path = 'local/path'
         remote_path = 'remote/path'
 
-        result = Adb.push(device_id, local_path, remote_path)
+        result = handle.push(local_path, remote_path)
 
         assert result == 'push output'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.run_cmd('push {} {}'.format(local_path, remote_path))]
-        assert mock_adb.mock_calls == expected_calls
-
-    def test_pull_no_error(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'pull output'
-        mock_adb._ADB__error = None
-        Adb.adb = mock_adb
+        run.assert_called_once_with(['push', local_path, remote_path])
 
-        device_id = 123
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_pull(self, run, handle):
+        run.return_value = 'remote/path: 1 file pulled. 1.2 MB/s (4096 bytes in 0.003s)'
         local_path = 'local/path'
         remote_path = 'remote/path'
 
-        result = Adb.pull(device_id, remote_path, local_path)
+        result = handle.pull(remote_path, local_path)
 
-        assert result == 'pull output'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.run_cmd('pull {} {}'.format(remote_path, local_path))]
-        assert mock_adb.mock_calls == expected_calls
+        assert result == 'remote/path: 1 file pulled. 1.2 MB/s (4096 bytes in 0.003s)'
+        run.assert_called_once_with(['pull', remote_path, local_path])
 
-    def test_pull_error_no_bytes_in(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'pull output'
-        mock_adb._ADB__error = 'error error'
-        Adb.adb = mock_adb
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_logcat_no_regex(self, run, handle):
+        run.return_value = 'logcat output'
 
-        device_id = 123
-        local_path = 'local/path'
-        remote_path = 'remote/path'
+        result = handle.logcat()
 
-        result = Adb.pull(device_id, remote_path, local_path)
+        assert result == 'logcat output'
+        run.assert_called_once_with(['logcat', '-d'])
 
-        assert result == 'pull output'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.run_cmd('pull {} {}'.format(remote_path, local_path))]
-        assert mock_adb.mock_calls == expected_calls
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_logcat_with_regex(self, run, handle):
+        run.return_value = 'logcat output'
+        test_regex = '[a-zA-Z]+'
 
-    def test_pull_error_with_bytes_in(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'pull output'
-        mock_adb._ADB__error = 'bytes in error'
-        Adb.adb = mock_adb
+        result = handle.logcat(test_regex)
 
-        device_id = 123
-        local_path = 'local/path'
-        remote_path = 'remote/path'
+        assert result == 'logcat output'
+        run.assert_called_once_with(['logcat', '-d', '-e', test_regex])
 
-        result = Adb.pull(device_id, remote_path, local_path)
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_pull_stream_missing_file(self, raw_shell, handle):
+        raw_shell.return_value = ''
 
-        assert result == 'bytes in error'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.run_cmd('pull {} {}'.format(remote_path, local_path))]
-        assert mock_adb.mock_calls == expected_calls
+        with pytest.raises(Adb.AdbError):
+            list(handle.pull_stream('/sdcard/missing file.csv'))
 
-    def test_logcat_no_regex(self):
-        mock_adb = Mock()
-        mock_adb.get_logcat.return_value = 'get_logcat output'
-        Adb.adb = mock_adb
+        raw_shell.assert_called_once_with("[ -r '/sdcard/missing file.csv' ] && echo readable")
 
-        device_id = 123
+    @patch('subprocess.Popen')
+    @patch('AndroidRunner.Adb.AdbHandle.raw_shell')
+    def test_pull_stream(self, raw_shell, popen, handle):
+        raw_shell.return_value = 'readable\n'
+        popen.return_value.stdout = io.BufferedReader(io.BytesIO(b'csv content'))
+        popen.return_value.poll.return_value = 0
 
-        result = Adb.logcat(device_id)
+        assert b''.join(handle.pull_stream('/sdcard/file.csv')) == b'csv content'
 
-        assert result == 'get_logcat output'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.get_logcat(lcfilter='-d')]
-        assert mock_adb.mock_calls == expected_calls
+        assert popen.call_args[0][0] == ['adb/path', '-s', '123', 'exec-out', 'cat /sdcard/file.csv']
+        popen.return_value.wait.assert_called_once()
 
-    def test_logcat_with_regex(self):
-        mock_adb = Mock()
-        mock_adb.get_logcat.return_value = 'get_logcat output'
-        Adb.adb = mock_adb
+    @patch('subprocess.Popen')
+    def test_push_stream(self, popen, handle):
+        popen.return_value.communicate.return_value = (b'', None)
+        popen.return_value.returncode = 0
 
-        test_regex = '[a-zA-Z]+'
-        device_id = 123
+        handle.push_stream(iter([b'12', b'34']), '/sdcard/file.txt')
+
+        assert popen.call_args[0][0] == ['adb/path', '-s', '123', 'exec-in', 'cat > /sdcard/file.txt']
+        assert popen.return_value.stdin.write.mock_calls == [call(b'12'), call(b'34')]
+
+    @patch('subprocess.Popen')
+    def test_push_stream_error(self, popen, handle):
+        popen.return_value.stdin.write.side_effect = BrokenPipeError
+        popen.return_value.communicate.return_value = (b'/system/bin/sh: can\'t create /file.txt: Read-only', None)
+        popen.return_value.returncode = 1
+
+        with pytest.raises(Adb.AdbError) as except_result:
+            handle.push_stream(iter([b'12']), '/file.txt')
+
+        assert 'Read-only' in str(except_result.value)
+
+    def test_close(self):
+        mock_session = Mock()
+        handle = Adb.AdbHandle(123, 'adb/path', None, mock_session)
+
+        handle.close()
+
+        mock_session.close.assert_called_once()
+
+
+class TestDeviceInfo(object):
+    def test_from_getprop(self):
+        output = '[dalvik.vm.heapsize]: [512m]\r\n' \
+                 '[ro.build.fingerprint]: [google/sailfish/sailfish:9/PQ3A.190801.002/5670241:user/release-keys]\n' \
+                 '[ro.build.version.release]: [9]\n' \
+                 '[ro.build.version.sdk]: [28]\n' \
+                 '[ro.product.cpu.abi]: [arm64-v8a]\n' \
+                 '[ro.product.manufacturer]: [Google]\n' \
+                 '[ro.product.model]: [Pixel]\n' \
+                 '[sys.boot.reason]: [error: bootloader]\n'
+
+        info = DeviceInfo.from_getprop(output)
+
+        assert info.version == '9'
+        assert info.api_level == 28
+        assert info.manufacturer == 'Google'
+        assert info.model == 'Pixel'
+        assert info.abi == 'arm64-v8a'
+        assert info.build_fingerprint.startswith('google/sailfish')
+        assert info.get('dalvik.vm.heapsize') == '512m'
+        assert info.get('sys.boot.reason') == 'error: bootloader'
+        assert info.to_dict()['api_level'] == 28
+
+    def test_missing_properties(self):
+        info = DeviceInfo.from_getprop('[ro.build.version.sdk]: []\n')
+
+        assert info.version is None
+        assert info.api_level is None
+        assert info.get('ro.product.model', 'unknown') == 'unknown'
+
+
+class TestShellSession(object):
+    @pytest.fixture()
+    def fake_adb(self, tmpdir):
+        # Stand-in for 'adb -s <id> shell' that starts a local shell
+        path = os.path.join(str(tmpdir), 'adb')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n[ "$3" = features ] && echo shell_v2 && echo cmd && exit 0\nexec /bin/sh\n')
+        os.chmod(path, 0o755)
+        return path
+
+    @pytest.fixture()
+    def session(self, fake_adb):
+        shell_session = ShellSession(123456789, adb_path=fake_adb)
+        yield shell_session
+        shell_session.close()
+
+    def test_run_output_and_exit_code(self, session):
+        assert session.run('echo hello') == ('hello\n', 0)
+        assert session.run('echo fail; false') == ('fail\n', 1)
+
+    def test_run_output_without_newline(self, session):
+        assert session.run('printf abc') == ('abc', 0)
+        assert session.run('true') == ('', 0)
+
+    def test_run_multiline_and_stderr(self, session):
+        output, exit_code = session.run('echo a; echo b >&2; exit_code_test() { return 3; }; exit_code_test')
+
+        assert output == 'a\nb\n'
+        assert exit_code == 3
+
+    def test_run_reuses_process(self, session):
+        session.run('true')
+        process = session.process
+        session.run('true')
+
+        assert session.process is process
+
+    def test_shell_batch_in_session(self, session):
+        handle = Adb.AdbHandle(123456789, session.adb_path, None, session)
+
+        assert handle.shell_batch(['echo one', 'printf two', 'false']) == ['one', 'two', '']
+        assert handle.shell('echo after') == 'after'
+
+    def test_run_in_subshell(self, session):
+        assert session.run('cd /; export LEAK=1; exit 3') == ('', 3)
+
+        assert session.run('echo "$LEAK"; pwd') == ('\n%s\n' % os.getcwd(), 0)
+        assert session.run('echo alive') == ('alive\n', 0)
+
+    def test_supported(self, session):
+        assert session.supported()
+        session.adb_path = 'missing/adb'
+
+        # Queried once
+        assert session.supported()
+
+    def test_not_supported_without_shell_v2(self, tmpdir):
+        path = os.path.join(str(tmpdir), 'adb')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n[ "$3" = features ] && echo cmd && exit 0\necho "$@"\n')
+        os.chmod(path, 0o755)
+        handle = Adb.AdbHandle(123456789, path, None, ShellSession(123456789, adb_path=path))
+
+        assert not handle.session.supported()
+        assert handle.raw_shell('echo hi') == '-s 123456789 shell echo hi'
+        assert handle.session.process is None
+
+    def test_run_command_reading_stdin(self, session):
+        assert session.run('cat') == ('', 0)
+        assert session.run('echo next') == ('next\n', 0)
+
+    def test_run_restarts_dead_session(self, session):
+        session.run('true')
+        session.process.kill()
+        session.process.wait()
+
+        assert session.run('echo restarted') == ('restarted\n', 0)
+
+    def test_run_restarts_after_exit(self, session):
+        with pytest.raises(ShellSessionError):
+            session.run('kill -9 $$')
+        assert session.run('echo alive') == ('alive\n', 0)
+
+    def test_run_does_not_repeat_sent_command(self, session, tmpdir):
+        marker = os.path.join(str(tmpdir), 'marker')
+
+        with pytest.raises(ShellSessionError):
+            session.run('echo x >> %s; kill -9 $$' % marker)
+
+        with open(marker) as f:
+            assert f.read() == 'x\n'
+        assert session.process is None
+
+    def test_run_retries_unsent_command(self, session):
+        session.run('true')
+        session.stdin = Mock(write=Mock(side_effect=BrokenPipeError()))
+
+        assert session.run('echo resent') == ('resent\n', 0)
+
+    def test_run_timeout(self, fake_adb):
+        session = ShellSession(123456789, adb_path=fake_adb, timeout=0.2)
+
+        with pytest.raises(ShellSessionError):
+            session.run('sleep 5')
+        assert session.process is None
+        assert session.run('echo next') == ('next\n', 0)
+        session.close()
+
+    def test_run_in_forked_process_while_lock_held(self, session):
+        session.run('true')
+        queue = mp.get_context('fork').Queue()
+        process = mp.get_context('fork').Process(target=lambda: queue.put(session.run('echo child')))
+
+        with session.lock:
+            process.start()
+            process.join(10)
+
+        assert queue.get(timeout=1) == ('child\n', 0)
+        assert session.is_alive()
+        assert session.run('echo parent') == ('parent\n', 0)
+
+    def test_is_alive_other_process(self, session):
+        session.run('true')
+        assert session.is_alive()
+
+        session.owner_pid = -1
+
+        assert not session.is_alive()
+        session.owner_pid = os.getpid()
+
+    def test_close(self, session):
+        session.run('true')
+        process = session.process
 
-        result = Adb.logcat(device_id, test_regex)
+        session.close()
 
-        assert result == 'get_logcat output'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.get_logcat(lcfilter='-d -e {}'.format(test_regex))]
-        assert mock_adb.mock_calls == expected_calls
+        assert process.poll() is not None
+        assert session.process is None
+        assert not session.is_alive()
@@ -0,0 +1,141 @@
+import json
+import os.path as op
+import time
+
+import pytest
+from mock import Mock
+
+import AndroidRunner.Adb as Adb
+import AndroidRunner.Simulator as Simulator
+import AndroidRunner.Waits as Waits
+import paths
+from AndroidRunner.DryRun import DryRun, EstimatedScripts, HookHistory, format_duration
+from AndroidRunner.Progress import Progress
+from AndroidRunner.util import ConfigError, load_json, makedirs
+
+
+class TestDryRun(object):
+    @pytest.fixture()
+    def config_dir(self, tmpdir):
+        config_dir = op.join(str(tmpdir), 'config')
+        makedirs(op.join(config_dir, 'output', '2020.01.01_000000'))
+        with open(op.join(config_dir, 'output', '2020.01.01_000000', 'experiment.log'), 'w') as f:
+            f.write('2020-01-01 00:00:00,000:DEBUG:Scripts:Hook before_run took 1.000s\n'
+                    '2020-01-01 00:00:01,000:DEBUG:Scripts:Hook before_run took 2.000s\n'
+                    '2020-01-01 00:00:02,000:DEBUG:Profilers:Hook collect_results took 0.250s\n'
+                    '2020-01-01 00:00:03,000:INFO:Experiment:Hook before_run took 9.000s\n')
+        for script in ['before_run.py', 'interaction.py']:
+            with open(op.join(config_dir, script), 'w') as f:
+                f.write('def main(device, *args, **kwargs):\n    pass\n')
+        with open(op.join(config_dir, 'devices.json'), 'w') as f:
+            json.dump({'device1': 'serial1', 'device2': 'serial2'}, f)
+        output_dir = op.join(str(tmpdir), 'dry_run')
+        makedirs(output_dir)
+        paths.CONFIG_DIR = config_dir
+        paths.OUTPUT_DIR = output_dir
+        paths.BASE_OUTPUT_DIR = output_dir
+        yield config_dir
+        Adb.client = None
+
+    @staticmethod
+    def write_config(config_dir, **settings):
+        config = {'type': 'web', 'devices': {'device1': {}, 'device2': {}},
+                  'devices_spec': op.join(config_dir, 'devices.json'),
+                  'paths': ['https://example.com/', 'https://example.org/'], 'browsers': ['chrome'],
+                  'replications': 2, 'duration': 1000, 'time_between_run': 500,
+                  'scripts': {'before_run': 'before_run.py',
+                              'interaction': [{'type': 'python3', 'path': 'interaction.py', 'timeout': 2000}]}}
+        config.update(settings)
+        config_file = op.join(config_dir, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump(config, f)
+        return config_file
+
+    def test_hook_history(self, config_dir):
+        history = HookHistory.from_output_dir(op.join(config_dir, 'output'))
+
+        assert history.log_count == 1
+        assert history.mean('Scripts', 'before_run') == 1.5
+        assert history.mean('Profilers', 'collect_results') == 0.25
+        assert history.mean('Scripts', 'interaction') is None
+
+    def test_estimated_scripts(self):
+        history = HookHistory()
+        history.durations[('Scripts', 'before_run')] = [3.0]
+        scripts = Mock()
+        scripts.scripts = {'before_run': [Mock(timeout=1.0)], 'interaction': [Mock(timeout=1.0), Mock(timeout=0.5)]}
+        clock = Simulator.Clock()
+        estimated = EstimatedScripts(scripts, history, clock)
+
+        estimated.run('before_run', Mock())
+        estimated.run('interaction', Mock())
+        estimated.run('after_run', Mock())
+
+        assert clock.time() == 4.5
+        assert estimated.unknown == {'interaction'}
+
+    def test_run(self, config_dir):
+        dry_run = DryRun(self.write_config(config_dir))
+        start = time.time()
+
+        estimates = dry_run.run()
+
+        assert time.time() - start < 5
+        assert Waits.clock is time
+        assert Adb.injected_client is None
+        assert [estimate.run['runId'] for estimate in estimates] == [str(i) for i in range(8)]
+        # before_run 1.5s, page load 5s, interaction timeout 2s, duration 1s, time between runs 0.5s and adb commands
+        assert all(10 < estimate.duration < 11 for estimate in estimates)
+        assert estimates[1].start == estimates[0].start + estimates[0].duration
+        assert dry_run.total_duration() == dry_run.clock.time()
+        assert list(dry_run.device_durations()) == ['device1', 'device2']
+        assert dry_run.scripts.unknown == {'interaction'}
+        assert not op.exists(op.join(config_dir, 'output', '2020.01.01_000000', 'progress.xml'))
+
+    def test_run_parallel_devices(self, config_dir):
+        dry_run = DryRun(self.write_config(config_dir, parallel_devices=True))
+        dry_run.run()
+
+        assert dry_run.total_duration() < dry_run.clock.time() / 2 + 1
+        assert dry_run.total_duration() > max(dry_run.device_durations().values())
+
+    def test_run_progress(self, config_dir, tmpdir):
+        config_file = self.write_config(config_dir, random_seed=1, scheduler='round_robin')
+        paths.OUTPUT_DIR = op.join(str(tmpdir), 'previous')
+        makedirs(paths.OUTPUT_DIR)
+        progress = Progress(config_file=config_file, config=load_json(config_file), load_progress=False)
+        schedule = [run.run_id for run in progress.get_schedule()]
+        for run_id in schedule[:3]:
+            progress.journal_run(run_id)
+        with open(progress.progress_xml_file, 'rb') as f:
+            content = f.read()
+        paths.OUTPUT_DIR = paths.BASE_OUTPUT_DIR
+
+        dry_run = DryRun(config_file, progress_file=progress.progress_xml_file)
+        dry_run.run()
+
+        assert [estimate.run['runId'] for estimate in dry_run.estimates] == schedule[3:]
+        with open(progress.progress_xml_file, 'rb') as f:
+            assert f.read() == content
+        assert op.isfile(progress.get_journal_file())
+
+    def test_report(self, config_dir):
+        dry_run = DryRun(self.write_config(config_dir))
+        dry_run.run()
+
+        report = dry_run.report().splitlines()
+
+        assert report[1].split()[:4] == ['0', 'device1', 'chrome', '1']
+        assert report[1].split()[-1] == 'https://example.com/'
+        assert 'Schedule: 8 runs, 4 subject setups, 1 device changes' in report
+        assert 'Estimated duration: %s' % format_duration(dry_run.clock.time()) in report
+        assert 'Scripts without earlier durations, estimated by their timeout if they have one: interaction' in report
+
+    def test_run_plugintest(self, config_dir):
+        with pytest.raises(ConfigError):
+            DryRun(self.write_config(config_dir, type='plugintest')).run()
+
+    def test_format_duration(self):
+        assert format_duration(0) == '0:00:00.0'
+        assert format_duration(61.25) == '0:01:01.2'
+        assert format_duration(90000) == '25:00:00.0'
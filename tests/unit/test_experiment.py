@@ -1,19 +1,24 @@
+import csv
 import filecmp
 import os
+import os.path as op
+import time
 from collections import OrderedDict
 
 import pytest
 from mock import MagicMock, Mock, call, patch
 
 import paths
+from AndroidRunner.DeviceInfo import DeviceInfo
 from AndroidRunner.Devices import Devices
-from AndroidRunner.Experiment import Experiment
+from AndroidRunner.Experiment import Experiment, ExperimentError
 from AndroidRunner.ExperimentFactory import ExperimentFactory
 from AndroidRunner.NativeExperiment import NativeExperiment
 from AndroidRunner.Profilers import Profilers
-from AndroidRunner.Progress import Progress
+from AndroidRunner.Progress import Progress, Run
 from AndroidRunner.Scripts import Scripts
 from AndroidRunner.WebExperiment import WebExperiment
+from AndroidRunner import Manifest, Timing, util
 from AndroidRunner.util import ConfigError, makedirs
 from tests.PluginTests import PluginTests
 
@@ -40,6 +45,7 @@ class TestExperiment(object):
     @patch('AndroidRunner.Devices.Devices.__init__')
     def default_experiment(self, mock_devices, mock_test):
         paths.OUTPUT_DIR = 'fake/path/name'
+        Timing.summary = Timing.Summary()
         device_config = {'devices': 'fake_device'}
         mock_devices.return_value = None
         return Experiment(device_config, None, False)
@@ -49,6 +55,10 @@ class TestExperiment(object):
         with pytest.raises(ConfigError):
             Experiment(empty_config, None, False)
 
+    def test_init_randomization_string(self):
+        with pytest.raises(ConfigError):
+            Experiment({'devices': 'fake_device', 'randomization': 'False'}, None, False)
+
     @patch('AndroidRunner.Experiment.Experiment.prepare_device')
     @patch('AndroidRunner.Tests.check_dependencies')
     @patch('AndroidRunner.Devices.Devices.__init__')
@@ -68,7 +78,6 @@ class TestExperiment(object):
         assert isinstance(experiment.scripts, Scripts)
         assert experiment.time_between_run == 0
         assert experiment.output_root == paths.OUTPUT_DIR
-        assert experiment.result_file_structure is None
         assert mock_prepare.call_count == 0
 
     @patch('AndroidRunner.Experiment.Experiment.prepare_device')
@@ -92,7 +101,6 @@ class TestExperiment(object):
         assert isinstance(experiment.scripts, Scripts)
         assert experiment.time_between_run == 0
         assert experiment.output_root == paths.OUTPUT_DIR
-        assert experiment.result_file_structure is None
         assert mock_prepare.call_count == 3
         assert mock_prepare.mock_calls[0] == call('dev1', restart=True)
         assert mock_prepare.mock_calls[1] == call('dev2', restart=True)
@@ -124,14 +132,15 @@ class TestExperiment(object):
         assert isinstance(experiment.scripts, Scripts)
         assert experiment.time_between_run == 10
         assert experiment.output_root == paths.OUTPUT_DIR
-        assert experiment.result_file_structure is None
-        mock_devices.assert_called_once_with(['dev1', 'dev2'], adb_path='test_adb', devices_spec=None)
+        mock_devices.assert_called_once_with(['dev1', 'dev2'], adb_path='test_adb', devices_spec=None,
+                                             adb_backend='adb')
         mock_profilers.assert_called_once_with({'fake': {'config1': 1, 'config2': 2}})
         mock_scripts.assert_called_once_with({'script1': 'path/to/1'}, monkeyrunner_path='monkey_path')
         mock_test.assert_called_once_with(experiment.devices, [])
         assert mock_prepare.call_count == 0
 
-    def test_prepare_device(self, default_experiment):
+    @patch('AndroidRunner.Experiment.Experiment.write_device_info')
+    def test_prepare_device(self, write_device_info, default_experiment):
         mock_profilers = Mock()
         fake_device = Mock()
         mock_manager = Mock()
@@ -141,9 +150,26 @@ class TestExperiment(object):
 
         default_experiment.prepare_device(fake_device)
 
+        write_device_info.assert_called_once_with(fake_device)
         expected_calls = [call.mock_profilers.load(fake_device), call.fake_device.unplug(False)]
         assert mock_manager.mock_calls == expected_calls
 
+    def test_write_device_info(self, default_experiment, tmpdir):
+        fake_device = Mock()
+        fake_device.name = 'nexus6p'
+        fake_device.id = '123'
+        fake_device.get_info.return_value = DeviceInfo({'ro.build.version.release': '9',
+                                                        'ro.build.version.sdk': '28', 'ro.product.model': 'Nexus 6P'})
+        default_experiment.output_root = str(tmpdir)
+
+        default_experiment.write_device_info(fake_device)
+
+        with open(op.join(str(tmpdir), 'device_info_nexus6p.csv')) as f:
+            rows = list(csv.DictReader(f))
+        assert rows == [OrderedDict([('device', 'nexus6p'), ('id', '123'), ('version', '9'), ('api_level', '28'),
+                                     ('manufacturer', ''), ('model', 'Nexus 6P'), ('abi', ''),
+                                     ('build_fingerprint', '')])]
+
     def test_cleanup(self, default_experiment):
         mock_profilers = Mock()
         fake_device = Mock()
@@ -165,92 +191,52 @@ class TestExperiment(object):
         default_experiment.progress = mock_progress
         assert default_experiment.get_progress_xml_file() == xml_path
 
-    def test_update_progress_empty_folder(self, default_experiment, tmpdir):
-        mock_progress = Mock()
-        default_experiment.progress = mock_progress
+    def test_collect_result_files(self, default_experiment, tmpdir):
         paths.BASE_OUTPUT_DIR = str(tmpdir)
         makedirs(os.path.join(paths.BASE_OUTPUT_DIR, 'data'))
-        default_experiment.update_progress()
-
-        mock_progress.write_progress_to_file.assert_called_once()
-        result_walk_list = list(default_experiment.result_file_structure)
-        expected_walk_list = default_experiment.walk_to_list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        assert result_walk_list == expected_walk_list
-
-    def test_update_progress_non_empty_folder(self, default_experiment, tmpdir):
+        Manifest.start_run()
+        paths.OUTPUT_DIR = os.path.join(paths.BASE_OUTPUT_DIR, 'data', 'device', 'subject')
+        makedirs(os.path.join(paths.OUTPUT_DIR, 'trepn'))
+        util.write_to_file(os.path.join(paths.OUTPUT_DIR, 'trepn', 'test.csv'), [{'a': 1}])
+        open(os.path.join(paths.OUTPUT_DIR, 'unregistered.txt'), 'w+').close()
+
+        files = default_experiment.collect_result_files()
+
+        data_dir = os.path.join(paths.BASE_OUTPUT_DIR, 'data')
+        assert files == [os.path.join(data_dir, 'device'), os.path.join(data_dir, 'device', 'subject'),
+                         os.path.join(data_dir, 'device', 'subject', 'trepn'),
+                         os.path.join(data_dir, 'device', 'subject', 'trepn', 'test.csv')]
+        assert Manifest.current is None
+        assert default_experiment.collect_result_files() == []
+
+    def test_save_progress(self, default_experiment):
         mock_progress = Mock()
         default_experiment.progress = mock_progress
-        paths.BASE_OUTPUT_DIR = str(tmpdir)
-        folder_path = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '1', '2')
-        makedirs(folder_path)
-        open(os.path.join(folder_path, "test.txt"), "w+")
-        default_experiment.update_progress()
-
-        mock_progress.write_progress_to_file.assert_called_once()
-        result_walk_list = list(default_experiment.result_file_structure)
-        expected_walk_list = default_experiment.walk_to_list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        assert result_walk_list == expected_walk_list
-
-    def test_walk_to_list(self, default_experiment, tmpdir):
-        paths.BASE_OUTPUT_DIR = str(tmpdir)
-        folder_path1 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '1', '1')
-        folder_path2 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '2', '1')
-        makedirs(folder_path1), makedirs(folder_path2)
-        open(os.path.join(folder_path1, "test.txt"), "w+")
-        open(os.path.join(folder_path2, "test.txt"), "w+")
-
-        walk_list = default_experiment.walk_to_list(os.walk(paths.BASE_OUTPUT_DIR))
-        print(walk_list)
-        assert len(walk_list) == 7
-
-        files = ['data/1/1/test.txt', 'data/2/1/test.txt']
-        flags = [False]*2
-
-        for item in walk_list:
-            for i, file in enumerate(files):
-                flags[i] |= file in item
-        
-        assert(all(flags))
-
-    def test_check_result_files_correct(self, default_experiment, tmpdir):
-        paths.BASE_OUTPUT_DIR = str(tmpdir)
-        folder_path1 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '1', '1')
-        folder_path2 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '2', '1')
-        makedirs(folder_path1), makedirs(folder_path2)
-        open(os.path.join(folder_path1, "test.txt"), "w+")
-        open(os.path.join(folder_path2, "test.txt"), "w+")
-        correct_file_structure1 = os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data'))
-        correct_file_structure2 = os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data'))
 
-        default_experiment.check_result_files(correct_file_structure1)
+        default_experiment.save_progress('3', ['b', 'c'])
 
-        current_file_structure = os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data'))
+        mock_progress.journal_run.assert_called_once_with('3', ['b', 'c'])
 
-        assert list(current_file_structure) == list(correct_file_structure2)
-
-    def test_check_result_files_incorrect(self, default_experiment, tmpdir):
+    def test_finish_experiment_removes_unfinished_run(self, default_experiment, tmpdir):
         paths.BASE_OUTPUT_DIR = str(tmpdir)
-        folder_path1 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '1', '1')
-        folder_path2 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '2', '1')
-        folder_path3 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '3', '1')
-        makedirs(folder_path1), makedirs(folder_path2)
-        open(os.path.join(folder_path1, "test.txt"), "w+")
-        open(os.path.join(folder_path2, "test.txt"), "w+")
-
-        correct_file_structure_list1 = default_experiment.walk_to_list(
-            os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        correct_file_structure_list2 = list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-
-        makedirs(folder_path3)
-        open(os.path.join(folder_path3, "test.txt"), "w+")
-
-        incorrect_file_structure_list = list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        assert not correct_file_structure_list2 == incorrect_file_structure_list
+        data_dir = os.path.join(paths.BASE_OUTPUT_DIR, 'data')
+        Manifest.start_run()
+        makedirs(os.path.join(data_dir, '1', '1'))
+        util.write_to_file(os.path.join(data_dir, '1', '1', 'test.csv'), [{'a': 1}])
+        default_experiment.collect_result_files()
+        finished_run = list(os.walk(data_dir))
+        Manifest.start_run()
+        makedirs(os.path.join(data_dir, '1', '1'))
+        makedirs(os.path.join(data_dir, '2', '1'))
+        util.write_to_file(os.path.join(data_dir, '1', '1', 'test2.csv'), [{'a': 1}])
+        util.write_to_file(os.path.join(data_dir, '2', '1', 'test.csv'), [{'a': 1}])
+        default_experiment.progress = Mock()
+        default_experiment.devices = []
 
-        default_experiment.check_result_files(correct_file_structure_list1)
+        default_experiment.finish_experiment(True, False)
 
-        current_file_structure_list = list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        assert current_file_structure_list == correct_file_structure_list2
+        assert list(os.walk(data_dir)) == finished_run
+        assert Manifest.current is None
 
     def test_get_experiment(self, default_experiment):
         default_experiment.random = False
@@ -550,38 +536,61 @@ class TestExperiment(object):
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_regular_no_devices(self, check_result_files, cleanup, aggregate_end, default_experiment):
-        fake_file_structure = 'test_structure'
-        default_experiment.result_file_structure = fake_file_structure
+    @patch('AndroidRunner.Manifest.rollback_run')
+    def test_finish_experiment_regular_no_devices(self, rollback_run, cleanup, aggregate_end, default_experiment):
+        default_experiment.progress = Mock()
         default_experiment.devices = []
         mock_manager = Mock()
-        mock_manager.attach_mock(check_result_files, "check_result_files_managed")
+        mock_manager.attach_mock(default_experiment.progress, "progress_managed")
+        mock_manager.attach_mock(rollback_run, "rollback_run_managed")
         mock_manager.attach_mock(aggregate_end, "aggregate_end_managed")
 
         default_experiment.finish_experiment(False, False)
 
-        expected_calls = [call.check_result_files_managed(fake_file_structure),
+        expected_calls = [call.progress_managed.write_progress_to_file(unfinished=[]),
+                          call.rollback_run_managed(),
                           call.aggregate_end_managed()]
         assert mock_manager.mock_calls == expected_calls
         assert cleanup.call_count == 0
 
+    @patch('AndroidRunner.Experiment.Experiment.write_timing_summary')
+    @patch('AndroidRunner.Experiment.Experiment.get_experiment')
+    @patch('AndroidRunner.Experiment.Experiment.run_experiment')
+    @patch('AndroidRunner.Manifest.rollback_run')
+    def test_start_run_failed_after_marked_finished(self, rollback_run, run_experiment, get_experiment,
+                                                    write_timing_summary, default_experiment):
+        default_experiment.progress = Mock()
+        default_experiment.progress.get_schedule.return_value = []
+        default_experiment.progress.experiment_finished_check.return_value = False
+        default_experiment.devices = []
+        get_experiment.return_value = {'runId': '7'}
+        # E.g. after_last_run failed in finish_run
+        run_experiment.side_effect = KeyboardInterrupt
+        mock_manager = Mock()
+        mock_manager.attach_mock(default_experiment.progress, "progress_managed")
+        mock_manager.attach_mock(rollback_run, "rollback_run_managed")
+
+        with pytest.raises(KeyboardInterrupt):
+            default_experiment.start()
+
+        assert mock_manager.mock_calls[-2:] == [call.progress_managed.write_progress_to_file(unfinished=['7']),
+                                                call.rollback_run_managed()]
+
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_regular_multiple_devices(self, check_result_files, cleanup, aggregate_end,
+    @patch('AndroidRunner.Manifest.rollback_run')
+    def test_finish_experiment_regular_multiple_devices(self, rollback_run, cleanup, aggregate_end,
                                                         default_experiment):
-        fake_file_structure = 'test_structure'
-        default_experiment.result_file_structure = fake_file_structure
+        default_experiment.progress = Mock()
         default_experiment.devices = ['1', '2', '3']
         mock_manager = Mock()
-        mock_manager.attach_mock(check_result_files, "check_result_files_managed")
+        mock_manager.attach_mock(rollback_run, "rollback_run_managed")
         mock_manager.attach_mock(aggregate_end, "aggregate_end_managed")
         mock_manager.attach_mock(cleanup, "cleanup_managed")
 
         default_experiment.finish_experiment(False, False)
 
-        expected_calls = [call.check_result_files_managed(fake_file_structure),
+        expected_calls = [call.rollback_run_managed(),
                           call.cleanup_managed('1'),
                           call.cleanup_managed('2'),
                           call.cleanup_managed('3'),
@@ -590,49 +599,47 @@ class TestExperiment(object):
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_error(self, check_result_files, cleanup, aggregate_end, default_experiment):
-        fake_file_structure = 'test_structure'
+    @patch('AndroidRunner.Manifest.rollback_run')
+    def test_finish_experiment_error(self, rollback_run, cleanup, aggregate_end, default_experiment):
         default_experiment.devices = ['1']
-        default_experiment.result_file_structure = fake_file_structure
+        default_experiment.progress = Mock()
         default_experiment.finish_experiment(True, False)
 
-        check_result_files.assert_called_once_with(fake_file_structure)
+        rollback_run.assert_called_once_with()
         cleanup.assert_called_once_with('1')
         assert aggregate_end.call_count == 0
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_interrupted(self, check_result_files, cleanup, aggregate_end, default_experiment):
-        fake_file_structure = 'test_structure'
+    @patch('AndroidRunner.Manifest.rollback_run')
+    def test_finish_experiment_interrupted(self, rollback_run, cleanup, aggregate_end, default_experiment):
         default_experiment.devices = ['1']
-        default_experiment.result_file_structure = fake_file_structure
+        default_experiment.progress = Mock()
 
         default_experiment.finish_experiment(False, True)
 
-        check_result_files.assert_called_once_with(fake_file_structure)
+        rollback_run.assert_called_once_with()
         cleanup.assert_called_once_with('1')
         assert aggregate_end.call_count == 0
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_error_in_cleanup(self, check_result_files, cleanup, aggregate_end, default_experiment):
-        fake_file_structure = 'test_structure'
+    @patch('AndroidRunner.Manifest.rollback_run')
+    def test_finish_experiment_error_in_cleanup(self, rollback_run, cleanup, aggregate_end, default_experiment):
         default_experiment.devices = ['1']
-        default_experiment.result_file_structure = fake_file_structure
+        default_experiment.progress = Mock()
         cleanup.side_effect = Exception
         default_experiment.finish_experiment(True, False)
-        check_result_files.assert_called_once_with(fake_file_structure)
+        rollback_run.assert_called_once_with()
         cleanup.assert_called_once_with('1')
         assert aggregate_end.call_count == 0
 
     @patch('AndroidRunner.Experiment.Experiment.finish_run')
     @patch('AndroidRunner.Experiment.Experiment.run_run')
     @patch('AndroidRunner.Experiment.Experiment.prepare_run')
-    def test_run_experiment(self, prepare_run, run_run, finish_run, default_experiment):
-        test_run = Mock()
+    def test_run_experiment(self, prepare_run, run_run, finish_run, default_experiment, tmpdir):
+        paths.OUTPUT_DIR = str(tmpdir)
+        test_run = {'runId': '0', 'runCount': '1'}
         mock_manager = Mock()
         mock_manager.attach_mock(prepare_run, "prepare_run_managed")
         mock_manager.attach_mock(run_run, "run_run_managed")
@@ -644,20 +651,46 @@ class TestExperiment(object):
                           call.run_run_managed(test_run),
                           call.finish_run_managed(test_run)]
         assert mock_manager.mock_calls == expected_calls
+        assert Timing.current is None
+        assert [row['phase'] for row in Timing.summary.to_rows()] == ['prepare_run', 'run', 'finish_run']
+        with open(op.join(str(tmpdir), 'timing', 'run1.csv')) as f:
+            rows = list(csv.DictReader(f))
+        assert [(row['phase'], row['parent']) for row in rows] == [('prepare_run', ''), ('run', ''),
+                                                                   ('finish_run', '')]
+
+    def test_write_timing_summary(self, default_experiment, tmpdir):
+        default_experiment.output_root = str(tmpdir)
+        default_experiment.write_timing_summary()
+        assert not op.exists(op.join(str(tmpdir), 'timing_summary.csv'))
+        Timing.summary.add([('prepare_run', 1.0), ('run', 10.0), ('finish_run', 2.0)])
+        Timing.summary.add([('prepare_run', 3.0), ('run', 20.0), ('finish_run', 2.0)])
 
+        default_experiment.write_timing_summary()
+
+        with open(op.join(str(tmpdir), 'timing_summary.csv')) as f:
+            rows = list(csv.DictReader(f))
+        assert [(row['phase'], row['runs'], row['mean'], row['min'], row['max']) for row in rows] == [
+            ('prepare_run', '2', '2.000000', '1.000000', '3.000000'),
+            ('run', '2', '15.000000', '10.000000', '20.000000'),
+            ('finish_run', '2', '2.000000', '2.000000', '2.000000')]
+
+    @patch('AndroidRunner.Manifest.start_run')
     @patch('AndroidRunner.Experiment.Experiment.prepare_output_dir')
     @patch('AndroidRunner.Experiment.Experiment.first_run_device')
     @patch('AndroidRunner.Experiment.Experiment.before_every_run_subject')
-    def test_prepare_run(self, before_every_run_subject, first_run_device, prepare_output_dir, default_experiment):
+    def test_prepare_run(self, before_every_run_subject, first_run_device, prepare_output_dir, start_run,
+                         default_experiment):
         test_run = Mock()
         mock_manager = Mock()
+        mock_manager.attach_mock(start_run, "start_run_managed")
         mock_manager.attach_mock(before_every_run_subject, "before_every_run_subject_managed")
         mock_manager.attach_mock(first_run_device, "first_run_device_managed")
         mock_manager.attach_mock(prepare_output_dir, "prepare_output_dir_managed")
 
         default_experiment.prepare_run(test_run)
 
-        expected_calls = [call.prepare_output_dir_managed(test_run),
+        expected_calls = [call.start_run_managed(),
+                          call.prepare_output_dir_managed(test_run),
                           call.first_run_device_managed(test_run),
                           call.before_every_run_subject_managed(test_run)]
         assert mock_manager.mock_calls == expected_calls
@@ -702,88 +735,60 @@ class TestExperiment(object):
                           call.last_run_device_managed(test_run)]
         assert mock_manager.mock_calls == expected_calls
 
-    @patch('threading.Thread.join')
-    @patch('threading.Thread.start')
-    @patch('threading.Thread.__init__')
-    def test_save_progress(self, mock_threading_init, mock_threading_start, mock_threading_join, default_experiment):
-        mock_threading_init.return_value = None
-        mock_manager = Mock()
-        mock_manager.attach_mock(mock_threading_init, "mock_threading_init_managed")
-        mock_manager.attach_mock(mock_threading_start, "mock_threading_start_managed")
-        mock_manager.attach_mock(mock_threading_join, "mock_threading_join_managed")
-
-        default_experiment.save_progress()
-
-        expected_calls = [call.mock_threading_init_managed(target=default_experiment.update_progress),
-                          call.mock_threading_start_managed(),
-                          call.mock_threading_join_managed()]
-        assert mock_manager.mock_calls == expected_calls
-
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
     def test_start_error(self, finish_experiment_mock, capsys, default_experiment):
         mock_logger = Mock()
         default_experiment.logger = mock_logger
-        paths.BASE_OUTPUT_DIR = None  # raises TypeError
+        default_experiment.progress = Mock()
+        default_experiment.progress.get_schedule.return_value = []
+        default_experiment.progress.experiment_finished_check.side_effect = TypeError('progress is broken')
 
         with pytest.raises(Exception):
             default_experiment.start()
         captured = capsys.readouterr()  # Catch std out
         finish_experiment_mock.assert_called_once_with(True, False)
-        mock_logger.error.assert_called_once_with("TypeError: expected str, bytes or os.PathLike object, not NoneType")
+        mock_logger.error.assert_called_once_with("TypeError: progress is broken")
 
-    @patch("AndroidRunner.Experiment.Experiment.walk_to_list")
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
-    def test_start_interupt(self, finish_experiment_mock, walk_to_list_mock, default_experiment):
-        paths.BASE_OUTPUT_DIR = "test"
-        walk_to_list_mock.side_effect = KeyboardInterrupt
+    def test_start_interupt(self, finish_experiment_mock, default_experiment):
+        default_experiment.progress = Mock()
+        default_experiment.progress.get_schedule.return_value = []
+        default_experiment.progress.experiment_finished_check.side_effect = KeyboardInterrupt
         with pytest.raises(KeyboardInterrupt):
             default_experiment.start()
         finish_experiment_mock.assert_called_once_with(False, True)
 
-    @patch("AndroidRunner.Experiment.walk")
     @patch("AndroidRunner.Experiment.Experiment.get_experiment")
     @patch('AndroidRunner.Experiment.Experiment.run_experiment')
     @patch('AndroidRunner.Experiment.Experiment.save_progress')
-    @patch("AndroidRunner.Experiment.Experiment.walk_to_list")
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
-    def test_start_experiment_finished(self, finish_experiment_mock, walk_to_list_mock, save_progress_mock,
-                                       run_experiment_mock, get_experiment_mock, walk_mock, default_experiment):
-        paths.BASE_OUTPUT_DIR = "test"
-        mock_walk_to_list_result = Mock()
-        walk_to_list_mock.return_value = mock_walk_to_list_result
-        mock_walk_result = Mock()
-        walk_mock.return_value = mock_walk_result
+    def test_start_experiment_finished(self, finish_experiment_mock, save_progress_mock,
+                                       run_experiment_mock, get_experiment_mock, default_experiment):
         mock_progress = Mock()
+        mock_progress.get_schedule.return_value = []
         mock_progress.experiment_finished_check.return_value = True
         default_experiment.progress = mock_progress
 
         default_experiment.start()
 
         assert get_experiment_mock.call_count == run_experiment_mock.call_count == save_progress_mock.call_count == 0
-        walk_to_list_mock.assert_called_once_with(mock_walk_result)
         finish_experiment_mock.assert_called_once_with(False, False)
 
-    @patch("AndroidRunner.Experiment.walk")
     @patch("AndroidRunner.Experiment.Experiment.get_experiment")
     @patch('AndroidRunner.Experiment.Experiment.run_experiment')
     @patch('AndroidRunner.Experiment.Experiment.save_progress')
-    @patch("AndroidRunner.Experiment.Experiment.walk_to_list")
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
-    def test_start_experiment_one_run(self, finish_experiment_mock, walk_to_list_mock, save_progress_mock,
-                                      run_experiment_mock, get_experiment_mock, walk_mock, default_experiment):
-        paths.BASE_OUTPUT_DIR = "test"
-        mock_walk_to_list_result = Mock()
-        walk_to_list_mock.return_value = mock_walk_to_list_result
-        mock_walk_result = Mock()
-        walk_mock.return_value = mock_walk_result
+    @patch('AndroidRunner.Experiment.Experiment.collect_result_files')
+    def test_start_experiment_one_run(self, collect_result_files_mock, finish_experiment_mock,
+                                      save_progress_mock, run_experiment_mock, get_experiment_mock, default_experiment):
         mock_progress = Mock()
+        mock_progress.get_schedule.return_value = []
         mock_progress.experiment_finished_check.side_effect = [False, True]
         default_experiment.progress = mock_progress
-        mock_get_experiment_result = Mock()
+        mock_get_experiment_result = {'runId': '0'}
         get_experiment_mock.return_value = mock_get_experiment_result
+        collect_result_files_mock.return_value = ['file']
         mock_manager = Mock()
-        mock_manager.attach_mock(walk_mock, 'walk_mock_managed')
-        mock_manager.attach_mock(walk_to_list_mock, 'walk_to_list_managed')
         mock_manager.attach_mock(mock_progress, 'mock_progress_managed')
         mock_manager.attach_mock(get_experiment_mock, 'get_experiment_managed')
         mock_manager.attach_mock(run_experiment_mock, 'run_experiment_managed')
@@ -791,39 +796,215 @@ class TestExperiment(object):
         mock_manager.attach_mock(finish_experiment_mock, 'finish_experiment_managed')
 
         default_experiment.start()
-        expected_calls = [call.walk_mock_managed(os.path.join('test', 'data')),
-                          call.walk_to_list_managed(mock_walk_result),
+        expected_calls = [call.mock_progress_managed.get_schedule(),
                           call.mock_progress_managed.experiment_finished_check(),
                           call.get_experiment_managed(),
                           call.run_experiment_managed(mock_get_experiment_result),
-                          call.save_progress_managed(),
+                          call.save_progress_managed('0', ['file']),
                           call.mock_progress_managed.experiment_finished_check(),
                           call.finish_experiment_managed(False, False)]
         assert mock_manager.mock_calls == expected_calls
 
-    @patch("AndroidRunner.Experiment.walk")
     @patch("AndroidRunner.Experiment.Experiment.get_experiment")
     @patch('AndroidRunner.Experiment.Experiment.run_experiment')
     @patch('AndroidRunner.Experiment.Experiment.save_progress')
-    @patch("AndroidRunner.Experiment.Experiment.walk_to_list")
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
-    def test_start_experiment_multiple_runs(self, finish_experiment_mock, walk_to_list_mock, save_progress_mock,
-                                            run_experiment_mock, get_experiment_mock, walk_mock, default_experiment):
-        paths.BASE_OUTPUT_DIR = "test"
-        mock_walk_to_list_result = Mock()
-        walk_to_list_mock.return_value = mock_walk_to_list_result
-        mock_walk_result = Mock()
-        walk_mock.return_value = mock_walk_result
+    @patch('AndroidRunner.Experiment.Experiment.collect_result_files')
+    def test_start_experiment_multiple_runs(self, collect_result_files_mock, finish_experiment_mock,
+                                            save_progress_mock, run_experiment_mock,
+                                            get_experiment_mock, default_experiment):
         mock_progress = Mock()
+        mock_progress.get_schedule.return_value = []
         mock_progress.experiment_finished_check.side_effect = [False] * 9 + [True]
         default_experiment.progress = mock_progress
-        mock_get_experiment_result = Mock()
+        mock_get_experiment_result = MagicMock()
         get_experiment_mock.return_value = mock_get_experiment_result
 
         default_experiment.start()
 
         assert get_experiment_mock.call_count == run_experiment_mock.call_count == save_progress_mock.call_count == 9
 
+    @patch('AndroidRunner.Experiment.Experiment.run_devices_parallel')
+    @patch('AndroidRunner.Experiment.Experiment.run_experiment')
+    @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
+    def test_start_parallel_devices(self, finish_experiment_mock, run_experiment_mock,
+                                    run_devices_parallel_mock, default_experiment):
+        mock_progress = Mock()
+        mock_progress.get_schedule.return_value = []
+        mock_progress.experiment_finished_check.return_value = True
+        default_experiment.progress = mock_progress
+        default_experiment.parallel_devices = True
+
+        default_experiment.start()
+
+        run_devices_parallel_mock.assert_called_once()
+        assert run_experiment_mock.call_count == 0
+        finish_experiment_mock.assert_called_once_with(False, False)
+
+    @patch('AndroidRunner.Experiment.Experiment.collect_result_files')
+    @patch('AndroidRunner.Experiment.Experiment.run_experiment')
+    @patch('AndroidRunner.Experiment.Experiment.get_experiment')
+    def test_device_worker(self, get_experiment_mock, run_experiment_mock, collect_result_files_mock,
+                           default_experiment):
+        mock_progress = Mock()
+        mock_progress.device_finished.side_effect = [False, False, True]
+        default_experiment.progress = mock_progress
+        runs = [{'runId': '3', 'device': 'dev1'}, {'runId': '4', 'device': 'dev1'}]
+        get_experiment_mock.side_effect = runs
+        collect_result_files_mock.side_effect = [['file3'], ['file4']]
+        mock_queue = Mock()
+
+        default_experiment.device_worker(mock_queue, 'dev1', Mock(**{'is_set.return_value': False}))
+
+        assert get_experiment_mock.mock_calls == [call('dev1'), call('dev1')]
+        assert run_experiment_mock.mock_calls == [call(runs[0]), call(runs[1])]
+        assert mock_queue.put.mock_calls == [call(('run', 'dev1', '3', ['file3'])),
+                                             call(('run', 'dev1', '4', ['file4'])),
+                                             call(('done', 'dev1', Timing.summary))]
+
+    @patch('AndroidRunner.Manifest.rollback_run')
+    @patch('AndroidRunner.Experiment.Experiment.run_experiment')
+    @patch('AndroidRunner.Experiment.Experiment.get_experiment')
+    def test_device_worker_error(self, get_experiment_mock, run_experiment_mock, rollback_run, default_experiment):
+        mock_progress = Mock()
+        mock_progress.device_finished.return_value = False
+        default_experiment.progress = mock_progress
+        run_experiment_mock.side_effect = ValueError('run failed')
+        mock_queue = Mock()
+
+        default_experiment.device_worker(mock_queue, 'dev1', Mock(**{'is_set.return_value': False}))
+
+        rollback_run.assert_called_once_with()
+        message = mock_queue.put.call_args[0][0]
+        assert message[:2] == ('error', 'dev1')
+        assert 'ValueError: run failed' in message[2]
+
+    @patch('AndroidRunner.Experiment.Experiment.collect_result_files')
+    @patch('AndroidRunner.Experiment.Experiment.run_experiment')
+    @patch('AndroidRunner.Experiment.Experiment.get_experiment')
+    def test_device_worker_stopped(self, get_experiment_mock, run_experiment_mock, collect_result_files_mock,
+                                   default_experiment):
+        mock_progress = Mock()
+        mock_progress.device_finished.return_value = False
+        default_experiment.progress = mock_progress
+        get_experiment_mock.return_value = {'runId': '3', 'device': 'dev1'}
+        collect_result_files_mock.return_value = ['file3']
+        mock_stop = Mock()
+        mock_stop.is_set.side_effect = [False, True]
+        mock_queue = Mock()
+
+        default_experiment.device_worker(mock_queue, 'dev1', mock_stop)
+
+        assert run_experiment_mock.call_count == 1
+        assert mock_queue.put.mock_calls == [call(('run', 'dev1', '3', ['file3'])),
+                                             call(('done', 'dev1', Timing.summary))]
+
+    @staticmethod
+    def fake_device_worker(experiment, queue, device, stop):
+        for run_id in {'dev1': ['0', '1'], 'dev2': ['2']}[device]:
+            queue.put(('run', device, run_id, [run_id + '.csv']))
+        summary = Timing.Summary()
+        summary.add([('run', 1.0)])
+        queue.put(('done', device, summary))
+
+    def test_report_schedule(self, default_experiment):
+        default_experiment.progress = Mock()
+        default_experiment.progress.get_schedule.return_value = [
+            Run('0', 'dev1', 'path1', None, 1), Run('1', 'dev2', 'path1', None, 1),
+            Run('2', 'dev1', 'path1', None, 2), Run('3', 'dev1', 'path2', None, 1)]
+        default_experiment.logger = Mock()
+
+        default_experiment.report_schedule()
+        default_experiment.parallel_devices = True
+        default_experiment.report_schedule()
+
+        assert default_experiment.logger.info.mock_calls == [
+            call('Schedule: 4 runs, 3 subject setups, 2 device changes'), call('Schedule: 4 runs, 3 subject setups')]
+
+    @patch('AndroidRunner.Experiment.Experiment.save_progress')
+    def test_run_devices_parallel(self, save_progress_mock, default_experiment):
+        mock_progress = Mock()
+        mock_progress.get_devices_to_run.return_value = ['dev1', 'dev2']
+        default_experiment.progress = mock_progress
+
+        with patch('AndroidRunner.Experiment.Experiment.device_worker', self.fake_device_worker):
+            default_experiment.run_devices_parallel()
+
+        finished = [c[1][0] for c in mock_progress.run_finished.mock_calls]
+        assert sorted(finished) == ['0', '1', '2']
+        assert finished.index('0') < finished.index('1')
+        assert sorted(save_progress_mock.mock_calls) == [call('0', ['0.csv']), call('1', ['1.csv']),
+                                                         call('2', ['2.csv'])]
+        assert Timing.summary.phases['run'] == (2, 2.0, 1.0, 1.0)
+
+    @staticmethod
+    def failing_device_worker(experiment, queue, device, stop):
+        if device == 'dev1':
+            queue.put(('error', device, 'ValueError: run failed'))
+        else:
+            time.sleep(60)
+
+    @patch('AndroidRunner.Experiment.Experiment.save_progress')
+    def test_run_devices_parallel_error(self, save_progress_mock, default_experiment):
+        mock_progress = Mock()
+        mock_progress.get_devices_to_run.return_value = ['dev1', 'dev2']
+        default_experiment.progress = mock_progress
+        default_experiment.WORKER_STOP_TIMEOUT = 1
+
+        with patch('AndroidRunner.Experiment.Experiment.device_worker', self.failing_device_worker):
+            with pytest.raises(ExperimentError) as except_result:
+                default_experiment.run_devices_parallel()
+
+        assert str(except_result.value) == 'dev1: ValueError: run failed'
+        assert save_progress_mock.call_count == 0
+
+    @staticmethod
+    def interrupted_run(output_file, experiment, current_run):
+        Manifest.start_run()
+        if current_run['device'] == 'dev1':
+            # Fails once the run of dev2 wrote its output
+            while not op.exists(output_file):
+                time.sleep(0.01)
+            raise ValueError('run failed')
+        util.write_to_file(output_file, [{'a': 1}])
+        time.sleep(60)
+
+    @patch('AndroidRunner.Experiment.Experiment.save_progress')
+    @patch('AndroidRunner.Experiment.Experiment.get_experiment')
+    def test_run_devices_parallel_error_rollback_sibling(self, get_experiment_mock, save_progress_mock,
+                                                          default_experiment, tmpdir):
+        mock_progress = Mock()
+        mock_progress.get_devices_to_run.return_value = ['dev1', 'dev2']
+        mock_progress.device_finished.return_value = False
+        default_experiment.progress = mock_progress
+        default_experiment.WORKER_STOP_TIMEOUT = 1
+        get_experiment_mock.side_effect = lambda device: {'runId': device, 'device': device}
+        output_file = op.join(str(tmpdir), 'dev2.csv')
+
+        with patch('AndroidRunner.Experiment.Experiment.run_experiment',
+                   lambda experiment, current_run: self.interrupted_run(output_file, experiment, current_run)):
+            with pytest.raises(ExperimentError) as except_result:
+                default_experiment.run_devices_parallel()
+
+        assert str(except_result.value).startswith('dev1: ValueError: run failed')
+        assert not op.exists(output_file)
+        assert save_progress_mock.call_count == 0
+
+    @staticmethod
+    def dying_device_worker(experiment, queue, device, stop):
+        os._exit(1)
+
+    def test_run_devices_parallel_worker_died(self, default_experiment):
+        mock_progress = Mock()
+        mock_progress.get_devices_to_run.return_value = ['dev1']
+        default_experiment.progress = mock_progress
+
+        with patch('AndroidRunner.Experiment.Experiment.device_worker', self.dying_device_worker):
+            with pytest.raises(ExperimentError) as except_result:
+                default_experiment.run_devices_parallel()
+
+        assert 'dev1: Worker stopped unexpectedly' in str(except_result.value)
+
 
 class TestWebExperiment(object):
     @pytest.fixture()
@@ -961,10 +1142,11 @@ class TestWebExperiment(object):
 
         before_run_subject.assert_called_once_with(mock_device, path)
 
-    @patch('time.sleep')
+    @patch('AndroidRunner.Waits.activity_focused')
     @patch('AndroidRunner.Experiment.Experiment.before_run')
-    def test_before_run(self, before_run, sleep, web_experiment):
+    def test_before_run(self, before_run, activity_focused, web_experiment):
         mock_browser = Mock()
+        mock_browser.package_name = 'com.browser'
         args = (mock_browser, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
@@ -976,13 +1158,13 @@ class TestWebExperiment(object):
         mock_manager = Mock()
         mock_manager.attach_mock(before_run, "before_run_managed")
         mock_manager.attach_mock(mock_browser, "mock_browser_managed")
-        mock_manager.attach_mock(sleep, "sleep_managed")
+        mock_manager.attach_mock(activity_focused, "activity_focused_managed")
 
         web_experiment.before_run(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.before_run_managed(mock_device, path, run),
                           call.mock_browser_managed.start(mock_device),
-                          call.sleep_managed(5)]
+                          call.activity_focused_managed(mock_device, 'com.browser')]
         assert mock_manager.mock_calls == expected_calls
 
     @patch('time.sleep')
@@ -1007,10 +1189,11 @@ class TestWebExperiment(object):
                           call.sleep_managed(web_experiment.duration)]
         assert mock_manager.mock_calls == expected_calls
 
-    @patch('time.sleep')
+    @patch('AndroidRunner.Waits.process_gone')
     @patch('AndroidRunner.Experiment.Experiment.after_run')
-    def test_after_run(self, after_run,  sleep, web_experiment):
+    def test_after_run(self, after_run, process_gone, web_experiment):
         mock_browser = Mock()
+        mock_browser.package_name = 'com.browser'
         args = (mock_browser, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
@@ -1021,13 +1204,13 @@ class TestWebExperiment(object):
         run = 123456789
         mock_manager = Mock()
         mock_manager.attach_mock(mock_browser, "mock_browser_managed")
-        mock_manager.attach_mock(sleep, "sleep_managed")
+        mock_manager.attach_mock(process_gone, "process_gone_managed")
         mock_manager.attach_mock(after_run, "after_run_managed")
 
         web_experiment.after_run(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.mock_browser_managed.stop(mock_device, clear_data=True),
-                          call.sleep_managed(3),
+                          call.process_gone_managed(mock_device, 'com.browser'),
                           call.after_run_managed(mock_device, path, run)]
         assert mock_manager.mock_calls == expected_calls
 
@@ -1113,6 +1296,53 @@ class TestNativeExperiment(object):
         experiment.assert_called_once_with(config, None, False)
         isfile.assert_called_once_with(test_paths[0])
 
+    @patch('AndroidRunner.NativeExperiment.NativeExperiment.install_apks')
+    @patch('AndroidRunner.Experiment.Experiment.start')
+    def test_start_preinstall(self, start, install_apks, native_experiment):
+        native_experiment.start()
+        assert install_apks.call_count == 0
+
+        native_experiment.preinstall_apks = True
+        native_experiment.start()
+        install_apks.assert_called_once()
+        assert start.call_count == 2
+
+    @patch('AndroidRunner.NativeExperiment.NativeExperiment.install_device_apks')
+    def test_install_apks(self, install_device_apks, native_experiment, tmpdir):
+        apk1 = op.join(str(tmpdir), 'com.app.1.apk')
+        apk2 = op.join(str(tmpdir), 'com.app.2.apk')
+        for apk in (apk1, apk2):
+            with open(apk, 'wb') as f:
+                f.write(apk.encode())
+        native_experiment.paths = [apk1, apk2]
+        native_experiment.progress = Mock()
+        native_experiment.progress.get_devices_to_run.return_value = ['dev1', 'dev2']
+        runs = {'dev1': [apk1, apk2, apk1, 'com.pre.installed'], 'dev2': [apk2]}
+        native_experiment.progress.get_runs_to_run.side_effect = \
+            lambda device: [{'path': path} for path in runs[device]]
+        devices = {'dev1': Mock(), 'dev2': Mock()}
+        native_experiment.devices = Mock()
+        native_experiment.devices.get_device.side_effect = lambda name: devices[name]
+
+        native_experiment.install_apks()
+
+        hashes = {apk1: util.file_md5(apk1), apk2: util.file_md5(apk2)}
+        assert install_device_apks.call_count == 2
+        install_device_apks.assert_any_call(devices['dev1'], [apk1, apk2], hashes)
+        install_device_apks.assert_any_call(devices['dev2'], [apk2], hashes)
+
+    def test_install_device_apks(self, native_experiment):
+        mock_device = Mock()
+        mock_device.get_app_list.return_value = {'com.app.same', 'com.app.changed'}
+        mock_device.get_apk_hash.side_effect = lambda package: {'com.app.same': 'hash1', 'com.app.changed': 'old'}[
+            package]
+        apks = ['test/com.app.same.apk', 'test/com.app.changed.apk', 'test/com.app.new.apk']
+        hashes = {'test/com.app.same.apk': 'hash1', 'test/com.app.changed.apk': 'new', 'test/com.app.new.apk': 'hash3'}
+
+        native_experiment.install_device_apks(mock_device, apks, hashes)
+
+        assert mock_device.install.mock_calls == [call('test/com.app.changed.apk'), call('test/com.app.new.apk')]
+
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
     def test_cleanup_app_not_installed(self, cleanup, native_experiment):
         mock_device = Mock()
@@ -1165,24 +1395,44 @@ class TestNativeExperiment(object):
         assert mock_device.get_app_list.call_count == 0
         assert native_experiment.package == 'com.test.app'
 
+    @patch('AndroidRunner.NativeExperiment.file_md5')
     @patch('AndroidRunner.Experiment.Experiment.before_run_subject')
-    def test_before_run_subject_in_app_list(self, before_run_subject, native_experiment):
+    def test_before_run_subject_in_app_list(self, before_run_subject, file_md5, native_experiment):
         args = (1, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
-        test_package = 'com.test.app.apk'
-        path = os.path.join('test', test_package)
-        mock_device.get_app_list.return_value = [test_package]
+        test_package = 'com.test.app'
+        path = os.path.join('test', test_package + '.apk')
+        mock_device.get_app_list.return_value = {test_package}
+        mock_device.get_apk_hash.return_value = 'hash1'
+        file_md5.return_value = 'hash1'
 
+        native_experiment.before_run_subject(mock_device, path, *args, **kwargs)
         native_experiment.before_run_subject(mock_device, path, *args, **kwargs)
 
-        before_run_subject.assert_called_once_with(mock_device, path)
-        mock_device.get_app_list.assert_called_once()
+        assert before_run_subject.mock_calls == [call(mock_device, path)] * 2
+        file_md5.assert_called_once_with(path)
+        mock_device.get_apk_hash.assert_called_with(test_package)
         assert mock_device.install.call_count == 0
         assert native_experiment.package == 'com.test.app'
 
+    @patch('AndroidRunner.NativeExperiment.file_md5')
+    @patch('AndroidRunner.Experiment.Experiment.before_run_subject')
+    def test_before_run_subject_other_build_installed(self, before_run_subject, file_md5, native_experiment):
+        mock_device = Mock()
+        path = os.path.join('test', 'com.test.app.apk')
+        mock_device.get_app_list.return_value = {'com.test.app'}
+        mock_device.get_apk_hash.return_value = 'old'
+        file_md5.return_value = 'new'
+
+        native_experiment.before_run_subject(mock_device, path)
+
+        mock_device.install.assert_called_once_with(path)
+        assert native_experiment.package == 'com.test.app'
+
+    @patch('AndroidRunner.NativeExperiment.file_md5')
     @patch('AndroidRunner.Experiment.Experiment.before_run_subject')
-    def test_before_run_subject_app_not_installed(self, before_run_subject, native_experiment):
+    def test_before_run_subject_app_not_installed(self, before_run_subject, file_md5, native_experiment):
         args = (1, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
@@ -1197,9 +1447,10 @@ class TestNativeExperiment(object):
         mock_device.install.assert_called_once_with(path)
         assert native_experiment.package == 'com.test.app'
 
+    @patch('AndroidRunner.Waits.activity_focused')
     @patch('AndroidRunner.Experiment.Experiment.after_launch')
     @patch('AndroidRunner.Experiment.Experiment.before_run')
-    def test_before_run(self, before_run, after_launch, native_experiment):
+    def test_before_run(self, before_run, after_launch, activity_focused, native_experiment):
         args = (1, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
@@ -1213,11 +1464,13 @@ class TestNativeExperiment(object):
         mock_manager.attach_mock(before_run, 'before_run_managed')
         mock_manager.attach_mock(mock_device, 'mock_device_managed')
         mock_manager.attach_mock(after_launch, 'after_launch_managed')
+        mock_manager.attach_mock(activity_focused, 'activity_focused_managed')
 
         native_experiment.before_run(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.before_run_managed(mock_device, path, run),
                           call.mock_device_managed.launch_package('com.test.app'),
+                          call.activity_focused_managed(mock_device, 'com.test.app'),
                           call.after_launch_managed(mock_device, path, run)]
         assert mock_manager.mock_calls == expected_calls
 
@@ -1240,8 +1493,9 @@ class TestNativeExperiment(object):
                           call.sleep_managed(native_experiment.duration)]
         assert mock_manager.mock_calls == expected_calls
 
+    @patch('AndroidRunner.Waits.process_gone')
     @patch('AndroidRunner.Experiment.Experiment.after_run')
-    def test_after_run(self, after_run, native_experiment):
+    def test_after_run(self, after_run, process_gone, native_experiment):
         args = (1, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
@@ -1254,11 +1508,13 @@ class TestNativeExperiment(object):
         mock_manager = Mock()
         mock_manager.attach_mock(mock_device, 'mock_device_managed')
         mock_manager.attach_mock(after_run, 'after_run_managed')
+        mock_manager.attach_mock(process_gone, 'process_gone_managed')
 
         native_experiment.after_run(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.mock_device_managed.current_activity(),
                           call.mock_device_managed.force_stop(native_experiment.package),
+                          call.process_gone_managed(mock_device, 'com.test.app'),
                           call.after_run_managed(mock_device, path, run)]
         assert mock_manager.mock_calls == expected_calls
 
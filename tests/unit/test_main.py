@@ -103,6 +103,27 @@ class TestRunnerMain(object):
         assert result_args.get('file') == fake_filename
         assert result_args.get('progress') == fake_progress_file
 
+    def test_parse_arguments_dry_run(self):
+        result_args = main.parse_arguments(['test/file/name', '--dry-run'])
+
+        assert result_args == {'file': 'test/file/name', 'dry_run': True}
+
+    @patch('runner_main.DryRun')
+    @patch('runner_main.setup_paths')
+    @patch('runner_main.parse_arguments')
+    def test_main_dry_run(self, parse_arguments_mock, setup_paths_mock, dry_run_mock, capsys):
+        parse_arguments_mock.return_value = {'file': 'config.json', 'dry_run': True, 'progress': 'progress.xml'}
+        dry_run_mock.return_value.report.return_value = 'report'
+
+        main.main()
+
+        log_dir = setup_paths_mock.call_args[0][1]
+        assert setup_paths_mock.call_args[0][0] == op.abspath('config.json')
+        assert not op.exists(log_dir)
+        dry_run_mock.assert_called_once_with(op.abspath('config.json'), progress_file='progress.xml')
+        dry_run_mock.return_value.run.assert_called_once_with()
+        assert capsys.readouterr().out == 'report\n'
+
     def test_set_progress_new(self, tmpdir):
         temp_config_file = op.join(str(tmpdir), 'fake_config.json')
         open(temp_config_file, "w+")
@@ -0,0 +1,126 @@
+import os
+
+import pytest
+from mock import patch
+
+import AndroidRunner.Manifest as Manifest
+from AndroidRunner import util
+
+
+class TestManifest(object):
+    @pytest.fixture(autouse=True)
+    def no_run(self):
+        Manifest.current = None
+        Manifest.snapshots = {}
+        yield
+        Manifest.current = None
+        Manifest.snapshots = {}
+
+    def test_register_outside_run(self, tmpdir):
+        Manifest.register(os.path.join(str(tmpdir), 'file.txt'))
+
+        assert Manifest.current is None
+        assert Manifest.end_run().paths == []
+
+    def test_register_in_order_once(self, tmpdir):
+        manifest = Manifest.start_run()
+        Manifest.register(os.path.join(str(tmpdir), 'a'))
+        Manifest.register(os.path.join(str(tmpdir), 'b', '..', 'a'))
+        Manifest.register(os.path.join(str(tmpdir), 'c'))
+
+        assert Manifest.end_run() is manifest
+        assert manifest.paths == [os.path.join(str(tmpdir), 'a'), os.path.join(str(tmpdir), 'c')]
+        assert Manifest.current is None
+
+    def test_makedirs_registers_created_directories(self, tmpdir):
+        util.makedirs(os.path.join(str(tmpdir), 'existing'))
+        Manifest.start_run()
+
+        util.makedirs(os.path.join(str(tmpdir), 'existing', 'device', 'subject'))
+        util.makedirs(os.path.join(str(tmpdir), 'existing', 'device', 'subject'))
+
+        assert Manifest.end_run().paths == [os.path.join(str(tmpdir), 'existing', 'device'),
+                                            os.path.join(str(tmpdir), 'existing', 'device', 'subject')]
+
+    def test_rollback_run(self, tmpdir):
+        subject_dir = os.path.join(str(tmpdir), 'data', 'device', 'subject')
+        util.makedirs(subject_dir)
+        open(os.path.join(subject_dir, 'previous_run.csv'), 'w').close()
+        Manifest.start_run()
+        util.makedirs(os.path.join(subject_dir, 'android'))
+        util.makedirs(os.path.join(str(tmpdir), 'data', 'device2', 'subject'))
+        util.write_to_file(os.path.join(subject_dir, 'android', 'run.csv'), [{'a': 1}])
+        util.write_to_file(os.path.join(subject_dir, 'run.csv'), [{'a': 1}])
+        Manifest.register(os.path.join(subject_dir, 'removed_by_profiler.txt'))
+
+        Manifest.rollback_run()
+
+        assert os.listdir(str(tmpdir)) == ['data']
+        assert os.listdir(os.path.join(str(tmpdir), 'data')) == ['device']
+        assert os.listdir(subject_dir) == ['previous_run.csv']
+        assert Manifest.current is None
+
+    def test_rollback_keeps_unregistered_files(self, tmpdir):
+        Manifest.start_run()
+        util.makedirs(os.path.join(str(tmpdir), 'data', 'device'))
+        open(os.path.join(str(tmpdir), 'data', 'device', 'script_output.txt'), 'w').close()
+
+        Manifest.rollback_run()
+
+        assert os.listdir(os.path.join(str(tmpdir), 'data', 'device')) == ['script_output.txt']
+
+    def test_rollback_watched_directory(self, tmpdir):
+        subject_dir = os.path.join(str(tmpdir), 'data', 'device', 'subject')
+        os.makedirs(os.path.join(subject_dir, 'profiler'))
+        open(os.path.join(subject_dir, 'profiler', 'previous_run.csv'), 'w').close()
+        Manifest.start_run()
+        Manifest.watch(subject_dir)
+        os.makedirs(os.path.join(subject_dir, 'script', 'logs'))
+        open(os.path.join(subject_dir, 'script', 'logs', 'output.txt'), 'w').close()
+        open(os.path.join(subject_dir, 'profiler', 'run.csv'), 'w').close()
+        util.write_to_file(os.path.join(subject_dir, 'profiler', 'registered.csv'), [{'a': 1}])
+
+        Manifest.rollback_run()
+
+        assert os.listdir(subject_dir) == ['profiler']
+        assert os.listdir(os.path.join(subject_dir, 'profiler')) == ['previous_run.csv']
+
+    def test_end_run_keeps_watched_files(self, tmpdir):
+        Manifest.start_run()
+        Manifest.watch(str(tmpdir))
+        open(os.path.join(str(tmpdir), 'output.txt'), 'w').close()
+        Manifest.end_run()
+
+        Manifest.rollback_run()
+
+        assert os.listdir(str(tmpdir)) == ['output.txt']
+
+    def test_watch_walks_once(self, tmpdir):
+        with patch('AndroidRunner.Manifest.walk', wraps=Manifest.walk) as walk:
+            for run in range(3):
+                Manifest.start_run()
+                Manifest.watch(str(tmpdir))
+                util.write_to_file(os.path.join(str(tmpdir), 'run%d.csv' % run), [{'a': 1}])
+                Manifest.end_run()
+
+        walk.assert_called_once_with(os.path.normpath(str(tmpdir)))
+        assert Manifest.snapshots[os.path.normpath(str(tmpdir))] == {
+            os.path.join(str(tmpdir), 'run%d.csv' % run) for run in range(3)}
+
+    def test_rollback_keeps_files_of_finished_runs(self, tmpdir):
+        Manifest.start_run()
+        Manifest.watch(str(tmpdir))
+        util.write_to_file(os.path.join(str(tmpdir), 'registered.csv'), [{'a': 1}])
+        open(os.path.join(str(tmpdir), 'script_output.txt'), 'w').close()
+        Manifest.end_run()
+        # The next run starts later than the files of the finished run were written
+        for name in ('registered.csv', 'script_output.txt'):
+            os.utime(os.path.join(str(tmpdir), name), (0, 0))
+        Manifest.start_run()
+        Manifest.watch(str(tmpdir))
+        util.write_to_file(os.path.join(str(tmpdir), 'run.csv'), [{'a': 1}])
+        open(os.path.join(str(tmpdir), 'run_output.txt'), 'w').close()
+
+        Manifest.rollback_run()
+
+        assert sorted(os.listdir(str(tmpdir))) == ['registered.csv', 'script_output.txt']
@@ -8,7 +8,8 @@ import pdb
 
 import paths
 from AndroidRunner import util
-from AndroidRunner.Plugins.Android import Android
+from AndroidRunner.Plugins import AndroidDataPoints
+from AndroidRunner.Plugins.Android import Android, SampleBuffer
 from AndroidRunner.Plugins.Batterystats import Batterystats
 from AndroidRunner.Plugins.Profiler import Profiler
 from AndroidRunner.Plugins.Trepn import Trepn
@@ -68,7 +69,14 @@ class TestPluginTemplate(object):
 class TestAndroidPlugin(object):
     @pytest.fixture()
     def mock_device(self):
-        return Mock()
+        device = Mock()
+        device.clock_offset.return_value = (0.5, 0.01)
+        device.uptime_offset.return_value = (-1599999900.0, 0.005)
+        return device
+
+    @staticmethod
+    def start_clock(plugin):
+        plugin.wall_start, plugin.monotonic_start, plugin.clock_offset = 1600000000.0, 10.0, 0.5
 
     @pytest.fixture()
     def fixture_dir(self):
@@ -107,7 +115,8 @@ class TestAndroidPlugin(object):
         assert ap.profile is False
         assert ap.interval == 1
         assert ap.data_points == ['cpu', 'mem']
-        assert ap.data == [['datetime', 'cpu', 'mem']]
+        assert ap.data.header() == ['datetime', 'cpu', 'mem']
+        assert len(ap.data) == 0
 
     @patch('logging.Logger.warning')
     def test_android_plugin_invalid_datapoints(self, logger_warning):
@@ -120,7 +129,8 @@ class TestAndroidPlugin(object):
         assert ap.profile is False
         assert ap.interval == 1
         assert ap.data_points == ['cpu', 'mem']
-        assert ap.data == [['datetime', 'cpu', 'mem']]
+        assert ap.data.header() == ['datetime', 'cpu', 'mem']
+        assert len(ap.data) == 0
         logger_warning.assert_called_once_with("Invalid data points in config: ['invalid']")
 
     def test_android_plugin_default_interval(self):
@@ -133,112 +143,136 @@ class TestAndroidPlugin(object):
         assert ap.profile is False
         assert ap.interval == 0
         assert ap.data_points == ['cpu', 'mem']
-        assert ap.data == [['datetime', 'cpu', 'mem']]
+        assert ap.data.header() == ['datetime', 'cpu', 'mem']
+        assert len(ap.data) == 0
 
-    def test_get_cpu_usage(self, android_plugin, mock_device):
-        mock_device.shell.return_value = '30% TOTAL: 21% user + 6.7% kernel + 1.2% iowait + 0.7% irq + 0.5% softirq'
-        cpu_usage = android_plugin.get_cpu_usage(mock_device)
+    @patch('AndroidRunner.Plugins.Android.Android.get_data')
+    def test_start_profiling_with_app(self, get_data_mock, android_plugin, mock_device):
+        android_plugin.data.append(1600000000000, {'cpu': '12.5'})
+        kwargs = {'arg1': 1, 'app': 'test.app'}
+        android_plugin.start_profiling(mock_device, **kwargs)
+        android_plugin.sampler.join()
 
-        assert cpu_usage == '30'
-        mock_device.shell.assert_called_once_with('dumpsys cpuinfo | grep TOTAL')
+        assert android_plugin.profile is True
+        assert len(android_plugin.data) == 0
+        assert (android_plugin.clock_offset, android_plugin.clock_uncertainty) == (0.5, 0.01)
+        get_data_mock.assert_called_once_with(mock_device, 'test.app')
 
-    def test_get_cpu_usage_minus_in(self, android_plugin, mock_device):
-        mock_device.shell.return_value = '30.-6% TOTAL: 21% user + 6.7% kernel + 1.2% iowait + 0.7% irq + 0.5% softirq'
-        cpu_usage = android_plugin.get_cpu_usage(mock_device)
+    @patch('AndroidRunner.Plugins.Android.Android.get_data')
+    def test_start_profiling_without_app(self, get_data_mock, android_plugin, mock_device):
+        kwargs = {'arg1': 1}
+        android_plugin.start_profiling(mock_device, **kwargs)
+        android_plugin.sampler.join()
 
-        assert cpu_usage == '30.6'
-        mock_device.shell.assert_called_once_with('dumpsys cpuinfo | grep TOTAL')
+        assert android_plugin.profile is True
+        get_data_mock.assert_called_once_with(mock_device, None)
 
-    def test_get_mem_usage_no_app(self, android_plugin, mock_device):
-        mock_device.shell.return_value = 'Used RAM: 1016104 kB (819528 used pss + 196576 kernel)'
+    @patch('time.monotonic')
+    def test_sample_all_points(self, monotonic_mock, android_plugin, mock_device):
+        monotonic_mock.side_effect = [10.0, 10.2]
+        self.start_clock(android_plugin)
+        mock_device.shell_batch.return_value = [
+            '30% TOTAL: 21% user + 6.7% kernel', ' TOTAL    20411     7516    10228      980    36740    28499     8240']
 
-        mem_usage = android_plugin.get_mem_usage(mock_device, None)
+        android_plugin.sample(mock_device, 'app')
 
-        assert mem_usage == "1016104"
-        mock_device.shell.assert_called_once_with('dumpsys meminfo | grep Used')
+        # Halfway the batch on the host clock, plus the offset of the device clock
+        assert list(android_plugin.data.rows()) == [['2020-09-13T12:26:40.600Z', '30', '20411']]
+        mock_device.shell_batch.assert_called_once_with(['dumpsys cpuinfo | grep TOTAL',
+                                                         'dumpsys meminfo app'])
 
-    def test_get_mem_usage_app_found(self, android_plugin, mock_device):
-        mock_device.shell.return_value = ' TOTAL    20411     7516    10228      980    36740    28499     8240   ' \
-                                         'TOTAL:    20411      TOTAL SWAP (KB):      980'
+    def test_sample_only_mem(self, mock_device):
+        android_plugin = Android({'data_points': ['mem']}, {})
+        self.start_clock(android_plugin)
+        mock_device.shell_batch.return_value = ['Used RAM: 1016104 kB (819528 used pss + 196576 kernel)']
 
-        mem_usage = android_plugin.get_mem_usage(mock_device, 'com.google.android.calendar')
+        android_plugin.sample(mock_device, None)
 
-        assert mem_usage == "20411"
-        mock_device.shell.assert_called_once_with('dumpsys meminfo com.google.android.calendar | grep TOTAL')
+        assert android_plugin.data.header() == ['datetime', 'mem']
+        assert android_plugin.data.columns['mem'].tolist() == [1016104]
+        mock_device.shell_batch.assert_called_once_with(['dumpsys meminfo | grep Used'])
 
-    def test_get_mem_usage_app_not_found(self, android_plugin, mock_device):
-        mock_device.shell.side_effect = ['', 'No process found for: fake.app']
+    def test_sample_app_not_found(self, android_plugin, mock_device):
+        self.start_clock(android_plugin)
+        mock_device.shell_batch.return_value = ['30% TOTAL', 'No process found for: fake.app']
 
         with pytest.raises(Exception) as exception:
-            android_plugin.get_mem_usage(mock_device, 'fake.app')
+            android_plugin.sample(mock_device, 'fake.app')
 
         assert str(exception.value) == 'Android Profiler: No process found for: fake.app'
-        mock_device.shell.mock_calls[0]('dumpsys meminfo fake.app | grep TOTAL')
-        mock_device.shell.mock_calls[1]('dumpsys meminfo fake.app')
 
-    @patch('AndroidRunner.Plugins.Android.Android.get_data')
-    def test_start_profiling_with_app(self, get_data_mock, android_plugin, mock_device):
-        kwargs = {'arg1': 1, 'app': 'test.app'}
-        android_plugin.start_profiling(mock_device, **kwargs)
+    def test_sample_new_columns(self, mock_device):
+        android_plugin = Android({'data_points': ['cpu', 'threads', 'core_freq']}, {})
+        self.start_clock(android_plugin)
+        freq = '/cpu0/cpufreq/scaling_cur_freq:'
+        mock_device.shell_batch.side_effect = [
+            ['30% TOTAL', '100.00 350.00\n1 (main) S' + ' 0' * 10 + ' 10 10', freq + '300'],
+            ['35% TOTAL', freq + '450'],
+            ['40% TOTAL', '101.00 353.00\n1 (main) S' + ' 0' * 10 + ' 20 30', freq + '600']]
+
+        android_plugin.sample(mock_device, 'app')
+        android_plugin.sample(mock_device, None)
+        android_plugin.sample(mock_device, 'app')
+
+        assert android_plugin.data.header() == ['datetime', 'cpu', 'core_freq_cpu0', 'thread_main']
+        assert [row[1:] for row in android_plugin.data.rows()] == [['30', '300', ''], ['35', '450', ''],
+                                                                   ['40', '600', '30']]
+        assert mock_device.shell_batch.call_args_list[1][0][0] == ['dumpsys cpuinfo | grep TOTAL',
+                                                                   'grep -H . /sys/devices/system/cpu/cpu[0-9]*/'
+                                                                   'cpufreq/scaling_cur_freq']
 
-        assert android_plugin.profile is True
-        get_data_mock.assert_called_once_with(mock_device, 'test.app')
+    @patch('logging.Logger.warning')
+    def test_android_plugin_data_point_cost(self, logger_warning):
+        Android({'sample_interval': 100, 'data_points': ['cpu', 'mem']}, {})
+
+        logger_warning.assert_called_once_with('The data points take about 250ms per sample on the device, the '
+                                               'sample_interval is 100ms')
+
+    def test_android_plugin_device_sampling_data_points(self):
+        with pytest.raises(ConfigError):
+            Android({'data_points': ['cpu', 'thermal'], 'sampling': 'device'}, {})
+
+    @patch('time.monotonic')
+    @patch('AndroidRunner.Plugins.Android.Android.sample')
+    def test_get_data_deadlines(self, sample_mock, monotonic_mock, android_plugin, mock_device):
+        # start, then for every sample the time before and after it, then the end
+        monotonic_mock.side_effect = [100.0, 100.0, 100.3, 101.1, 101.4, 102.0, 104.5, 105.0]
+        android_plugin.stopped = Mock()
+        android_plugin.stopped.wait.side_effect = [False, False, True]
+        android_plugin.profile = True
 
-    @patch('AndroidRunner.Plugins.Android.Android.get_data')
-    def test_start_profiling_without_app(self, get_data_mock, android_plugin, mock_device):
-        kwargs = {'arg1': 1}
-        android_plugin.start_profiling(mock_device, **kwargs)
+        android_plugin.get_data(mock_device, 'app')
 
-        assert android_plugin.profile is True
-        get_data_mock.assert_called_once_with(mock_device, None)
+        assert sample_mock.call_count == 3
+        assert android_plugin.stopped.wait.mock_calls == [call(pytest.approx(0.7)), call(pytest.approx(0.6)),
+                                                          call(pytest.approx(0.5))]
+        assert android_plugin.lateness == pytest.approx([0.0, 0.1, 0.0])
+        assert android_plugin.missed == 2
+        assert android_plugin.sampling_duration == 5.0
 
-    @patch('timeit.default_timer')
-    @patch('threading.Timer')
-    @patch('AndroidRunner.Plugins.Android.Android.get_cpu_usage')
-    @patch('AndroidRunner.Plugins.Android.Android.get_mem_usage')
-    def test_get_data_all_points(self, get_mem_usage_mock, get_cpu_usage_mock, timer_mock, timeit_mock,
-                                 android_plugin, mock_device):
-        timeit_mock.side_effect = [100, 200]
-        mock_device.shell.return_value = 'device_time'
-        get_mem_usage_mock.return_value = "mem_usage"
-        get_cpu_usage_mock.return_value = "cpu_usage"
-        mock_timer_result = Mock()
-        timer_mock.return_value = mock_timer_result
-        android_plugin.profile = True
-        android_plugin.interval = 200
-        android_plugin.get_data(mock_device, 'app')
+    @patch('AndroidRunner.Plugins.Android.Android.sample')
+    def test_get_data_stops(self, sample_mock, android_plugin, mock_device):
+        android_plugin.interval = 60
 
-        assert android_plugin.data[1] == ['device_time', 'cpu_usage', 'mem_usage']
-        timer_mock.assert_called_once_with(100, android_plugin.get_data, args=(mock_device, 'app'))
-        mock_timer_result.start.assert_called_once()
-
-    @patch('timeit.default_timer')
-    @patch('AndroidRunner.Plugins.Android.Android.get_cpu_usage')
-    @patch('AndroidRunner.Plugins.Android.Android.get_mem_usage')
-    def test_get_data_only_mem(self, get_mem_usage_mock, get_cpu_usage_mock, timeit_mock,
-                               android_plugin, mock_device):
-        timeit_mock.side_effect = [100, 200]
-        mock_device.shell.return_value = 'device_time'
-        get_mem_usage_mock.return_value = "mem_usage"
-        get_cpu_usage_mock.return_value = "cpu_usage"
-        android_plugin.data_points = ['mem']
-        android_plugin.get_data(mock_device, 'app')
+        android_plugin.start_profiling(mock_device)
+        sampler = android_plugin.sampler
+        android_plugin.stop_profiling(mock_device)
 
-        assert android_plugin.data[1] == ['device_time', 'mem_usage']
-
-    @patch('timeit.default_timer')
-    @patch('AndroidRunner.Plugins.Android.Android.get_cpu_usage')
-    @patch('AndroidRunner.Plugins.Android.Android.get_mem_usage')
-    def test_get_data_only_cpu(self, get_mem_usage_mock, get_cpu_usage_mock, timeit_mock,
-                               android_plugin, mock_device):
-        timeit_mock.side_effect = [100, 200]
-        mock_device.shell.return_value = 'device_time'
-        get_mem_usage_mock.return_value = "mem_usage"
-        get_cpu_usage_mock.return_value = "cpu_usage"
-        android_plugin.data_points = ['cpu']
-        android_plugin.get_data(mock_device, 'app')
+        assert not sampler.is_alive()
+        assert android_plugin.sampler is None
+        assert sample_mock.call_count == 1
+
+    def test_sampling_report(self, android_plugin):
+        android_plugin.lateness = [0.0, 0.002, 0.004]
+        android_plugin.missed = 1
+        android_plugin.sampling_duration = 4.0
+        android_plugin.clock_offset, android_plugin.clock_uncertainty = -1.25, 0.003
 
-        assert android_plugin.data[1] == ['device_time', 'cpu_usage']
+        assert android_plugin.sampling_report() == {'sample_interval': '1.000', 'samples': 3, 'missed': 1,
+                                                     'duration': '4.000', 'target_rate': '1.000',
+                                                     'achieved_rate': '0.750', 'mean_jitter': '0.002000',
+                                                     'max_jitter': '0.004000', 'clock_offset': '-1.250000',
+                                                     'clock_uncertainty': '0.003000'}
 
     def test_stop_profiling(self, android_plugin, mock_device):
         android_plugin.profile = True
@@ -246,6 +280,7 @@ class TestAndroidPlugin(object):
         android_plugin.stop_profiling(mock_device)
 
         assert android_plugin.profile is False
+        assert android_plugin.stopped.is_set()
 
     @patch('time.strftime')
     def test_collect_results(self, time_mock, android_plugin, mock_device, tmpdir, fixture_dir):
@@ -253,23 +288,26 @@ class TestAndroidPlugin(object):
         time_mock.return_value = 'time'
         mock_device.id = 'device_id'
         time_mock.return_value = 'experiment_time'
-        android_plugin.data = self.csv_reader_to_table(op.join(fixture_dir, 'test_android_output.csv'))
+        original = self.csv_reader_to_table(op.join(fixture_dir, 'test_android_output.csv'))
+        for i, (_, cpu, mem) in enumerate(original[1:]):
+            android_plugin.data.append(1551623746000 + i * 2000, {'cpu': cpu, 'mem': mem})
         android_plugin.output_dir = test_output_dir
 
         android_plugin.collect_results(mock_device)
 
         assert op.isfile(op.join(test_output_dir, '{}_{}.csv'.format('device_id', 'experiment_time')))
+        assert op.isfile(op.join(test_output_dir, 'sampling', '{}_{}.csv'.format('device_id', 'experiment_time')))
 
-        file_content_created = self.get_dataset(
-            op.join(test_output_dir, '{}_{}.csv'.format('device_id', 'experiment_time')))
-        file_content_original = self.get_dataset(op.join(fixture_dir, 'test_android_output.csv'))
-        assert file_content_created == file_content_original
+        created = self.csv_reader_to_table(op.join(test_output_dir, '{}_{}.csv'.format('device_id', 'experiment_time')))
+        assert [row[1:] for row in created] == [row[1:] for row in original]
 
     def test_set_output(self, android_plugin):
         test_output_dir = "asdfgbfsdgbf/hjbdsfavav"
+        android_plugin.data.append(1600000000000, {'cpu': '12.5'})
         android_plugin.set_output(test_output_dir)
 
         assert android_plugin.output_dir == test_output_dir
+        assert len(android_plugin.data) == 0
 
     def test_dependencies(self, android_plugin):
         assert android_plugin.dependencies() == []
@@ -280,6 +318,96 @@ class TestAndroidPlugin(object):
     def test_unload(self, android_plugin, mock_device):
         assert android_plugin.unload(mock_device) is None
 
+    @pytest.fixture()
+    def device_sampling_plugin(self):
+        return Android({'sample_interval': 50, 'data_points': ['cpu', 'mem'], 'sampling': 'device'}, {})
+
+    def test_android_plugin_invalid_sampling(self):
+        with pytest.raises(ConfigError):
+            Android({'data_points': ['cpu'], 'sampling': 'phone'}, {})
+
+    def test_load_device_sampling(self, device_sampling_plugin, mock_device):
+        device_sampling_plugin.load(mock_device)
+
+        fileobj, remote = mock_device.push_from.call_args[0]
+        assert remote == Android.SAMPLER_PATH
+        assert b'/proc/stat' in fileobj.read()
+
+    def test_unload_device_sampling(self, device_sampling_plugin, mock_device):
+        device_sampling_plugin.unload(mock_device)
+
+        mock_device.shell.assert_called_once_with('rm -f %s' % Android.SAMPLER_PATH)
+
+    def test_start_profiling_device_sampling(self, device_sampling_plugin, mock_device):
+        device_sampling_plugin.start_profiling(mock_device, app='test.app')
+
+        assert device_sampling_plugin.sampler is None
+        assert device_sampling_plugin.uptime_offset == -1599999900.0
+        assert (device_sampling_plugin.clock_offset, device_sampling_plugin.clock_uncertainty) == \
+            pytest.approx((0.5, 0.015))
+        mock_device.shell_batch.assert_called_once_with([
+            'rm -f %s %s.stop' % (Android.SAMPLES_PATH, Android.SAMPLES_PATH),
+            'nohup sh %s 5 %s test.app >/dev/null 2>&1 &' % (Android.SAMPLER_PATH, Android.SAMPLES_PATH)])
+
+    @patch('AndroidRunner.Waits.until')
+    def test_stop_profiling_device_sampling(self, until_mock, device_sampling_plugin, mock_device):
+        mock_device.file_size.return_value = None
+
+        device_sampling_plugin.stop_profiling(mock_device)
+
+        mock_device.shell.assert_called_once_with('touch %s.stop' % Android.SAMPLES_PATH)
+        assert until_mock.call_args[0][0]() is True
+
+    def test_read_samples(self, device_sampling_plugin):
+        device_sampling_plugin.app = 'test.app'
+        pid_stat = '4242 (test app) S' + ' 0' * 20 + ' 100' + ' 0' * 20
+        device_sampling_plugin.read_samples([
+            'start 1600000000 100.00 4096 4242\n',
+            '10000 100.01|4000000 3000000|cpu  100 0 100 800 0 0 0 0 0 0|%s\n' % pid_stat,
+            '10005 100.05|4000000 2000000|cpu  125 0 125 850 0 0 0 0 0 0|%s\n' % pid_stat,
+            '10020 100.22|4000000 2000000|cpu  150 0 150 900 0 0 0 0 0 0|\n',
+            'stop 100.40\n'])
+
+        assert list(device_sampling_plugin.data.rows()) == [['2020-09-13T12:26:40.050Z', '50', '400'],
+                                                            ['2020-09-13T12:26:40.220Z', '50', '']]
+        assert device_sampling_plugin.lateness == pytest.approx([0.01, 0.0, 0.02])
+        assert device_sampling_plugin.missed == 2
+        assert device_sampling_plugin.sampling_duration == pytest.approx(0.4)
+
+    def test_read_samples_system_memory(self, device_sampling_plugin):
+        device_sampling_plugin.read_samples([
+            'start 1600000000 100.00 4096 \n',
+            '10000 100.00|4000000 3000000|cpu  100 0 100 800 0 0 0 0 0 0|\n',
+            '10005 100.05|4000000 2000000|cpu  100 0 100 900 0 0 0 0 0 0|\n'])
+
+        assert list(device_sampling_plugin.data.rows()) == [['2020-09-13T12:26:40.050Z', '0', '2000000']]
+
+    def test_read_samples_clock_offset(self, device_sampling_plugin):
+        # The uptime is 100s at host time 1599999900 + 100, the device clock 0.5s ahead of the host
+        device_sampling_plugin.uptime_offset, device_sampling_plugin.clock_offset = -1599999900.0, 0.5
+        device_sampling_plugin.read_samples([
+            'start 1600000000 100.00 4096 \n',
+            '10000 100.00|4000000 3000000|cpu  100 0 100 800 0 0 0 0 0 0|\n',
+            '10005 100.05|4000000 2000000|cpu  100 0 100 900 0 0 0 0 0 0|\n'])
+
+        assert list(device_sampling_plugin.data.rows()) == [['2020-09-13T12:26:40.550Z', '0', '2000000']]
+
+    @patch('time.strftime')
+    @patch('AndroidRunner.Plugins.Android.Android.read_samples')
+    def test_collect_results_device_sampling(self, read_samples_mock, time_mock, device_sampling_plugin,
+                                             mock_device, tmpdir):
+        time_mock.return_value = 'experiment_time'
+        mock_device.id = 'device_id'
+        mock_device.pull_stream.return_value = iter([b'start 1600000000 100.00 4096 \n'])
+        device_sampling_plugin.output_dir = str(tmpdir)
+
+        device_sampling_plugin.collect_results(mock_device)
+
+        mock_device.pull_stream.assert_called_once_with(Android.SAMPLES_PATH)
+        assert list(read_samples_mock.call_args[0][0]) == ['start 1600000000 100.00 4096 \n']
+        mock_device.shell.assert_called_once_with('rm -f %s' % Android.SAMPLES_PATH)
+        assert op.isfile(op.join(str(tmpdir), 'device_id_experiment_time.csv'))
+
     @patch('AndroidRunner.util.write_to_file')
     @patch('AndroidRunner.Plugins.Android.Android.aggregate_android_subject')
     def test_aggregate_subject(self, aggregate_mock, write_to_file_mock, android_plugin):
@@ -316,6 +444,15 @@ class TestAndroidPlugin(object):
         assert test_logs_aggregated['android_cpu'] == 32.94186117467583
         assert test_logs_aggregated['android_mem'] == 1131976.3141113652
 
+    def test_aggregate_android_subject_missing_values(self, android_plugin, tmpdir):
+        with open(op.join(str(tmpdir), 'run1.csv'), 'w') as f:
+            f.write('datetime,cpu,core_util_cpu0\nt1,10,\nt2,20,50\nt3,30,70\n')
+        with open(op.join(str(tmpdir), 'run2.csv'), 'w') as f:
+            f.write('datetime,cpu\nt1,40\n')
+
+        assert android_plugin.aggregate_android_subject(str(tmpdir)) == {'android_core_util_cpu0': 60.0,
+                                                                         'android_cpu': 30.0}
+
     @patch("AndroidRunner.Plugins.Android.Android.aggregate_android_final")
     def test_aggregate_final_web(self, aggregate_mock, android_plugin, fixture_dir):
         test_struct_dir_web = op.join(fixture_dir, 'test_dir_struct', 'data_web')
@@ -345,6 +482,127 @@ class TestAndroidPlugin(object):
         assert aggregated_final_rows['android_mem'] == '1280213.4222222222'
 
     
+class TestSampleBuffer(object):
+    def test_append(self):
+        buffer = SampleBuffer(['cpu', 'mem'])
+
+        buffer.append(1600000000000, {'cpu': '12.5', 'mem': 'unknown'})
+        buffer.append(1600000000100, {'cpu': 13, 'core_freq_cpu0': '300000'})
+
+        assert len(buffer) == 2
+        assert buffer.header() == ['datetime', 'cpu', 'mem', 'core_freq_cpu0']
+        assert buffer.columns['cpu'].typecode == 'd'
+        assert list(buffer.rows()) == [['2020-09-13T12:26:40.000Z', '12.5', '', ''],
+                                       ['2020-09-13T12:26:40.100Z', '13', '', '300000']]
+
+    def test_clear(self):
+        buffer = SampleBuffer(['cpu'])
+        buffer.append(1600000000000, {'cpu': '12.5', 'thread_main': '1'})
+
+        buffer.clear()
+
+        assert len(buffer) == 0
+        assert buffer.header() == ['datetime', 'cpu']
+        assert list(buffer.rows()) == []
+
+
+class TestAndroidDataPoints(object):
+    def test_registry(self):
+        assert list(AndroidDataPoints.DATA_POINTS) == ['cpu', 'mem', 'core_util', 'core_freq', 'threads', 'mem_detail',
+                                                       'thermal', 'battery']
+        for name, data_point in AndroidDataPoints.DATA_POINTS.items():
+            assert data_point(name).cost > 0
+
+    def test_cpu_usage(self):
+        point = AndroidDataPoints.CpuUsage('cpu')
+
+        assert point.command(None) == 'dumpsys cpuinfo | grep TOTAL'
+        assert point.parse('30% TOTAL: 21% user + 6.7% kernel + 1.2% iowait + 0.7% irq + 0.5% softirq', None) == \
+            {'cpu': '30'}
+        assert point.parse('30.-6% TOTAL: 21% user + 6.7% kernel + 1.2% iowait + 0.7% irq + 0.5% softirq', None) == \
+            {'cpu': '30.6'}
+
+    def test_mem_usage_no_app(self):
+        point = AndroidDataPoints.MemUsage('mem')
+
+        assert point.command(None) == 'dumpsys meminfo | grep Used'
+        assert point.parse('Used RAM: 1016104 kB (819528 used pss + 196576 kernel)', None) == {'mem': '1016104'}
+
+    def test_mem_usage_app_found(self):
+        point = AndroidDataPoints.MemUsage('mem')
+        output = '                   Pss  Private  Private  SwapPss     Heap     Heap     Heap\n' \
+                 '        TOTAL    20411     7516    10228      980    36740    28499     8240\n' \
+                 '           TOTAL PSS:    20411            TOTAL RSS:    98076       TOTAL SWAP PSS:      980'
+
+        assert point.command('com.google.android.calendar') == 'dumpsys meminfo com.google.android.calendar'
+        assert point.parse(output, 'com.google.android.calendar') == {'mem': '20411'}
+
+    def test_mem_usage_app_not_found(self):
+        point = AndroidDataPoints.MemUsage('mem')
+
+        with pytest.raises(Exception) as exception:
+            point.parse('No process found for: fake.app', 'fake.app')
+
+        assert str(exception.value) == 'Android Profiler: No process found for: fake.app'
+
+    def test_core_utilization(self):
+        point = AndroidDataPoints.CoreUtilization('core_util')
+
+        assert point.parse('cpu0 100 0 100 800 0 0 0 0 0 0\ncpu1 10 0 10 80 0 0 0 0 0 0', None) == {}
+        assert point.parse('cpu0 150 0 150 900 0 0 0 0 0 0\ncpu1 10 0 10 180 0 0 0 0 0 0', None) == \
+            {'core_util_cpu0': '50.0', 'core_util_cpu1': '0.0'}
+        point.reset()
+        assert point.parse('cpu0 200 0 200 1000 0 0 0 0 0 0', None) == {}
+
+    def test_core_frequency(self):
+        point = AndroidDataPoints.CoreFrequency('core_freq')
+        output = '/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq:1804800\n' \
+                 '/sys/devices/system/cpu/cpu4/cpufreq/scaling_cur_freq:2419200'
+
+        assert list(point.parse(output, None).items()) == [('core_freq_cpu0', '1804800'),
+                                                           ('core_freq_cpu4', '2419200')]
+
+    def test_thread_cpu(self):
+        point = AndroidDataPoints.ThreadCpu('threads')
+        stat = '{} ({}) S 1 1 0 0 -1 0 0 0 0 0 {} {} 0 0 20 0 1 0'
+
+        assert point.command('com.example') == 'cat /proc/uptime; p=$(pidof com.example) && ' \
+                                               'cat /proc/${p%% *}/task/*/stat'
+        assert point.parse('\n'.join(['10.00 40.00', stat.format(1, 'main', 10, 0),
+                                       stat.format(2, 'Binder:1 2', 5, 5)]), 'com.example') == {}
+        assert point.parse('\n'.join(['10.50 41.00', stat.format(1, 'main', 30, 5),
+                                       stat.format(2, 'Binder:1 2', 5, 5), stat.format(3, 'Binder:1 2', 1, 0)]),
+                           'com.example') == {'thread_main': '50.0', 'thread_Binder:1 2': '2.0'}
+        assert point.parse('', 'com.example') == {}
+
+    def test_mem_breakdown(self):
+        point = AndroidDataPoints.MemBreakdown('mem_detail')
+        output = '12c00000-ffff0000 ---p 00000000 00:00 0    [rollup]\nRss:              123456 kB\n' \
+                 'Pss:               65432 kB\nPrivate_Dirty:     40000 kB\nSwapPss:               0 kB'
+
+        assert list(point.parse(output, 'com.example').items()) == [
+            ('mem_rss', '123456'), ('mem_pss', '65432'), ('mem_private_dirty', '40000'), ('mem_swappss', '0')]
+
+    def test_thermal(self):
+        point = AndroidDataPoints.Thermal('thermal')
+        output = '/sys/class/thermal/thermal_zone0/type:cpu\n/sys/class/thermal/thermal_zone1/type:cpu\n' \
+                 '/sys/class/thermal/thermal_zone2/type:battery\n/sys/class/thermal/thermal_zone0/temp:45300\n' \
+                 '/sys/class/thermal/thermal_zone1/temp:46100\n/sys/class/thermal/thermal_zone2/temp:31\n' \
+                 'grep: /sys/class/thermal/thermal_zone3/temp: Permission denied'
+
+        assert list(point.parse(output, None).items()) == [('thermal_cpu', '45.3'),
+                                                           ('thermal_cpu_thermal_zone1', '46.1'),
+                                                           ('thermal_battery', '31.0')]
+
+    def test_battery(self):
+        point = AndroidDataPoints.Battery('battery')
+        output = '/sys/class/power_supply/battery/current_now:-352000\n' \
+                 '/sys/class/power_supply/battery/voltage_now:4123000'
+
+        assert list(point.parse(output, None).items()) == [('battery_current', '-352.0'),
+                                                           ('battery_voltage', '4123.0')]
+
+
 class TestBatterystatsPlugin(object):
 
     @staticmethod
@@ -550,9 +808,19 @@ class TestBatterystatsPlugin(object):
                        'wifi_signal_strength=4 wifi_suppl=completed +4m07s375ms (2) 090 volt=4225 +16m24s239ms (3) ' \
                        '089 volt=4195'
         dumpsys_charge = '3450, Computed drain: 150, actual drain: 104-138'
-        mock_device.shell.side_effect = [dumpsys_charge, dumpsys_volt]
+        mock_device.shell.return_value = '\n'.join([dumpsys_volt, dumpsys_charge])
         calculated_j_consumed = batterystats_plugin.get_consumed_joules(mock_device)
         assert calculated_j_consumed == 2292.84
+        mock_device.shell.assert_called_once_with('dumpsys batterystats | grep -e "Computed drain:" -e "volt="')
+
+    def test_get_consumed_joules_no_drain(self, batterystats_plugin, mock_device):
+        mock_device.id = '123'
+        mock_device.shell.return_value = '0 (1) 091 status=discharging volt=4246'
+
+        with pytest.raises(Exception) as except_result:
+            batterystats_plugin.get_consumed_joules(mock_device)
+
+        assert str(except_result.value) == 'Batterystats: the battery stats of 123 have no "Computed drain:"'
 
     @patch('os.remove')
     def test_cleanup_logs_false(self, os_remove_mock, batterystats_plugin):
@@ -863,25 +1131,28 @@ class TestTrepnPlugin(object):
         assert self.file_content(expected_pref_file) == self.file_content(op.join(fixture_dir, 'exp_trepn_pref.xml'))
         assert self.file_content(expected_dp_file) == self.file_content(op.join(fixture_dir, 'exp_saved_dp.xml'))
 
-    @patch('time.sleep')
-    def test_load(self, sleep_mock, trepn_plugin, mock_device, tmpdir):
+    @patch('AndroidRunner.Waits.process_gone')
+    @patch('AndroidRunner.Waits.activity_focused')
+    def test_load(self, activity_focused_mock, process_gone_mock, trepn_plugin, mock_device, tmpdir):
         test_pref_dir = str(tmpdir)
         trepn_plugin.pref_dir = test_pref_dir
+        mock_device.shell.return_value = 'Broadcasting: Intent { act=com.quicinc.trepn.load_preferences }\n' \
+                                         'Broadcast completed: result=0'
         mock_manager = Mock()
-        mock_manager.attach_mock(sleep_mock, 'sleep_managed')
+        mock_manager.attach_mock(activity_focused_mock, 'activity_focused_managed')
+        mock_manager.attach_mock(process_gone_mock, 'process_gone_managed')
         mock_manager.attach_mock(mock_device, 'device_managed')
 
         trepn_plugin.load(mock_device)
 
         expected_calls = [call.device_managed.push(test_pref_dir, trepn_plugin.remote_pref_dir),
                           call.device_managed.launch_package('com.quicinc.trepn'),
-                          call.sleep_managed(5),
+                          call.activity_focused_managed(mock_device, 'com.quicinc.trepn'),
                           call.device_managed.shell('am broadcast -a com.quicinc.trepn.load_preferences '
                                                     '-e com.quicinc.trepn.load_preferences_file "%s"'
                                                     % op.join(trepn_plugin.remote_pref_dir, 'trepn.pref')),
-                          call.sleep_managed(1),
                           call.device_managed.force_stop('com.quicinc.trepn'),
-                          call.sleep_managed(2),
+                          call.process_gone_managed(mock_device, 'com.quicinc.trepn'),
                           call.device_managed.shell('am startservice com.quicinc.trepn/.TrepnService')]
         assert mock_manager.mock_calls == expected_calls
 
@@ -895,16 +1166,17 @@ class TestTrepnPlugin(object):
 
         mock_device.shell.assert_called_once_with('am broadcast -a com.quicinc.trepn.stop_profiling')
 
-    @patch('time.sleep')
+    @patch('AndroidRunner.Waits.file_complete')
     @patch('AndroidRunner.Plugins.Trepn.Trepn.filter_results')
-    def test_collect_results(self, filter_results_mock, sleep_mock, trepn_plugin, mock_device, tmpdir):
+    def test_collect_results(self, filter_results_mock, file_complete_mock, trepn_plugin, mock_device, tmpdir):
         tmpdir_str = str(tmpdir)
         trepn_plugin.output_dir = tmpdir_str
         mock_device.id = '123'
         mock_device.shell.return_value = 'Trepn_2019.08.21_224812.db'
+        mock_device.pull_stream.return_value = iter([b'a,b\n1,', b'2\n3,4'])
         mock_manager = Mock()
         mock_manager.attach_mock(mock_device, 'device_managed')
-        mock_manager.attach_mock(sleep_mock, 'sleep_managed')
+        mock_manager.attach_mock(file_complete_mock, 'file_complete_managed')
         mock_manager.attach_mock(filter_results_mock, 'filter_managed')
 
         trepn_plugin.collect_results(mock_device)
@@ -915,15 +1187,15 @@ class TestTrepnPlugin(object):
                                                     '"Trepn_2019.08.21_224812.db" '
                                                     '-e com.quicinc.trepn.export_csv_output_file '
                                                     '"123_Trepn_2019.08.21_224812.csv"'),
-                          call.sleep_managed(1),
-                          call.device_managed.pull(op.join(trepn_plugin.DEVICE_PATH, '123_Trepn_2019.08.21_224812.csv')
-                                                   , tmpdir_str),
-                          call.sleep_managed(1),
-                          call.device_managed.shell(
-                              'rm %s' % op.join(trepn_plugin.DEVICE_PATH, 'Trepn_2019.08.21_224812.db')),
-                          call.device_managed.shell(
-                              'rm %s' % op.join(trepn_plugin.DEVICE_PATH, '123_Trepn_2019.08.21_224812.csv')),
-                          call.filter_managed(op.join(tmpdir_str, '123_Trepn_2019.08.21_224812.csv'))]
+                          call.file_complete_managed(
+                              mock_device, op.join(trepn_plugin.DEVICE_PATH, '123_Trepn_2019.08.21_224812.csv')),
+                          call.device_managed.pull_stream(
+                              op.join(trepn_plugin.DEVICE_PATH, '123_Trepn_2019.08.21_224812.csv')),
+                          call.device_managed.shell_batch(
+                              ['rm %s' % op.join(trepn_plugin.DEVICE_PATH, 'Trepn_2019.08.21_224812.db'),
+                               'rm %s' % op.join(trepn_plugin.DEVICE_PATH, '123_Trepn_2019.08.21_224812.csv')]),
+                          call.filter_managed(op.join(tmpdir_str, '123_Trepn_2019.08.21_224812.csv'),
+                                              [['a', 'b'], ['1', '2'], ['3', '4']])]
         assert mock_manager.mock_calls == expected_calls
 
     def test_read_csv(self, trepn_plugin, fixture_dir):
@@ -948,6 +1220,21 @@ class TestTrepnPlugin(object):
         filter_data_mock.assert_called_once_with(['Battery Power*', 'Memory Usage'], self.csv_reader_to_table(
             op.join(fixture_dir, 'test_trepn_data_to_filter.csv')))
 
+    @patch('AndroidRunner.Plugins.Trepn.Trepn.write_list_to_file')
+    @patch('AndroidRunner.Plugins.Trepn.Trepn.filter_data')
+    @patch('AndroidRunner.Plugins.Trepn.Trepn.read_csv')
+    def test_filter_result_rows(self, read_csv_mock, filter_data_mock, write_mock, trepn_plugin, tmpdir, fixture_dir):
+        test_filename = op.join(str(tmpdir), 'test_file.txt')
+        test_data = self.csv_reader_to_table(op.join(fixture_dir, 'test_output_orig_trepn.csv'))
+        filter_data_result = Mock()
+        filter_data_mock.return_value = filter_data_result
+        trepn_plugin.data_points = ['332', '328']
+
+        trepn_plugin.filter_results(test_filename, test_data)
+
+        read_csv_mock.assert_not_called()
+        write_mock.assert_called_once_with(test_filename, filter_data_result)
+
     def test_write_list_to_file(self, trepn_plugin, tmpdir):
         test_filename = op.join(str(tmpdir), 'test_file.txt')
         test_data = [[], [], []]
@@ -1006,8 +1293,8 @@ class TestTrepnPlugin(object):
     def test_unload(self, trepn_plugin, mock_device):
         trepn_plugin.unload(mock_device)
 
-        expected_calls = [call.shell('am stopservice com.quicinc.trepn/.TrepnService'),
-                          call.shell('rm -r %s' % op.join(trepn_plugin.remote_pref_dir, 'trepn.pref'))]
+        expected_calls = [call.shell_batch(['am stopservice com.quicinc.trepn/.TrepnService',
+                                            'rm -r %s' % op.join(trepn_plugin.remote_pref_dir, 'trepn.pref')])]
         assert mock_device.mock_calls == expected_calls
 
     def test_set_output(self, trepn_plugin, tmpdir):
@@ -1,14 +1,15 @@
+import json
 import os
 import os.path as op
 from shutil import copyfile
 
 import lxml.etree as et
 import pytest
-from mock import Mock, call, patch
+from mock import Mock, patch
 
 import paths
-from AndroidRunner.Progress import Progress
-from AndroidRunner.util import load_json
+from AndroidRunner.Progress import Progress, Run
+from AndroidRunner.util import ConfigError, load_json
 
 
 class TestProgressSetup(object):
@@ -22,35 +23,30 @@ class TestProgressSetup(object):
         fixture_dir = op.join(op.dirname(op.realpath(__file__)), "fixtures")
         return op.join(fixture_dir, 'test_progress.xml')
 
-    @patch('AndroidRunner.Progress.Progress.write_progress_to_file')
-    @patch('AndroidRunner.Progress.Progress.build_progress_xml')
-    def test_progress_init(self, build_progress_mock, write_to_file_mock, tmp_path, test_config, test_progress):
+    def test_progress_init(self, tmp_path, test_config, test_progress):
         with open(test_progress, 'r') as f:
             expected_xml = f.read()
         paths.OUTPUT_DIR = tmp_path.as_posix()
-        build_progress_mock.return_value = et.fromstring(expected_xml)
-        mock_manager = Mock()
-        mock_manager.attach_mock(build_progress_mock, 'managed_build_progress')
-        mock_manager.attach_mock(write_to_file_mock, 'managed_write_to_file')
 
         progress = Progress(config_file=test_config, config=load_json(test_config))
 
-        expected_calls = [call.managed_build_progress(load_json(test_config), test_config),
-                          call.managed_write_to_file()]
-        assert mock_manager.mock_calls == expected_calls
-        expected_lxml = et.fromstring(expected_xml)
-        current_lxml = progress.progress_xml_content
-        assert self.elements_equal(current_lxml, expected_lxml)
+        assert progress.progress_xml_file == op.join(paths.OUTPUT_DIR, 'progress.xml')
+        with open(progress.progress_xml_file, 'r') as f:
+            progress_xml = f.read()
+        assert progress_xml == expected_xml.replace('test/output/dir', paths.OUTPUT_DIR)
 
     @patch('AndroidRunner.Progress.Progress.check_config_hash')
     def test_progress_init_resume(self, check_hash_mock, tmp_path, test_config, test_progress):
         check_hash_mock.return_value = None
         progress = Progress(config_file=test_config, progress_file=test_progress, load_progress=True)
+        progress.progress_xml_file = op.join(tmp_path.as_posix(), 'progress.xml')
+        progress.write_progress_to_file()
         with open(test_progress, 'r') as f:
             expected_xml = f.read()
-        expected_lxml = et.fromstring(expected_xml)
-        current_lxml = progress.progress_xml_content
-        assert self.elements_equal(current_lxml, expected_lxml)
+        with open(progress.progress_xml_file, 'r') as f:
+            progress_xml = f.read()
+        assert progress_xml == expected_xml
+        check_hash_mock.assert_called_once_with(test_config)
 
     def elements_equal(self, e1, e2):
         if e1.tag != e2.tag:
@@ -115,13 +111,37 @@ class TestProgressMethods(object):
                                 replace('[', '').replace(']', '').replace('\n', '').split(', ')))
         assert unique_values == 1
 
-    @patch('AndroidRunner.Progress.Progress.run_to_dict')
-    def test_random_next(self, run_to_dict, current_progress):
+    def test_random_next_without_seed(self, current_progress):
+        # Progress files of older versions have no random seed, their order is that of the file
+        assert current_progress.random_seed is None
         for _ in range(50):
-            current_progress.get_random_run()
-        unique_values = len(set(str(run_to_dict.mock_calls).
-                                replace('[', '').replace(']', '').replace('\n', '').split(', ')))
-        assert unique_values > 1
+            assert current_progress.get_random_run() == current_progress.get_next_run()
+
+    @pytest.fixture()
+    def two_device_progress(self, tmp_path):
+        paths.OUTPUT_DIR = tmp_path.as_posix()
+        progress_file = op.join(paths.OUTPUT_DIR, 'two_devices.xml')
+        with open(progress_file, 'w') as f:
+            f.write('<experiment><configHash>hash</configHash><outputDir>dir</outputDir><runsToRun>'
+                    '<run runId="0"><device>dev1</device><path>path1</path><runCount>1</runCount></run>'
+                    '<run runId="1"><device>dev2</device><path>path1</path><runCount>1</runCount></run>'
+                    '<run runId="2"><device>dev2</device><path>path2</path><runCount>1</runCount></run>'
+                    '</runsToRun><runsDone/></experiment>')
+        with patch('AndroidRunner.Progress.Progress.check_config_hash'):
+            return Progress(config_file=None, progress_file=progress_file, load_progress=True)
+
+    def test_next_run_of_device(self, two_device_progress):
+        current_progress = two_device_progress
+
+        assert current_progress.get_next_run()['runId'] == '0'
+        assert current_progress.get_next_run('dev2')['runId'] == '1'
+        for _ in range(20):
+            assert current_progress.get_random_run('dev2')['device'] == 'dev2'
+        assert current_progress.get_devices_to_run() == ['dev1', 'dev2']
+        current_progress.run_finished('0')
+        assert current_progress.get_devices_to_run() == ['dev2']
+        assert [run['runId'] for run in current_progress.get_runs_to_run('dev2')] == ['1', '2']
+        assert current_progress.get_runs_to_run('dev1') == []
 
     def test_get_progress_xml_file(self, current_progress, test_progress):
         progress_file = current_progress.get_progress_xml_file()
@@ -154,10 +174,48 @@ class TestProgressMethods(object):
         assert expected_stripped == result_stripped
 
     def test_file_to_hash(self, current_progress, test_config):
-        expected_hash = "c563cc8583486714e40cf74b1fb98577"
+        expected_hash = "cb61060f52bfe9ab1e195bb96b4c5b0f"
         current_hash = current_progress.file_to_hash(test_config)
         assert current_hash == expected_hash
 
+    def test_file_to_hash_canonical(self, tmp_path):
+        config_file = tmp_path / 'config.json'
+        config_file.write_text('{"type": "web", "replications": 2, "devices": {"nexus6p": {}}, "duration": 1.5}')
+        fingerprint = Progress.file_to_hash(str(config_file))
+
+        config_file.write_text('{\n  "devices": {"nexus6p": {}},\n  "duration": 1.5,\n  "replications": 2.0,\n'
+                               '  "type": "web"\n}\n')
+        assert Progress.file_to_hash(str(config_file)) == fingerprint
+
+        config_file.write_text('{"type": "web", "replications": 3, "devices": {"nexus6p": {}}, "duration": 1.5}')
+        assert Progress.file_to_hash(str(config_file)) != fingerprint
+
+    def test_file_to_hash_referenced_files(self, tmp_path):
+        (tmp_path / 'Scripts').mkdir()
+        script = tmp_path / 'Scripts' / 'interaction.py'
+        aggregation = tmp_path / 'aggregate.py'
+        apk = tmp_path / 'app.apk'
+        config_file = tmp_path / 'config.json'
+        config_file.write_text(json.dumps({'type': 'native', 'paths': [str(apk)],
+                                           'scripts': {'interaction': [{'type': 'python3',
+                                                                        'path': 'Scripts/interaction.py'}]},
+                                           'profilers': {'android': {'experiment_aggregation': 'aggregate.py'}}}))
+        assert Progress.referenced_files(load_json(str(config_file)), str(tmp_path)) == \
+            [str(script), str(aggregation), str(apk)]
+
+        missing = Progress.file_to_hash(str(config_file))
+        hashes = set()
+        for path in (script, aggregation, apk):
+            path.write_bytes(b'version 1')
+            hashes.add(Progress.file_to_hash(str(config_file)))
+        assert len(hashes | {missing}) == 4
+        apk.write_bytes(b'version 2')
+        assert Progress.file_to_hash(str(config_file)) not in hashes
+
+    def test_check_config_hash_legacy(self, current_progress, test_config):
+        current_progress.config_hash = '2c75074dd8a4411068d221dd5cc877b1'
+        current_progress.check_config_hash(test_config)
+
     @patch('AndroidRunner.Progress.Progress.file_to_hash')
     def test_check_config_hash_fail(self, file_to_hash_mock, current_progress, capsys, test_config, test_progress):
         file_to_hash_mock.return_value = '0'
@@ -170,156 +228,212 @@ class TestProgressMethods(object):
 
     @patch('AndroidRunner.Progress.Progress.file_to_hash')
     def test_check_config_hash_succes(self, file_to_hash_mock, current_progress):
-        file_to_hash_mock.return_value = current_progress.progress_xml_content.find('configHash').text
+        file_to_hash_mock.return_value = 'cb61060f52bfe9ab1e195bb96b4c5b0f'
         current_progress.check_config_hash(current_progress.get_progress_xml_file())
 
     @patch('AndroidRunner.Progress.Progress.get_run_count')
     def test_run_to_dict(self, get_run_count, current_progress):
         get_run_count.return_value = 1459
-        run_dict = current_progress.run_to_dict(et.fromstring('<run runId="0"><device>device</device><path>path</path>'
-                                                              '<browser>browser</browser><runCount>1</runCount></run>'))
-        expected_dict = {'runId': '0', 'device': 'device', 'path': 'path', 'browser': 'browser', 'runCount': 1459}
+        run_dict = current_progress.run_to_dict('0')
+        expected_dict = {'runId': '0', 'device': 'nexus6p', 'path': 'https://google.com/', 'browser': 'firefox',
+                         'runCount': 1459}
         assert run_dict == expected_dict
+        get_run_count.assert_called_once_with('nexus6p', 'https://google.com/', 'firefox')
+
+    def test_build_run_xml_web(self, current_progress):
+        run_xml = current_progress.build_run_xml(Run('3', 'device1', 'path1', 'browser1', 2))
+        expected_xml = '    <run runId="3">\n      <device>device1</device>\n      <path>path1</path>\n' \
+                       '      <browser>browser1</browser>\n      <runCount>2</runCount>\n    </run>\n'
+        assert run_xml == expected_xml
+
+    def test_build_run_xml_native(self, current_progress):
+        run_xml = current_progress.build_run_xml(Run('3', 'device1', "it's <a> & path", None, 2))
+        expected_xml = '    <run runId="3">\n      <device>device1</device>\n' \
+                       '      <path>it\'s &lt;a&gt; &amp; path</path>\n      <runCount>2</runCount>\n    </run>\n'
+        assert run_xml == expected_xml
+
+    def test_write_progress_to_file_like_lxml(self, current_progress):
+        current_progress.run_finished('3')
+        current_progress.add_run(Run('9', 'd\xe9vice', 'a\'b<&>"c\r\n', None, 1))
+        current_progress.write_progress_to_file()
+
+        with open(current_progress.progress_xml_file, 'rb') as f:
+            progress_xml = f.read()
+        assert progress_xml == et.tostring(et.parse(current_progress.progress_xml_file), pretty_print=True)
+        with patch('AndroidRunner.Progress.Progress.check_config_hash'):
+            resumed = Progress(config_file=None, progress_file=current_progress.progress_xml_file, load_progress=True)
+        assert resumed.runs == current_progress.runs
+        assert list(resumed.runs_to_run) == list(current_progress.runs_to_run)
+        assert resumed.runs_done == ['3']
 
-    def test_build_subject_xml_web(self, current_progress):
-        device = 'device1'
-        path = 'path1'
-        browser = 'browser1'
-        subject_xml = current_progress.build_subject_xml(device, path, browser)
-        expected_xml = '<device>device1</device><path>path1</path><browser>browser1</browser>'
-        assert subject_xml == expected_xml
-
-    def test_build_subject_xml_native(self, current_progress):
-        device = 'device1'
-        path = 'path1'
-        subject_xml = current_progress.build_subject_xml(device, path)
-        expected_xml = '<device>device1</device><path>path1</path>'
-        assert subject_xml == expected_xml
-
-    @patch('AndroidRunner.Progress.Progress.build_runs_xml')
     @patch('AndroidRunner.Progress.Progress.file_to_hash')
-    def test_build_progress_xml(self, file_to_hash_mock, build_runs_xml_mock, current_progress):
-        mock_config = Mock()
-        mock_config_file = Mock()
-        paths.OUTPUT_DIR = "test/dir"
+    def test_write_progress_to_file_runs_done(self, file_to_hash_mock, tmp_path, config_native_dict):
+        paths.OUTPUT_DIR = tmp_path.as_posix()
         file_to_hash_mock.return_value = 'hash123'
-        build_runs_xml_mock.return_value = "runs_xml"
-        expected_xml = "<experiment><configHash>hash123</configHash><outputDir>test/dir</outputDir>" \
-                       "<runsToRun>runs_xml</runsToRun><runsDone></runsDone></experiment>"
-        expected_lxml = et.fromstring(expected_xml)
-        build_progress = current_progress.build_progress_xml(mock_config, mock_config_file)
-        assert self.elements_equal(expected_lxml, build_progress)
+        mock_config_file = Mock()
+        progress = Progress(config_file=mock_config_file, config=config_native_dict)
+        progress.run_finished('0')
+        progress.write_progress_to_file()
+        expected_xml = "<experiment><configHash>hash123</configHash><outputDir>{}</outputDir>" \
+                       "<runsToRun/><runsDone><run runId=\"0\"><device>device1</device><path>path1</path>" \
+                       "<runCount>1</runCount></run></runsDone></experiment>".format(paths.OUTPUT_DIR)
+        assert self.elements_equal(et.fromstring(expected_xml), self.read_progress_xml(progress))
         file_to_hash_mock.assert_called_once_with(mock_config_file)
-        build_runs_xml_mock.assert_called_once_with(mock_config)
-
-    @patch('AndroidRunner.Progress.Progress.build_subject_xml')
-    def test_build_runs_xml_web(self, build_subject_xml_mock, current_progress, config_web_dict):
-        build_subject_xml_mock.return_value = "<device>device1</device><path>path1</path><browser>browser1</browser>"
-        runs_xml_web = current_progress.build_runs_xml(config_web_dict)
-        expected_runs_web = '<run runId="0"><device>device1</device><path>path1</path><browser>browser1</browser>' \
-                            '<runCount>1</runCount></run>'
-        assert runs_xml_web == expected_runs_web
-
-    @patch('AndroidRunner.Progress.Progress.build_subject_xml')
-    def test_build_runs_xml_non_web(self, build_subject_xml_mock, current_progress, config_native_dict):
-        build_subject_xml_mock.return_value = "<device>device1</device><path>path1</path>"
-        runs_xml_native = current_progress.build_runs_xml(config_native_dict)
-        expected_runs_native = '<run runId="0"><device>device1</device><path>path1</path><runCount>1</runCount></run>'
-        assert runs_xml_native == expected_runs_native
+
+    @patch('AndroidRunner.Progress.Progress.file_to_hash')
+    def test_write_progress_to_file_unfinished(self, file_to_hash_mock, tmp_path, config_native_dict):
+        paths.OUTPUT_DIR = tmp_path.as_posix()
+        file_to_hash_mock.return_value = 'hash123'
+        config_native_dict['replications'] = 2
+        progress = Progress(config_file=Mock(), config=config_native_dict)
+        progress.run_finished('0')
+        progress.write_progress_to_file(unfinished=['0'])
+        expected_xml = "<experiment><configHash>hash123</configHash><outputDir>{}</outputDir>" \
+                       "<runsToRun><run runId=\"0\"><device>device1</device><path>path1</path>" \
+                       "<runCount>1</runCount></run><run runId=\"1\"><device>device1</device><path>path1</path>" \
+                       "<runCount>2</runCount></run></runsToRun><runsDone/></experiment>".format(paths.OUTPUT_DIR)
+        assert self.elements_equal(et.fromstring(expected_xml), self.read_progress_xml(progress))
+
+    @staticmethod
+    def read_progress_xml(progress):
+        return et.parse(progress.progress_xml_file, et.XMLParser(remove_blank_text=True)).getroot()
+
+    def test_build_runs_web(self, config_web_dict):
+        config_web_dict['replications'] = 2
+        config_web_dict['browsers'] = ['browser1', 'browser2']
+        runs = self.build_runs(config_web_dict)
+        assert runs == [Run('0', 'device1', 'path1', 'browser1', 1), Run('1', 'device1', 'path1', 'browser1', 2),
+                        Run('2', 'device1', 'path1', 'browser2', 1), Run('3', 'device1', 'path1', 'browser2', 2)]
+
+    def test_build_runs_native(self, config_native_dict):
+        config_native_dict['devices'] = ['device1', 'device2']
+        config_native_dict['apps'] = ['com.app']
+        runs = self.build_runs(config_native_dict)
+        assert runs == [Run('0', 'device1', 'path1', None, 1), Run('1', 'device1', 'com.app', None, 1),
+                        Run('2', 'device2', 'path1', None, 1), Run('3', 'device2', 'com.app', None, 1)]
+
+    def test_build_runs_randomized(self, config_native_dict):
+        config_native_dict.update({'devices': ['device1', 'device2'], 'paths': ['path1', 'path2'],
+                                   'replications': 5, 'randomization': True, 'random_seed': 42})
+        ordered_runs = self.build_runs(dict(config_native_dict, randomization=False))
+
+        runs = self.build_runs(config_native_dict)
+
+        assert runs != ordered_runs
+        assert sorted(runs, key=lambda run: int(run.run_id)) == ordered_runs
+        assert self.build_runs(config_native_dict) == runs
+        config_native_dict['random_seed'] = 43
+        assert self.build_runs(config_native_dict) != runs
+
+    def test_build_runs_scheduler(self, config_native_dict):
+        config_native_dict.update({'devices': ['device1', 'device2'], 'paths': ['path1', 'path2'],
+                                   'replications': 5, 'scheduler': 'device_blocks', 'random_seed': 42})
+
+        runs = self.build_runs(config_native_dict)
+
+        assert [run.device for run in runs] == ['device1'] * 10 + ['device2'] * 10
+        assert runs != self.build_runs(dict(config_native_dict, scheduler='sequential'))
+
+    def test_get_schedule(self, two_device_progress):
+        assert [run.run_id for run in two_device_progress.get_schedule()] == ['0', '1', '2']
+        assert two_device_progress.get_schedule('dev2') == [Run('1', 'dev2', 'path1', None, 1),
+                                                            Run('2', 'dev2', 'path2', None, 1)]
+        assert two_device_progress.get_schedule('dev3') == []
+
+    @patch('AndroidRunner.Progress.Progress.file_to_hash')
+    def test_randomized_resume(self, file_to_hash_mock, tmp_path, config_native_dict):
+        paths.OUTPUT_DIR = tmp_path.as_posix()
+        file_to_hash_mock.return_value = 'hash'
+        config_native_dict.update({'paths': ['path1', 'path2', 'path3'], 'replications': 3, 'randomization': True})
+        progress = Progress(config_file='config.json', config=config_native_dict)
+        assert progress.random_seed is not None
+        first_run = progress.get_random_run()
+        assert first_run['runId'] == next(iter(progress.runs_to_run))
+        progress.run_finished(first_run['runId'])
+        progress.journal_run(first_run['runId'])
+
+        with patch('AndroidRunner.Progress.Progress.check_config_hash'):
+            resumed = Progress(config_file=None, progress_file=progress.progress_xml_file, load_progress=True)
+
+        assert resumed.random_seed == progress.random_seed
+        assert list(resumed.runs_to_run) == list(progress.runs_to_run)
+        remaining = []
+        while not resumed.experiment_finished_check():
+            remaining.append(resumed.get_random_run()['runId'])
+            resumed.run_finished(remaining[-1])
+        assert remaining == list(progress.runs_to_run)
+
+    @staticmethod
+    @patch('AndroidRunner.Progress.Progress.write_progress_to_file')
+    @patch('AndroidRunner.Progress.Progress.file_to_hash')
+    def build_runs(config, file_to_hash_mock, write_mock):
+        progress = Progress(config_file='config.json', config=config)
+        return [progress.runs[run_id] for run_id in progress.runs_to_run]
 
     def test_get_output_dir(self, current_progress):
         assert current_progress.get_output_dir() == "test/output/dir"
 
-    def test_subject_first_web_first(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = []
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_first('fake_device', 'fake_path', 'fake_browser')
-        assert subject_first is True
-
-    def test_subject_first_native_first(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = []
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_first('fake_device', 'fake_path')
-        assert subject_first is True
-
-    def test_subject_first_web_not_first(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = ['not_empty']
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_first('fake_device', 'fake_path', 'fake_browser')
-        assert subject_first is False
-
-    def test_subject_first_native_not_first(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = ['not_empty']
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_first('fake_device', 'fake_path')
-        assert subject_first is False
-
-    def test_subject_finished_web_finished(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = []
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_finished('fake_device', 'fake_path', 'fake_browser')
-        assert subject_first is True
-
-    def test_subject_finished_native_finished(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = []
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_finished('fake_device', 'fake_path')
-        assert subject_first is True
-
-    def test_subject_finished_web_not_finished(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = ['not_empty']
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_finished('fake_device', 'fake_path', 'fake_browser')
-        assert subject_first is False
-
-    def test_subject_finished_native_not_finished(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = ['not_empty']
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_finished('fake_device', 'fake_path')
-        assert subject_first is False
+    def test_subject_first_web(self, current_progress):
+        assert current_progress.subject_first('nexus6p', 'https://google.com/', 'firefox') is True
+        assert current_progress.subject_first('nexus6p', 'https://google.com/') is True
+        current_progress.run_finished('0')
+        assert current_progress.subject_first('nexus6p', 'https://google.com/', 'firefox') is False
+        assert current_progress.subject_first('nexus6p', 'https://google.com/') is False
+        assert current_progress.subject_first('nexus6p', 'https://google.com/', 'chrome') is True
+        assert current_progress.subject_first('nexus6p', 'https://apple.com/', 'firefox') is True
+
+    def test_subject_first_native(self, two_device_progress):
+        assert two_device_progress.subject_first('dev2', 'path1') is True
+        two_device_progress.run_finished('1')
+        assert two_device_progress.subject_first('dev2', 'path1') is False
+        assert two_device_progress.subject_first('dev1', 'path1') is True
+
+    def test_subject_finished_web(self, current_progress):
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/', 'firefox') is False
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/', 'chrome') is True
+        for run_id in ('0', '1'):
+            current_progress.run_finished(run_id)
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/', 'firefox') is False
+        current_progress.run_finished('2')
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/', 'firefox') is True
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/') is True
+        assert current_progress.subject_finished('nexus6p', 'https://apple.com/') is False
+
+    def test_subject_finished_native(self, two_device_progress):
+        assert two_device_progress.subject_finished('dev2', 'path1') is False
+        two_device_progress.run_finished('1')
+        assert two_device_progress.subject_finished('dev2', 'path1') is True
+        assert two_device_progress.subject_finished('dev2', 'path2') is False
 
     def test_run_finished(self, current_progress):
-        runs_to_run_mock = Mock()
-        runs_to_run_mock.findall.return_value = ['fake_element']
-        runs_done_mock = Mock()
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.side_effect = [runs_to_run_mock, runs_done_mock]
-        current_progress.progress_xml_content = mock_progress_xml
-
         current_progress.run_finished(0)
+        current_progress.run_finished('0')
 
-        runs_to_run_mock.remove.assert_called_once_with('fake_element')
-        runs_done_mock.append.assert_called_once_with('fake_element')
+        assert '0' not in [run['runId'] for run in current_progress.get_runs_to_run()]
+        assert current_progress.runs_done == ['0']
+        current_progress.write_progress_to_file()
+        runs_done_xml = self.read_progress_xml(current_progress).find('runsDone')
+        assert [run_xml.get('runId') for run_xml in runs_done_xml] == ['0']
 
-    def test_experiment_finished_check_true(self, current_progress):
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = et.fromstring('<runsToRun></runsToRun>')
-        current_progress.progress_xml_content = mock_progress_xml
-        experiment_finished = current_progress.experiment_finished_check()
+    def test_run_finished_resume(self, current_progress, tmp_path, test_config):
+        for run_id in ('4', '0'):
+            current_progress.run_finished(run_id)
+        current_progress.write_progress_to_file()
+
+        with patch('AndroidRunner.Progress.Progress.check_config_hash'):
+            resumed = Progress(config_file=test_config, progress_file=current_progress.progress_xml_file,
+                               load_progress=True)
+
+        assert resumed.runs_done == ['4', '0']
+        assert resumed.get_next_run() == {'runId': '1', 'device': 'nexus6p', 'path': 'https://google.com/',
+                                          'browser': 'firefox', 'runCount': 2}
+        assert resumed.subject_first('nexus6p', 'https://apple.com/', 'firefox') is False
+        assert resumed.device_first('nexus6p') is False
+
+    def test_experiment_finished_check_true(self, two_device_progress):
+        for run_id in ('0', '1', '2'):
+            two_device_progress.run_finished(run_id)
+        experiment_finished = two_device_progress.experiment_finished_check()
         assert experiment_finished is True
 
     def test_experiment_finished_check_false(self, current_progress):
@@ -330,12 +444,10 @@ class TestProgressMethods(object):
         device_first = current_progress.device_first('nexus6p')
         assert device_first is True
 
-    def test_device_first_false(self, current_progress):
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = et.fromstring('<runsDone><run><device>device1</device></run></runsDone>')
-        current_progress.progress_xml_content = mock_progress_xml
-        device_first = current_progress.device_first('device1')
-        assert device_first is False
+    def test_device_first_false(self, two_device_progress):
+        two_device_progress.run_finished('0')
+        assert two_device_progress.device_first('dev1') is False
+        assert two_device_progress.device_first('dev2') is True
 
     def test_device_finished_false(self, current_progress):
         device_finished = current_progress.device_finished('nexus6p')
@@ -348,22 +460,71 @@ class TestProgressMethods(object):
     def test_get_run_count_web(self, current_progress):
         device = 'nexus6p'
         path = 'https://google.com/'
-        run_xml = et.fromstring('<run runId="0"><device>nexus6p</device>'
-                                '<path>https://google.com/</path>'
-                                '<browser>firefox</browser></run>')
-        assert current_progress.get_run_count(run_xml, device, path) == 1
+        assert current_progress.get_run_count(device, path, 'firefox') == 1
 
         for _ in range(2):
             run = current_progress.get_next_run()
             current_progress.run_finished(run['runId'])
 
-        assert current_progress.get_run_count(run_xml, device, path) == 3
+        assert current_progress.get_run_count(device, path, 'firefox') == 3
+        assert current_progress.get_next_run()['runCount'] == 3
 
-    def test_get_run_count_native(self, current_progress):
-        device = 'nexus6p'
-        path = 'https://google.com/'
-        run_xml = et.fromstring('<run runId="0"><device>nexus6p</device><path>https://google.com/</path></run>')
-        assert current_progress.get_run_count(run_xml, device, path) == 1
-        run = current_progress.get_next_run()
-        current_progress.run_finished(run['runId'])
-        assert current_progress.get_run_count(run_xml, device, path) == 2
+    def test_get_run_count_native(self, two_device_progress):
+        assert two_device_progress.get_run_count('dev2', 'path1') == 1
+        two_device_progress.run_finished('1')
+        assert two_device_progress.get_run_count('dev2', 'path1') == 2
+
+    def test_journal_run(self, current_progress):
+        journal_file = op.join(paths.OUTPUT_DIR, 'progress.journal.jsonl')
+        assert current_progress.get_journal_file() == journal_file
+
+        with patch('os.fsync') as fsync_mock:
+            current_progress.journal_run('0', ['data/file.csv'])
+            current_progress.journal_run(1)
+
+        assert fsync_mock.call_count == 2
+        with open(journal_file, 'r') as f:
+            assert [json.loads(line) for line in f] == [{'runId': '0', 'files': ['data/file.csv']},
+                                                        {'runId': '1', 'files': []}]
+        assert current_progress.journal_size == 2
+
+    @patch('AndroidRunner.Progress.Progress.write_progress_to_file')
+    def test_journal_run_compact(self, write_progress_to_file, current_progress):
+        current_progress.COMPACT_INTERVAL = 3
+        for run_id in range(2):
+            current_progress.journal_run(run_id)
+        assert write_progress_to_file.call_count == 0
+        current_progress.journal_run(2)
+        write_progress_to_file.assert_called_once_with()
+
+    def test_write_progress_to_file_clears_journal(self, current_progress):
+        current_progress.journal_run('0')
+        assert op.isfile(current_progress.get_journal_file())
+
+        current_progress.write_progress_to_file()
+
+        assert not op.isfile(current_progress.get_journal_file())
+        assert not op.isfile(current_progress.progress_xml_file + '.tmp')
+        assert current_progress.journal_size == 0
+
+    def test_replay_journal(self, current_progress, test_config):
+        current_progress.run_finished('0')
+        current_progress.journal_run('0')
+        current_progress.write_progress_to_file()
+        for run_id in ('3', '1'):
+            current_progress.run_finished(run_id)
+            current_progress.journal_run(run_id, [run_id + '.csv'])
+        with open(current_progress.get_journal_file(), 'a') as f:
+            f.write('{"runId": "2", "fil')
+
+        with patch('AndroidRunner.Progress.Progress.check_config_hash'):
+            resumed = Progress(config_file=test_config, progress_file=current_progress.progress_xml_file,
+                               load_progress=True)
+
+        assert resumed.runs_done == ['0', '3', '1']
+        assert resumed.get_next_run()['runId'] == '2'
+        assert not op.isfile(resumed.get_journal_file())
+        with patch('AndroidRunner.Progress.Progress.check_config_hash'):
+            compacted = Progress(config_file=test_config, progress_file=current_progress.progress_xml_file,
+                                 load_progress=True)
+        assert compacted.runs_done == ['0', '3', '1']
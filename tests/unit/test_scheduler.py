@@ -0,0 +1,100 @@
+import pytest
+
+import AndroidRunner.Scheduler as Scheduler
+from AndroidRunner.Progress import Run
+from AndroidRunner.util import ConfigError
+
+
+class TestScheduler(object):
+    @pytest.fixture()
+    def runs(self):
+        runs = []
+        for device in ['dev1', 'dev2']:
+            for path in ['path1', 'path2', 'path3']:
+                for run_count in range(1, 4):
+                    runs.append(Run(str(len(runs)), device, path, None, run_count))
+        return runs
+
+    @staticmethod
+    def order(name, runs, seed=42):
+        return Scheduler.SCHEDULERS[name](seed).order(runs)
+
+    @pytest.mark.parametrize('name', list(Scheduler.SCHEDULERS))
+    def test_order_is_permutation(self, name, runs):
+        ordered = self.order(name, runs)
+
+        assert sorted(ordered, key=lambda run: int(run.run_id)) == runs
+        assert self.order(name, runs) == ordered
+
+    def test_sequential(self, runs):
+        assert self.order('sequential', runs, seed=None) == runs
+
+    def test_random(self, runs):
+        assert self.order('random', runs) != runs
+        assert self.order('random', runs) != self.order('random', runs, seed=43)
+
+    def test_device_blocks(self, runs):
+        ordered = self.order('device_blocks', runs)
+
+        assert [run.device for run in ordered] == ['dev1'] * 9 + ['dev2'] * 9
+        assert ordered != runs
+
+    def test_round_robin(self, runs):
+        ordered = self.order('round_robin', runs)
+
+        assert [run.device for run in ordered] == ['dev1', 'dev2'] * 9
+        assert [run for run in ordered if run.device == 'dev2'] == \
+            [run for run in self.order('device_blocks', runs) if run.device == 'dev2']
+
+    def test_round_robin_uneven(self):
+        runs = [Run('0', 'dev1', 'path1', None, 1), Run('1', 'dev1', 'path1', None, 2),
+                Run('2', 'dev2', 'path1', None, 1)]
+
+        assert [run.device for run in self.order('round_robin', runs)] == ['dev1', 'dev2', 'dev1']
+
+    def test_subject_blocks(self, runs):
+        ordered = self.order('subject_blocks', runs)
+
+        assert [run.device for run in ordered] == ['dev1'] * 9 + ['dev2'] * 9
+        subjects = [(run.device, run.path) for run in ordered]
+        assert all(subject == subjects[i // 3 * 3] for i, subject in enumerate(subjects))
+        assert [run.run_count for run in ordered] == [1, 2, 3] * 6
+        assert ordered != runs
+
+    def test_get_scheduler_default(self):
+        scheduler = Scheduler.get_scheduler({})
+
+        assert isinstance(scheduler, Scheduler.Sequential)
+        assert scheduler.seed is None
+
+    def test_get_scheduler_randomization(self):
+        scheduler = Scheduler.get_scheduler({'randomization': True})
+
+        assert isinstance(scheduler, Scheduler.Random)
+        assert isinstance(scheduler.seed, int)
+
+    def test_get_scheduler_seed(self):
+        scheduler = Scheduler.get_scheduler({'scheduler': 'subject_blocks', 'random_seed': 7})
+
+        assert isinstance(scheduler, Scheduler.SubjectBlocks)
+        assert scheduler.seed == 7
+
+    def test_get_scheduler_invalid(self):
+        with pytest.raises(ConfigError):
+            Scheduler.get_scheduler({'scheduler': 'fastest'})
+        with pytest.raises(ConfigError):
+            Scheduler.get_scheduler({'scheduler': 'random', 'random_seed': 'seed'})
+        with pytest.raises(ConfigError):
+            Scheduler.get_scheduler({'scheduler': 'sequential', 'randomization': True})
+
+    def test_get_scheduler_randomization_string(self):
+        # A string is rejected instead of being read as true by one check and as false by another
+        with pytest.raises(ConfigError):
+            Scheduler.get_scheduler({'randomization': 'False'})
+
+    def test_setup_overhead(self, runs):
+        assert Scheduler.setup_overhead(runs) == Scheduler.SetupOverhead(18, 6, 1)
+        assert Scheduler.setup_overhead(self.order('subject_blocks', runs)) == Scheduler.SetupOverhead(18, 6, 1)
+        assert Scheduler.setup_overhead(self.order('round_robin', runs)).device_changes == 17
+        assert Scheduler.setup_overhead(self.order('random', runs)).subject_setups > 6
+        assert Scheduler.setup_overhead([]) == Scheduler.SetupOverhead(0, 0, 0)
@@ -0,0 +1,140 @@
+import os.path as op
+
+import pytest
+
+import AndroidRunner.Adb as Adb
+import AndroidRunner.Simulator as Simulator
+import AndroidRunner.Waits as Waits
+from AndroidRunner.Device import Device
+from AndroidRunner.Plugins.AndroidDataPoints import DATA_POINTS
+from AndroidRunner.Plugins.Batterystats import Batterystats
+from AndroidRunner.util import file_md5
+
+
+class TestSimulator(object):
+    @pytest.fixture()
+    def client(self):
+        client = Simulator.SimulatedAdbClient()
+        client.add_device('serial1', ['org.mozilla.firefox'])
+        Adb.inject_client(client)
+        Adb.setup('adb', backend='simulated')
+        yield client
+        Adb.inject_client(None)
+        Adb.client = None
+
+    @pytest.fixture()
+    def device(self, client):
+        return Device('device1', 'serial1', {})
+
+    def test_clock(self):
+        clock = Simulator.Clock()
+        clock.sleep(1.5)
+        clock.sleep(-1)
+
+        assert clock.time() == 1.5
+
+    def test_setup(self, client):
+        assert Adb.client is client
+        assert Adb.devices() == {0: 'serial1'}
+        assert Adb.get_handle('serial1').session is None
+
+    def test_setup_not_injected(self):
+        with pytest.raises(Adb.AdbError):
+            Adb.setup('adb', backend='simulated')
+
+    def test_device_info(self, device):
+        assert device.get_api_level() == 28
+        assert str(device) == 'device1 (serial1, Android 9, API level 28)'
+
+    def test_launch_and_stop(self, device):
+        assert device.current_activity() is None
+
+        device.launch_package('org.mozilla.firefox')
+
+        assert device.current_activity() == 'org.mozilla.firefox'
+        assert device.is_running('org.mozilla.firefox')
+        device.force_stop('org.mozilla.firefox')
+        assert not device.is_running('org.mozilla.firefox')
+        assert device.current_activity() is None
+
+    def test_launch_activity(self, device):
+        device.launch_activity('org.mozilla.firefox', 'org.mozilla.gecko.BrowserApp', data_uri='https://example.com',
+                               action='android.intent.action.VIEW')
+
+        assert Waits.activity_focused(device, 'org.mozilla.firefox', timeout=0)
+
+    def test_install_uninstall(self, device, tmpdir):
+        apk = op.join(str(tmpdir), 'com.example.app.apk')
+        with open(apk, 'wb') as f:
+            f.write(b'apk')
+
+        device.install(apk)
+
+        assert device.get_app_list(refresh=True) == {'org.mozilla.firefox', 'com.example.app'}
+        assert device.get_apk_hash('com.example.app') == file_md5(apk)
+        assert device.get_apk_hash('org.mozilla.firefox') is None
+        assert device.file_size('/data/local/tmp/com.example.app.apk') is None
+        device.uninstall('com.example.app')
+        assert device.get_app_list(refresh=True) == {'org.mozilla.firefox'}
+        assert device.get_apk_hash('com.example.app') is None
+
+    def test_shell_batch(self, device):
+        device.launch_package('org.mozilla.firefox')
+
+        assert device.shell_batch(['pidof org.mozilla.firefox || ps', 'unknown command', 'getprop sys.boot_completed']) \
+            == ['4242', '', '1']
+
+    def test_shell_su(self, device):
+        assert device.adb.shell_su('getprop ro.build.version.sdk') == '28'
+
+    def test_push_pull(self, device, tmpdir):
+        local = op.join(str(tmpdir), 'local.txt')
+        with open(local, 'w') as f:
+            f.write('content')
+
+        device.push(local, '/sdcard/file.txt')
+        device.pull('/sdcard/file.txt', op.join(str(tmpdir), 'pulled.txt'))
+
+        assert device.file_size('/sdcard/file.txt') == 7
+        with open(op.join(str(tmpdir), 'pulled.txt')) as f:
+            assert f.read() == 'content'
+
+    def test_commands_advance_clock(self, client, device):
+        device.shell('logcat -c')
+        device.shell_batch(['logcat -c', 'logcat -c'])
+        device.adb.push_stream(iter([b'\0' * client.TRANSFER_BYTES_PER_SECOND]), '/sdcard/file')
+
+        assert client.clock.time() == pytest.approx(3 * client.COMMAND_SECONDS + 1)
+
+    @staticmethod
+    def sample(device, name, app=None):
+        """Returns the value of a data point of the android profiler"""
+        point = DATA_POINTS[name](name)
+        return point.parse(device.shell(point.command(app)), app)[name]
+
+    def test_canned_outputs(self, device):
+        device.launch_package('org.mozilla.firefox')
+
+        assert self.sample(device, 'cpu') == '12.5'
+        assert self.sample(device, 'mem') == '1843216'
+        assert self.sample(device, 'mem', 'org.mozilla.firefox') == '52345'
+        assert Batterystats.get_consumed_joules(device) == pytest.approx(12.3 * 4200 / 1000000.0 * 3600)
+        assert device.shell('cat /proc/cpuinfo | grep processor | wc -l') == '8'
+        assert device.shell('date +%s') == str(Simulator.SimulatedAdbClient.EPOCH)
+        assert device.logcat_regex('chromium') == device.adb.logcat().splitlines()[1]
+
+    def test_outputs_and_latencies(self, device):
+        client = Simulator.SimulatedAdbClient(latencies=[(r'^dumpsys', 0.5), (r'^dumpsys cpuinfo', 2)],
+                                              outputs=[(r'dumpsys cpuinfo', '50% TOTAL')])
+        client.add_device('serial1')
+        Adb.client = client
+        device = Device('device1', 'serial1', {})
+
+        assert self.sample(device, 'cpu') == '50'
+        assert client.clock.time() == pytest.approx(client.COMMAND_SECONDS + 0.5)
+        device.shell_batch(['dumpsys meminfo', 'dumpsys battery', 'date'])
+        assert client.clock.time() == pytest.approx(2 * client.COMMAND_SECONDS + 1.5)
+
+    def test_unknown_device(self, client):
+        with pytest.raises(IOError):
+            client.shell('serial2', 'getprop')
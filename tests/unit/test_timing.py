@@ -0,0 +1,66 @@
+import pytest
+
+from AndroidRunner import Timing
+
+
+class TestTiming(object):
+    @pytest.fixture(autouse=True)
+    def reset(self):
+        Timing.current = None
+        Timing.summary = Timing.Summary()
+        yield
+        Timing.current = None
+        Timing.summary = Timing.Summary()
+
+    def test_measure_nested(self):
+        Timing.start_run()
+        with Timing.measure('run'):
+            with Timing.measure('scripts.interaction') as hook:
+                pass
+        with Timing.measure('finish_run'):
+            pass
+
+        timings = Timing.end_run()
+
+        assert [(phase.name, phase.parent) for phase in timings.phases] == [
+            ('run', None), ('scripts.interaction', 'run'), ('finish_run', None)]
+        assert hook.duration <= timings.phases[0].duration
+        assert timings.phases[2].start >= timings.phases[0].start + timings.phases[0].duration
+        assert Timing.current is None
+        assert list(Timing.summary.phases) == ['run', 'scripts.interaction', 'finish_run']
+
+    def test_measure_error(self):
+        Timing.start_run()
+        with pytest.raises(ValueError):
+            with Timing.measure('run'):
+                raise ValueError()
+
+        assert Timing.current.phases[0].duration is not None
+        assert Timing.current.running == []
+
+    def test_measure_outside_run(self):
+        with Timing.measure('profilers.load') as phase:
+            pass
+
+        assert phase.duration is not None
+        assert Timing.end_run().phases == []
+        assert Timing.summary.phases == {}
+
+    def test_summary(self):
+        Timing.summary.add([('run', 2.0), ('profilers.load', 1.0), ('profilers.load', 0.5)])
+        Timing.summary.add([('run', 4.0)])
+        other = Timing.Summary()
+        other.add([('run', 1.0), ('finish_run', 3.0)])
+
+        Timing.summary.merge(other)
+
+        assert Timing.summary.phases == {'run': (3, 7.0, 1.0, 4.0), 'profilers.load': (1, 1.5, 1.5, 1.5),
+                                         'finish_run': (1, 3.0, 3.0, 3.0)}
+        assert Timing.summary.to_rows()[0] == {'phase': 'run', 'runs': 3, 'total': '7.000000', 'mean': '2.333333',
+                                               'min': '1.000000', 'max': '4.000000'}
+
+    def test_phase_to_dict(self):
+        phase = Timing.Phase('scripts.before_run', 'run', 0.25)
+        phase.duration = 1.5
+
+        assert list(phase.to_dict().values()) == ['scripts.before_run', 'run', '0.250000', '1.500000']
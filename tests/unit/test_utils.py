@@ -25,7 +25,7 @@ class TestUtilClass(object):
         config = util.load_json(op.join(fixtures, 'test_config.json'))
         assert config['type'] == 'web'
         assert config['devices'] == ['nexus6p']
-        assert config['randomization'] == 'False'
+        assert config['randomization'] is False
         assert config['replications'] == 3
 
     def test_load_json_file_format_error(self, tmp_file):
@@ -94,6 +94,14 @@ class TestUtilClass(object):
         assert self.csv_reader_to_table(tmp_file) == list(
             [['key1', 'key2'], ['value1', 'value2'], ['value3', 'value4']])
 
+    def test_iter_lines(self):
+        chunks = [b'a,b\r\n1,', b'2\n\xe2\x82', b'\xac,4']
+
+        assert list(util.iter_lines(iter(chunks))) == ['a,b\r\n', '1,2\n', '\u20ac,4']
+
+    def test_file_md5(self, tmp_file):
+        assert util.file_md5(tmp_file, chunk_size=4) == '9473fdd0d880a43c21b7778d34872157'
+
     def test_list_subdir(self, fixture_dir):
         test_dir = op.join(fixture_dir, 'test_dir_struct')
 
@@ -146,6 +154,14 @@ class TestTestsClass(object):
     def test_is_integer_succes(self):
         assert Tests.is_integer(10) == 10
 
+    def test_is_boolean_fail(self):
+        with pytest.raises(util.ConfigError) as except_result:
+            Tests.is_boolean('False')
+        assert 'False is not true or false' in str(except_result.value)
+
+    def test_is_boolean_succes(self):
+        assert Tests.is_boolean(False) is False
+
     def test_is_string_fail(self):
         with pytest.raises(util.ConfigError) as except_result:
             Tests.is_string(list())
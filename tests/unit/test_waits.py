@@ -0,0 +1,110 @@
+import pytest
+from mock import Mock, patch
+
+import AndroidRunner.Timing as Timing
+import AndroidRunner.Waits as Waits
+from AndroidRunner.Adb import AdbError
+
+
+class TestWaits(object):
+    @pytest.fixture(autouse=True)
+    def timings(self):
+        yield Timing.start_run()
+        Timing.current = None
+
+    @pytest.fixture()
+    def device(self):
+        device = Mock()
+        device.id = 'device1'
+        return device
+
+    @patch('time.sleep')
+    def test_until_satisfied(self, sleep, timings):
+        condition = Mock(side_effect=[False, False, True])
+
+        assert Waits.until(condition, 'condition', timeout=10, interval=0.5)
+
+        assert condition.call_count == 3
+        assert sleep.call_count == 2
+        sleep.assert_called_with(0.5)
+        assert [phase.name for phase in timings.phases] == ['wait.until']
+        assert timings.phases[0].duration is not None
+
+    @patch('time.sleep')
+    def test_until_timeout(self, sleep, timings):
+        condition = Mock(return_value=False)
+
+        assert not Waits.until(condition, 'condition', timeout=0)
+
+        condition.assert_called_once_with()
+        assert sleep.call_count == 0
+        assert len(timings.phases) == 1
+
+    @patch('time.sleep')
+    def test_until_adb_error(self, sleep):
+        condition = Mock(side_effect=[AdbError('Could not parse activity from dumpsys'), True])
+
+        assert Waits.until(condition, 'condition')
+        assert condition.call_count == 2
+
+    def test_until_other_error(self):
+        condition = Mock(side_effect=ValueError('boom'))
+
+        with pytest.raises(ValueError):
+            Waits.until(condition, 'condition')
+
+    @patch('time.sleep')
+    def test_activity_focused(self, sleep, device):
+        device.current_activity.side_effect = [None, 'com.launcher', 'com.app']
+
+        assert Waits.activity_focused(device, 'com.app')
+        assert device.current_activity.call_count == 3
+
+    @patch('time.sleep')
+    def test_process_started(self, sleep, device):
+        device.is_running.side_effect = [False, True]
+
+        assert Waits.process_started(device, 'com.app')
+        device.is_running.assert_called_with('com.app')
+
+    @patch('time.sleep')
+    def test_process_gone(self, sleep, device, timings):
+        device.is_running.side_effect = [True, False]
+
+        assert Waits.process_gone(device, 'com.app')
+        assert [phase.name for phase in timings.phases] == ['wait.process_gone']
+
+    @patch('time.sleep')
+    def test_file_exists(self, sleep, device):
+        device.file_size.side_effect = [None, 0]
+
+        assert Waits.file_exists(device, '/sdcard/file')
+        device.file_size.assert_called_with('/sdcard/file')
+
+    @patch('time.sleep')
+    def test_file_complete(self, sleep, device):
+        device.file_size.side_effect = [None, 10, 20, 20]
+
+        assert Waits.file_complete(device, '/sdcard/file')
+        assert device.file_size.call_count == 4
+        sleep.assert_called_with(0.5)
+
+    @patch('time.sleep')
+    def test_sleep(self, sleep, timings):
+        Waits.sleep(1.5, 'device1: duration')
+
+        sleep.assert_called_once_with(1.5)
+        assert [phase.name for phase in timings.phases] == ['wait.sleep']
+
+    def test_clock(self):
+        clock = Mock()
+        clock.time.side_effect = [0, 0.5, 1]
+        with patch('AndroidRunner.Waits.clock', clock):
+            assert not Waits.until(lambda: False, 'condition', timeout=1, interval=0.5)
+
+        clock.sleep.assert_called_once_with(0.5)
+
+    def test_broadcast_acknowledged(self):
+        assert Waits.broadcast_acknowledged('Broadcasting: Intent { act=com.app.action flg=0x400000 }\n'
+                                            'Broadcast completed: result=0')
+        assert not Waits.broadcast_acknowledged('')